@@ -0,0 +1,115 @@
+"""
+Benchmark of how long command line scripts take to open a site's database.
+
+Times opening a site's home by spinning up the site's Pyramid application, as
+`get_site_home` does, against opening only its storage, with
+`LazySite.open_home`, as the read only commands do, both in process and for
+whole `jove settings list` and `jove evolve status` invocations.
+
+    $ python benchmarks/bench_cli_home.py
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPEAT = 20
+CLI_REPEAT = 5
+
+COMMANDS = (
+    ('settings list', ('settings', 'list', 'site0')),
+    ('evolve status', ('evolve', 'site0', 'status')),
+)
+
+jove_ini = """\
+[app:jove]
+use = egg:jove#main
+sites_config = %(here)s/sites.ini
+"""
+
+site_ini = """\
+[site:site0]
+application = jove#test_app
+zodbconn.uri = file://%(here)s/Data.fs
+"""
+
+# Runs the command line with read only commands spinning up the whole site
+before = """\
+from jove.scripts import utils
+utils.read_site_home = utils.get_site_home
+from jove.scripts.main import main
+main()
+"""
+
+after = """\
+from jove.scripts.main import main
+main()
+"""
+
+
+def open_site(site):
+    from pyramid.scripting import get_root
+    root, closer = get_root(site.site())
+    closer()
+
+
+def open_home(site):
+    home, closer = site.open_home()
+    closer()
+
+
+def time_opener(site, opener):
+    best = None
+    for i in xrange(REPEAT):
+        site.close()
+        start = time.time()
+        opener(site)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    site.close()
+    return best
+
+
+def time_command(ini_path, code, args):
+    argv = [sys.executable, '-c', code, '-C', ini_path] + list(args)
+    with open(os.devnull, 'w') as devnull:
+        best = None
+        for i in xrange(CLI_REPEAT):
+            start = time.time()
+            subprocess.check_call(argv, stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    return best
+
+
+def main():
+    from jove.scripts.main import load_app
+    tmp = tempfile.mkdtemp('.jove-bench')
+    try:
+        ini_path = os.path.join(tmp, 'jove.ini')
+        with open(ini_path, 'w') as out:
+            out.write(jove_ini)
+        with open(os.path.join(tmp, 'sites.ini'), 'w') as out:
+            out.write(site_ini)
+
+        site = load_app(ini_path, 'jove').registry.sites.get('site0')
+        open_home(site)  # Bootstrap the site
+        print '%-24s %10s %10s' % ('', 'before', 'after')
+        print '%-24s %9.1fms %9.1fms' % (
+            'open site0 in process',
+            time_opener(site, open_site) * 1000,
+            time_opener(site, open_home) * 1000)
+        for label, args in COMMANDS:
+            print '%-24s %9.3fs %9.3fs' % (
+                label, time_command(ini_path, before, args),
+                time_command(ini_path, after, args))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark of `jove` command line startup time as the number of sites grows.
+
+Writes configs with increasing numbers of sites and times, as separate
+processes, a command implemented by a script (`settings list --help`), a
+command implemented by a service (`evolve --help`) and a command which
+operates on a single site (`check site0`).  None of them should slow down
+noticeably as sites are added, since service commands are declared by the
+installed services rather than found from each site.
+
+    $ python benchmarks/bench_cli_startup.py
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SITE_COUNTS = (1, 10, 100, 1000)
+REPEAT = 3
+
+COMMANDS = (
+    ('settings list --help', ('settings', 'list', '--help')),
+    ('evolve --help', ('evolve', '--help')),
+    ('check site0', ('check', 'site0')),
+)
+
+jove_ini = """\
+[app:jove]
+use = egg:jove#main
+sites_config = %(here)s/sites.ini
+"""
+
+site_ini = """\
+[site:site%d]
+application = jove#test_app
+zodbconn.uri = memory://
+"""
+
+
+def time_command(ini_path, args):
+    argv = [sys.executable, '-c', 'from jove.scripts.main import main; main()',
+            '-C', ini_path] + list(args)
+    with open(os.devnull, 'w') as devnull:
+        best = None
+        for i in xrange(REPEAT):
+            start = time.time()
+            subprocess.check_call(argv, stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    return best
+
+
+def main():
+    tmp = tempfile.mkdtemp('.jove-bench')
+    try:
+        ini_path = os.path.join(tmp, 'jove.ini')
+        with open(ini_path, 'w') as out:
+            out.write(jove_ini)
+
+        print '%8s' % 'sites' + ''.join(
+            '%22s' % label for label, args in COMMANDS)
+        for n_sites in SITE_COUNTS:
+            with open(os.path.join(tmp, 'sites.ini'), 'w') as out:
+                for i in xrange(n_sites):
+                    out.write(site_ini % i)
+            timings = [time_command(ini_path, args) for label, args in COMMANDS]
+            print '%8d' % n_sites + ''.join(
+                '%21.3fs' % elapsed for elapsed in timings)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
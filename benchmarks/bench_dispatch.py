@@ -0,0 +1,53 @@
+"""
+Microbenchmark for site lookup in the dispatcher.
+
+Builds a `jove.site.DispatchIndex` for increasing numbers of sites and
+measures the cost of a single lookup by path prefix, by virtual host and by
+wildcard virtual host.  Per lookup cost should stay flat as the number of
+sites grows.
+
+    $ python benchmarks/bench_dispatch.py
+"""
+import timeit
+
+from jove.site import DispatchIndex
+
+SITE_COUNTS = (10, 100, 1000, 10000, 100000)
+NUMBER = 200000
+
+
+def make_index(n_sites):
+    sites = {}
+    virtual_hosts = {}
+    for i in xrange(n_sites):
+        name = 'site%d' % i
+        sites[name] = name
+        virtual_hosts['www.%s.example.com:80' % name] = name
+        virtual_hosts['*.%s.example.org' % name] = name
+    return DispatchIndex(sites, virtual_hosts, 'site0')
+
+
+def main():
+    print '%8s %12s %12s %12s %12s' % (
+        'sites', 'prefix', 'vhost', 'wildcard', 'root')
+    for n_sites in SITE_COUNTS:
+        index = make_index(n_sites)
+        name = 'site%d' % (n_sites - 1)
+        cases = (
+            ('localhost:8080', (name, 'foo', 'bar')),
+            ('WWW.%s.example.com' % name, ('foo', 'bar')),
+            ('a.b.%s.example.org:443' % name, ('foo', 'bar')),
+            ('localhost', ('nosuchsite', 'foo')),
+        )
+        timings = []
+        for host, path in cases:
+            assert index.lookup(host, path)[0] is not None
+            elapsed = timeit.timeit(
+                lambda: index.lookup(host, path), number=NUMBER)
+            timings.append(elapsed / NUMBER * 1e9)
+        print '%8d %10.0fns %10.0fns %10.0fns %10.0fns' % (
+            (n_sites,) + tuple(timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark of the memory used by sharded and unsharded worker pools.
+
+Serves a number of sites with `jove serve --workers N`, first with every
+worker serving every site and then with sites sharded between the workers,
+sends each site enough requests to reach every worker, and reports the total
+resident memory of the workers.  Sharded workers should each hold only their
+own sites, so total memory should grow with the number of sites rather than
+with the number of sites times the number of workers.  Linux only, as it
+reads memory use from /proc.
+
+    $ python benchmarks/bench_shard_rss.py [sites] [workers]
+"""
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+N_SITES = 100
+N_WORKERS = 4
+
+jove_ini = """\
+[app:jove]
+use = egg:jove#main
+sites_config = %(here)s/sites.ini
+"""
+
+site_ini = """\
+[site:site%d]
+application = jove#test_app
+zodbconn.uri = memory://
+"""
+
+
+def children(pid):
+    with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+        return [int(child) for child in f.read().split()]
+
+
+def rss(pid):
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def measure(ini_path, n_sites, n_workers, shard):
+    args = [sys.executable, '-c', 'from jove.scripts.main import main; main()',
+            '-C', ini_path, 'serve', '--port', '0',
+            '--workers', str(n_workers)]
+    if shard:
+        args.append('--shard')
+    process = subprocess.Popen(args, stderr=subprocess.PIPE)
+    try:
+        url = process.stderr.readline().split()[-4]
+        # Keep the server's log from filling the pipe
+        drain = threading.Thread(target=process.stderr.read)
+        drain.daemon = True
+        drain.start()
+        start = time.time()
+        for i in xrange(n_sites):
+            for j in xrange(n_workers * 2):
+                urllib2.urlopen('%s/site%d/' % (url, i)).read()
+        elapsed = time.time() - start
+        return sum(rss(child) for child in children(process.pid)), elapsed
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.wait()
+
+
+def main(n_sites=N_SITES, n_workers=N_WORKERS):
+    tmp = tempfile.mkdtemp('.jove-bench')
+    try:
+        ini_path = os.path.join(tmp, 'jove.ini')
+        with open(ini_path, 'w') as out:
+            out.write(jove_ini)
+        with open(os.path.join(tmp, 'sites.ini'), 'w') as out:
+            for i in xrange(n_sites):
+                out.write(site_ini % i)
+
+        print '%d sites, %d workers' % (n_sites, n_workers)
+        print '%10s %14s %10s' % ('layout', 'total rss', 'time')
+        for shard in (False, True):
+            total, elapsed = measure(ini_path, n_sites, n_workers, shard)
+            print '%10s %12.1fMB %9.2fs' % (
+                'sharded' if shard else 'unsharded', total / float(1 << 20),
+                elapsed)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -1,7 +1,25 @@
+import errno
+import fcntl
+import logging
+import os
+import signal
+import threading
+
 from pyramid.config import Configurator
 from pyramid.exceptions import NotFound
+from pyramid.interfaces import IResponse
+from zope.interface import implementer
 
+from jove.metrics import metrics_view
+from jove.proxy import FORWARDED_KEY
+from jove.proxy import ProxyResponse
 from jove.site import Sites
+from jove.utils import asbool
+
+# Keys placed in the environ by the Pyramid router
+ROUTER_KEYS = ('bfg.routes.route', 'bfg.routes.matchdict')
+
+log = logging.getLogger(__name__)
 
 
 def make_app(global_config, **local_config):
@@ -9,17 +27,80 @@ def make_app(global_config, **local_config):
     settings.update(local_config)
     config = Configurator()
     config.begin()
+    if asbool(settings.get('jove.metrics', 'false')):
+        path = settings.get('jove.metrics.path', '/_jove/metrics')
+        config.add_route('jove.metrics', path)
+        config.add_view(metrics_view, route_name='jove.metrics')
     config.add_route('sites', '/*subpath')
-    config.add_view(site_dispatch, route_name='sites')
-    config.registry.sites = Sites(settings)
+    dispatch = settings.get('jove.dispatch', 'copy')
+    if dispatch == 'copy':
+        config.add_view(site_dispatch, route_name='sites')
+    elif dispatch == 'direct':
+        config.add_view(direct_site_dispatch, route_name='sites')
+    else:
+        raise ValueError("Unknown dispatch mode: %s" % dispatch)
+    config.registry.sites = sites = Sites(settings)
     config.end()
 
+    # The command line loads the application for every command, so sites are
+    # only warmed up, and reloaded, when serving.
+    if not asbool(global_config.get('jove.script', 'false')):
+        if asbool(settings.get('jove.warmup', 'false')):
+            threads = int(settings.get('jove.warmup.threads', 4))
+            sites.warmup(threads=threads)
+        if asbool(settings.get('jove.reload_on_sighup', 'false')):
+            reload_on_signal(sites)
+
     return config.make_wsgi_app()
 
 
+def reload_on_signal(sites, signum=signal.SIGHUP):
+    """
+    Reloads the sites config when the process receives the signal, `signum`.
+    The signal handler only writes to a pipe, which wakes up a thread that
+    does the reload, since reloading takes locks which the interrupted code
+    may hold.  Signals received while a reload is running are handled by a
+    single reload once it has finished.
+
+    The handler can only be installed from the main thread, so this does
+    nothing when called from any other thread.
+    """
+    wakeup, waker = os.pipe()
+    flags = fcntl.fcntl(waker, fcntl.F_GETFL)
+    fcntl.fcntl(waker, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def handler(signum, frame):
+        try:
+            os.write(waker, 'x')
+        except OSError:
+            pass  # A reload is already pending
+    try:
+        signal.signal(signum, handler)
+    except ValueError:
+        os.close(wakeup)
+        os.close(waker)
+        return
+
+    def reloader():
+        while True:
+            try:
+                os.read(wakeup, 512)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            try:
+                sites.reload()
+            except Exception:
+                log.exception("Unable to reload sites config")
+    thread = threading.Thread(target=reloader, name='jove-reload')
+    thread.daemon = True
+    thread.start()
+
+
 def site_dispatch(request):
     sites = request.registry.sites
-    path = list(request.matchdict.get('subpath'))
+    path = request.matchdict.get('subpath')
     host = request.host
 
     # Copy request, getting rid of pyramid keys from the environ
@@ -34,35 +115,90 @@ def site_dispatch(request):
     if len(request.script_name) == 1:
         request.script_name = ''
 
-    # See if we're in a virtual hosting environment
-    name = sites.get_virtual_host(host)
-    if not name and path:
-        # We are not in a virtual hosting environment, so the first element of
-        # the path_info is the name of the site.
-        name = path.pop(0)
+    # Find the site to dispatch to, either by virtual host, by the first
+    # element of the path_info or by falling back to the root site.
+    site, name = sites.lookup(host, path)
 
-        # Get the site to dispatch to
-        site = sites.get(name)
+    # Sites owned by another process are forwarded to it
+    if site is not None:
+        forward = forward_to_owner(request, sites, site)
+        if forward is not None:
+            return forward
+        sites.touch(site)
 
-        # If we found the site, rewrite paths for subrequest
-        if site is not None:
-            script_name = '/'.join((request.script_name, name))
-            path_info = '/' + '/'.join(path)
-            request.script_name = script_name
-            request.path_info = path_info
-
-    else:
-        # Get the virtual host site to dispatch to
-        site = sites.get(name)
+    # If the site was found by name, rewrite paths for subrequest
+    if name is not None:
+        script_name = '/'.join((request.script_name, name))
+        path_info = '/' + '/'.join(path[1:])
+        request.script_name = script_name
+        request.path_info = path_info
 
-    # If we still don't have a site, see if one is defined as the root site.
     if site is None:
-        name = sites.root_site
-        if name is not None:
-            site = sites.get(name)
+        raise NotFound
+
+    return request.get_response(site)
+
+
+def direct_site_dispatch(request):
+    """
+    Dispatches to a site without copying the request.  The WSGI environ is
+    rewritten in place, only changing `SCRIPT_NAME` and `PATH_INFO` and
+    removing the keys set by the Pyramid router, and the site's pipeline is
+    called directly as a WSGI application, streaming its response.
+    """
+    sites = request.registry.sites
+    path = request.matchdict.get('subpath')
+    environ = request.environ
+    for key in ROUTER_KEYS:
+        environ.pop(key, None)
 
+    # nginx likes to set script name to '/' which screws up everybody
+    # trying to write urls and causes them to add an extra slash
+    if environ.get('SCRIPT_NAME') == '/':
+        environ['SCRIPT_NAME'] = ''
+
+    site, name = sites.lookup(request.host, path)
     if site is None:
         raise NotFound
 
-    return request.get_response(site.pipeline())
-
+    forward = forward_to_owner(request, sites, site)
+    if forward is not None:
+        return forward
+    sites.touch(site)
+
+    if name is not None:
+        request.script_name = '/'.join((request.script_name, name))
+        request.path_info = '/' + '/'.join(path[1:])
+
+    return PassThroughResponse(site)
+
+
+def forward_to_owner(request, sites, site):
+    """
+    When `sites` are sharded between processes, returns a response which
+    forwards the request to the process which owns `site`.  Returns `None`
+    if the site is owned by this process or the request has already been
+    forwarded.
+    """
+    if FORWARDED_KEY in request.environ:
+        return None
+    address = sites.owner(site)
+    if address is None:
+        return None
+    return ProxyResponse(address, sites.shard_timeout)
+
+
+@implementer(IResponse)
+class PassThroughResponse(object):
+    """
+    Response returned to the Pyramid router by `direct_site_dispatch`.  When
+    called by the router it simply calls the site, so the server's
+    `start_response` and the site's app_iter are passed through and response
+    bodies are streamed rather than collected.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        return self.app(environ, start_response)
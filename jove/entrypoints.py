@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+# Entry point groups kept in the manifest
+GROUPS = ('jove.application', 'jove.local_service', 'jove.script')
+
+# Metadata which lists a distribution's entry points, by type of distribution
+METADATA = (
+    ('.egg-info', 'entry_points.txt'),
+    ('.dist-info', 'entry_points.txt'),
+    ('.egg', os.path.join('EGG-INFO', 'entry_points.txt')),
+)
+
+log = logging.getLogger(__name__)
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+class EntryPoint(object):
+    """
+    An entry point read from the manifest.
+    """
+
+    def __init__(self, group, name, dist, module_name, attrs):
+        self.group = group
+        self.name = name
+        self.dist = dist
+        self.module_name = module_name
+        self.attrs = attrs
+
+    def load(self):
+        obj = __import__(self.module_name, fromlist=['__name__'])
+        for attr in self.attrs:
+            obj = getattr(obj, attr)
+        return obj
+
+    def __repr__(self):
+        return 'EntryPoint(%r, %r)' % (self.group, self.name)
+
+
+def iter_entry_points(group):
+    """
+    Returns the entry points in `group`, which must be one of `GROUPS`.
+    """
+    return [EntryPoint(group, *entry) for entry in get_manifest()[group]]
+
+
+def load_entry_point(dist, group, name):
+    """
+    Loads the entry point, `name`, in `group` provided by the distribution,
+    `dist`.  Raises `ImportError` if there is no such entry point, as
+    `pkg_resources.load_entry_point` does.
+    """
+    key = safe_name(dist)
+    for entry in get_manifest()[group]:
+        if entry[0] == name and safe_name(entry[1]) == key:
+            return EntryPoint(group, *entry).load()
+    raise ImportError("Entry point %r not found" % ((dist, group, name),))
+
+
+def get_manifest():
+    """
+    Returns the manifest of the entry points in Jove's plugpoint groups,
+    loading it from disk, or rebuilding it, on first use.  Reading the
+    manifest is much cheaper than querying the `pkg_resources` working set,
+    which in large environments can take hundreds of milliseconds for every
+    command line invocation.  The manifest maps each group in `GROUPS` to a
+    list of entry points, as `[name, dist, module_name, attrs]` lists.
+    """
+    global _manifest
+    manifest = _manifest
+    if manifest is not None:
+        return manifest
+    with _manifest_lock:
+        if _manifest is None:
+            _manifest = load_manifest(manifest_path(), stamp(sys.path))
+        return _manifest
+
+
+def load_manifest(path, key):
+    """
+    Reads the manifest at `path`, rebuilding it if it is missing or if it was
+    built for a different `key`.
+    """
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            return cached['groups']
+    except (IOError, ValueError):
+        pass
+
+    groups = build_manifest()
+    try:
+        save_manifest(path, {'key': key, 'groups': groups})
+    except (IOError, OSError), e:
+        log.debug("Unable to save entry point manifest %s: %s", path, e)
+    return groups
+
+
+def build_manifest():
+    import pkg_resources
+    groups = {}
+    for group in GROUPS:
+        entries = []
+        for ep in pkg_resources.iter_entry_points(group):
+            entries.append([ep.name, ep.dist.project_name, ep.module_name,
+                            list(ep.attrs)])
+        groups[group] = entries
+    return groups
+
+
+def save_manifest(path, manifest):
+    # Written to a temporary file and renamed into place, so concurrent
+    # processes never read a partly written manifest.
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    fd, tmp = tempfile.mkstemp(dir=folder)
+    try:
+        with os.fdopen(fd, 'w') as out:
+            json.dump(manifest, out)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def manifest_path():
+    """
+    Returns the path of the manifest, which may be set with the
+    `JOVE_ENTRY_POINTS` environment variable and is otherwise kept in the
+    user's cache folder, with one manifest per Python environment.
+    """
+    path = os.environ.get('JOVE_ENTRY_POINTS')
+    if path:
+        return path
+    cache = os.environ.get('XDG_CACHE_HOME',
+                           os.path.join(os.path.expanduser('~'), '.cache'))
+    prefix = hashlib.md5(sys.prefix).hexdigest()[:12]
+    return os.path.join(cache, 'jove', 'entry_points-%s.json' % prefix)
+
+
+def stamp(path):
+    """
+    Returns a key for the distributions installed on the search path, `path`,
+    which changes when a distribution is installed, removed or has its entry
+    points changed.  It is made from the folders on the path, the names of the
+    distributions in them and the modification times of their entry point
+    metadata.
+    """
+    found = []
+    for folder in path:
+        found.append(folder)
+        try:
+            names = os.listdir(folder or '.')
+        except OSError:
+            continue
+        for name in sorted(names):
+            for suffix, metadata in METADATA:
+                if name.endswith(suffix):
+                    filename = os.path.join(folder, name, metadata)
+                    try:
+                        mtime = os.stat(filename).st_mtime
+                    except OSError:
+                        mtime = None
+                    found.append((name, mtime))
+    return hashlib.md5(repr(found)).hexdigest()
+
+
+def safe_name(name):
+    return name.lower().replace('_', '-')
+
+
+def clear():
+    """
+    Forgets the manifest loaded by this process.
+    """
+    global _manifest
+    with _manifest_lock:
+        _manifest = None
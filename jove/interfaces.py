@@ -135,11 +135,13 @@ class LocalService(object):
         `pyramid.config.Configurator`.
         """
 
-    def scripts(self):
+    @classmethod
+    def scripts(cls):
         """
         Returns a sequence of (name, subparser) tuples for adding commands to
         the `Jove` command line interface. `name` is the name of the command
         and the `subparser` is the same thing used in [jove.script] entry
-        points.
+        points.  This is a class method, called on the service's factory, so
+        the command line can be built without creating any services.
         """
         return ()
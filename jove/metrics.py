@@ -0,0 +1,200 @@
+import bisect
+import threading
+import time
+
+from pyramid.response import Response
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class SiteMetrics(object):
+    """
+    Collects request counts, status codes and latencies for a site.  Each
+    observation holds an uncontended per site lock for a handful of
+    increments, so collection is cheap enough to leave on in production.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.statuses = {}
+        self.latency_counts = [0] * len(buckets)
+        self.latency_sum = 0.0
+
+    def observe(self, status, elapsed):
+        """
+        Records a request which finished with the status code, `status`,
+        after `elapsed` seconds.
+        """
+        i = bisect.bisect_left(self.buckets, elapsed)
+        with self.lock:
+            self.requests += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if i < len(self.latency_counts):
+                self.latency_counts[i] += 1
+            self.latency_sum += elapsed
+
+    def timer(self, start_response):
+        """
+        Starts timing a request.  Returns a tuple of `(start_response,
+        finished)` where `start_response` wraps the passed in callable to
+        capture the response status and `finished` is called with no
+        arguments to record the request once its response is complete.
+        """
+        start = time.time()
+        status = ['500']
+        def timed_start_response(status_line, headerlist, exc_info=None):
+            status[0] = status_line[:3]
+            return start_response(status_line, headerlist, exc_info)
+        def finished():
+            self.observe(status[0], time.time() - start)
+        return timed_start_response, finished
+
+    def snapshot(self):
+        """
+        Returns a consistent copy of the collected metrics as a tuple of
+        `(requests, statuses, latency_counts, latency_sum)`.
+        """
+        with self.lock:
+            return (self.requests, dict(self.statuses),
+                    list(self.latency_counts), self.latency_sum)
+
+
+def metrics_view(request):
+    """
+    Serves metrics for all sites in the Prometheus text exposition format.
+    """
+    response = Response(format_metrics(request.registry.sites))
+    response.headers['Content-Type'] = CONTENT_TYPE
+    return response
+
+
+def format_metrics(sites):
+    """
+    Formats metrics for `sites`, an instance of `jove.site.Sites`, in the
+    Prometheus text exposition format.
+    """
+    lines = []
+    def metric(name, type, help, samples):
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, type))
+        for suffix, labels, value in samples:
+            if labels:
+                labels = '{%s}' % ','.join(
+                    '%s="%s"' % (label, escape(value))
+                    for label, value in labels)
+            else:
+                labels = ''
+            lines.append('%s%s%s %s' % (name, suffix, labels,
+                                        format_value(value)))
+
+    names = sorted(sites.sites.keys())
+    stats = dict((name, sites.get(name).stats()) for name in names)
+    snapshots = {}
+    for name in names:
+        site_metrics = sites.get(name).metrics
+        if site_metrics is not None:
+            snapshots[name] = (site_metrics.buckets, site_metrics.snapshot())
+
+    def per_site(key):
+        return [('', (('site', name),), stats[name][key])
+                for name in names if key in stats[name]]
+
+    metric('jove_requests_total', 'counter', 'Requests served.',
+           [('', (('site', name),), snapshots[name][1][0])
+            for name in sorted(snapshots)])
+
+    samples = []
+    for name in sorted(snapshots):
+        statuses = snapshots[name][1][1]
+        for code in sorted(statuses):
+            samples.append(
+                ('', (('site', name), ('code', code)), statuses[code]))
+    metric('jove_responses_total', 'counter',
+           'Responses by HTTP status code.', samples)
+
+    samples = []
+    for name in sorted(snapshots):
+        buckets, (requests, statuses, counts, total) = snapshots[name]
+        cumulative = 0
+        for bound, count in zip(buckets, counts):
+            cumulative += count
+            samples.append(('_bucket', (('site', name), ('le', repr(bound))),
+                            cumulative))
+        samples.append(('_bucket', (('site', name), ('le', '+Inf')),
+                        requests))
+        samples.append(('_sum', (('site', name),), total))
+        samples.append(('_count', (('site', name),), requests))
+    metric('jove_request_duration_seconds', 'histogram',
+           'Time taken to serve requests.', samples)
+
+    metric('jove_requests_in_flight', 'gauge',
+           'Requests currently being served.', per_site('in_flight'))
+    metric('jove_site_active', 'gauge', 'Whether the site is spun up.',
+           per_site('active'))
+    metric('jove_cold_starts_total', 'counter', 'Times the site was spun up.',
+           per_site('cold_starts'))
+    metric('jove_cold_start_seconds_total', 'counter',
+           'Time spent spinning up the site.', per_site('cold_start_seconds'))
+    metric('jove_cold_start_waits_total', 'counter',
+           'Requests which waited for the site to be spun up.',
+           per_site('cold_start_waits'))
+    metric('jove_cold_start_wait_seconds_total', 'counter',
+           'Time requests spent waiting for the site to be spun up.',
+           per_site('cold_start_wait_seconds'))
+    metric('jove_zodb_connection_wait_seconds_total', 'counter',
+           'Time spent getting a database connection.',
+           per_site('connection_wait_seconds'))
+    metric('jove_zodb_pool_connections', 'gauge',
+           'Connections in the database connection pool.',
+           per_site('pool_connections'))
+    metric('jove_zodb_pool_in_use', 'gauge',
+           'Connections in use from the database connection pool.',
+           per_site('pool_in_use'))
+    metric('jove_zodb_cache_objects', 'gauge',
+           'Objects in the database object caches.',
+           per_site('cache_objects'))
+    metric('jove_zodb_cache_bytes', 'gauge',
+           'Estimated size of the database object caches.',
+           per_site('cache_bytes'))
+    metric('jove_conflicts_total', 'counter',
+           'Requests which raised a conflict error.', per_site('conflicts'))
+    metric('jove_conflict_retries_total', 'counter',
+           'Requests retried after a conflict error.',
+           per_site('conflict_retries'))
+    metric('jove_conflict_failures_total', 'counter',
+           'Conflict errors which were not retried.',
+           per_site('conflict_failures'))
+
+    samples = []
+    for name in names:
+        conflicts = getattr(sites.get(name), 'conflicts', None)
+        if conflicts is None:
+            continue
+        for (path, class_name, oid), count in conflicts.top():
+            samples.append(('', (('site', name), ('path', path),
+                                 ('class', class_name), ('oid', oid)), count))
+    metric('jove_conflict_hotspots_total', 'counter',
+           'Most frequent conflicts by path, class and oid.', samples)
+
+    metric('jove_evictions_total', 'counter',
+           'Idle sites closed to bound memory.', [('', (), sites.evictions)])
+
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
@@ -0,0 +1,229 @@
+import httplib
+import logging
+import socket
+import tempfile
+import urllib
+
+from pyramid.interfaces import IResponse
+from zope.interface import implementer
+
+# Environ key marking a request which has been forwarded to the worker which
+# owns its site, so it is never forwarded again.  It is only set by the
+# workers' private listeners, so clients can't forge it.
+FORWARDED_KEY = 'jove.forwarded'
+
+# Prefix of the environ keys of Jove's private headers, which are never
+# accepted from clients or passed on to sites.
+PRIVATE_PREFIX = 'HTTP_X_JOVE_'
+
+# Private headers carrying the parts of a forwarded request which aren't
+# otherwise passed on, and the environ keys they are restored to.
+FORWARDED_HEADERS = (
+    ('X-Jove-Script-Name', 'SCRIPT_NAME'),
+    ('X-Jove-Url-Scheme', 'wsgi.url_scheme'),
+    ('X-Jove-Remote-Addr', 'REMOTE_ADDR'),
+)
+
+# Characters left unquoted in forwarded paths
+PATH_SAFE = "/:@&+$,;=~!*'()"
+
+# Headers which apply to a single connection and are not forwarded
+HOP_BY_HOP = frozenset((
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade'))
+
+CHUNK_SIZE = 1<<16
+
+# Body of the response to a request which the owner of its site didn't
+# answer in time
+GATEWAY_TIMEOUT = 'Gateway Timeout'
+
+log = logging.getLogger(__name__)
+
+
+@implementer(IResponse)
+class ProxyResponse(object):
+    """
+    Response which forwards the request to the HTTP server listening at
+    `address`, a `(host, port)` tuple, and streams back its response.  The
+    request's `SCRIPT_NAME`, URL scheme and client address are passed on in
+    private headers, which `ShardMiddleware` restores.  The request body is
+    streamed to the server and the response body is streamed back, so
+    neither is held in memory.
+
+    If the server doesn't respond within `timeout` seconds, the response is
+    a `504 Gateway Timeout`.  With no `timeout`, it is waited for forever.
+    """
+
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self.timeout = timeout
+
+    def __call__(self, environ, start_response):
+        host, port = self.address
+        path = urllib.quote(environ.get('PATH_INFO', ''), PATH_SAFE)
+        query = environ.get('QUERY_STRING')
+        if query:
+            path += '?' + query
+
+        # A body without a length, which a server has decoded from a chunked
+        # request, is spooled to find its length.
+        input = environ['wsgi.input']
+        body = None
+        length = environ.get('CONTENT_LENGTH')
+        if not length and (environ.get('wsgi.input_terminated') or 'chunked'
+                           in environ.get('HTTP_TRANSFER_ENCODING', '')):
+            body = tempfile.SpooledTemporaryFile(CHUNK_SIZE)
+            copy(input, body)
+            length = body.tell()
+            body.seek(0)
+            input = body
+        length = int(length or 0)
+
+        conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+        try:
+            conn.putrequest(environ['REQUEST_METHOD'], path,
+                            skip_host=True, skip_accept_encoding=True)
+            for name, value in request_headers(environ):
+                conn.putheader(name, value)
+            if body is not None:
+                conn.putheader('Content-Length', str(length))
+            for name, value in forwarded_headers(environ):
+                conn.putheader(name, value)
+            conn.endheaders()
+
+            while length:
+                chunk = input.read(min(length, CHUNK_SIZE))
+                if not chunk:
+                    break
+                conn.send(chunk)
+                length -= len(chunk)
+
+            response = conn.getresponse()
+        except socket.timeout:
+            conn.close()
+            log.warn("Timed out forwarding request for %s to %s:%d",
+                     path, host, port)
+            start_response('504 Gateway Timeout', [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(GATEWAY_TIMEOUT)))])
+            return [GATEWAY_TIMEOUT]
+        except:
+            conn.close()
+            raise
+        finally:
+            if body is not None:
+                body.close()
+
+        status = '%d %s' % (response.status, response.reason)
+        start_response(status, response_headers(response.msg))
+        return ResponseIterator(response, conn)
+
+
+class ShardMiddleware(object):
+    """
+    Middleware for the listeners of a sharded worker, which removes Jove's
+    private headers from requests.  On the worker's private listener, to
+    which other workers forward requests, `forwarded` is true and requests
+    are marked as forwarded.
+    """
+
+    def __init__(self, app, forwarded=False):
+        self.app = app
+        self.forwarded = forwarded
+
+    def __call__(self, environ, start_response):
+        private = dict((key, environ.pop(key)) for key in list(environ)
+                       if key.startswith(PRIVATE_PREFIX))
+        if self.forwarded:
+            environ[FORWARDED_KEY] = True
+            for name, key in FORWARDED_HEADERS:
+                value = private.get(header_key(name))
+                if value is not None:
+                    environ[key] = urllib.unquote(value)
+        return self.app(environ, start_response)
+
+
+class ResponseIterator(object):
+    """
+    Streams the body of an `httplib` response, closing the connection once
+    the response is closed.
+    """
+
+    def __init__(self, response, conn):
+        self.response = response
+        self.conn = conn
+
+    def __iter__(self):
+        read = self.response.read
+        while True:
+            chunk = read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.response.close()
+        self.conn.close()
+
+
+def request_headers(environ):
+    """
+    Generates the `(name, value)` HTTP headers of the request described by
+    `environ`, excluding hop by hop headers.
+    """
+    for key, value in environ.items():
+        if key.startswith(PRIVATE_PREFIX):
+            continue
+        elif key.startswith('HTTP_'):
+            name = key[5:].replace('_', '-').title()
+        elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            if not value:
+                continue
+            name = key.replace('_', '-').title()
+        else:
+            continue
+        if name.lower() not in HOP_BY_HOP:
+            yield name, value
+
+
+def forwarded_headers(environ):
+    """
+    Generates the private `(name, value)` headers which carry the parts of
+    the request described by `environ` which aren't otherwise forwarded.
+    """
+    for name, key in FORWARDED_HEADERS:
+        value = environ.get(key, '')
+        if key == 'SCRIPT_NAME' and value == '/':
+            value = ''
+        yield name, urllib.quote(value, PATH_SAFE)
+
+
+def header_key(name):
+    return 'HTTP_' + name.upper().replace('-', '_')
+
+
+def copy(input, output):
+    while True:
+        chunk = input.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        output.write(chunk)
+
+
+def response_headers(message):
+    """
+    Returns the headers of an `httplib` response as a list of `(name,
+    value)` tuples, excluding hop by hop headers.  Repeated headers, like
+    `Set-Cookie`, are kept separate.
+    """
+    headers = []
+    for line in message.headers:
+        if line[:1] in (' ', '\t') and headers:
+            name, value = headers[-1]
+            headers[-1] = (name, value + ' ' + line.strip())
+            continue
+        name, value = line.split(':', 1)
+        headers.append((name.strip(), value.strip()))
+    return [(name, value) for name, value in headers
+            if name.lower() not in HOP_BY_HOP]
@@ -0,0 +1,346 @@
+import itertools
+import logging
+import random
+import socket
+import threading
+import time
+
+from tempfile import TemporaryFile
+
+from jove.utils import ClosingIterator
+
+try:
+    from transaction.interfaces import TransientError
+except ImportError: #pragma NO COVERAGE
+    class TransientError(Exception):
+        pass
+
+try:
+    from ZODB.POSException import ConflictError
+except ImportError: #pragma NO COVERAGE
+    class ConflictError(Exception):
+        pass
+
+retryable = (TransientError, ConflictError)
+
+log = logging.getLogger(__name__)
+
+
+class Retry(object):
+    """
+    WSGI middleware which retries requests that fail with a conflict error.
+    Retries are delayed by an exponential backoff with full jitter, so
+    colliding requests spread out rather than colliding again, and are
+    limited by a `RetryBudget` shared by all requests to a site.  Each
+    conflict is recorded in a `ConflictLog`.
+    """
+
+    def __init__(self, application, tries=3, delay=0.01, max_delay=1.0,
+                 budget=None, conflicts=None, retryable=retryable,
+                 spool_threshold=2<<20):
+        self.application = application
+        self.tries = tries
+        self.delay = delay
+        self.max_delay = max_delay
+        if budget is None:
+            budget = RetryBudget()
+        self.budget = budget
+        if conflicts is None:
+            conflicts = ConflictLog()
+        self.conflicts = conflicts
+        self.retryable = retryable
+        self.spool_threshold = spool_threshold
+
+    def __call__(self, environ, start_response):
+        body = None
+        if environ.get('wsgi.input') is not None:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            try:
+                body = SpooledBody(
+                    environ['wsgi.input'], length, self.spool_threshold)
+            except (socket.error, IOError):
+                # Different wsgi servers will generate either socket.error or
+                # IOError if there is a problem reading the request body.
+                msg = 'Not enough data in request or socket error'
+                start_response('400 Bad Request', [
+                    ('Content-Type', 'text/plain'),
+                    ('Content-Length', str(len(msg)))])
+                return [msg]
+            environ['wsgi.input'] = body.view()
+            environ['webob.is_body_seekable'] = True
+
+        try:
+            app_iter = self.call_application(environ, start_response, body)
+        except:
+            if body is not None:
+                body.close()
+            raise
+        if body is not None and body.spooled:
+            app_iter = ClosingIterator(app_iter, body.close)
+        return app_iter
+
+    def call_application(self, environ, start_response, body):
+        captured = []
+        written = []
+        def capture_start_response(status, headerlist, exc_info=None):
+            captured[:] = [status, headerlist, exc_info]
+            return written.append
+
+        budget = self.budget
+        budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                app_iter = self.application(environ, capture_start_response)
+                break
+            except self.retryable, e:
+                path = environ.get('PATH_INFO', '')
+                if attempt >= self.tries:
+                    self.conflicts.record(path, e, retried=False)
+                    raise
+                if not budget.withdraw():
+                    self.conflicts.record(path, e, retried=False)
+                    log.warn("Retry budget exhausted, not retrying %s", path)
+                    raise
+                self.conflicts.record(path, e, retried=True)
+                self.sleep(attempt)
+                attempt += 1
+                del captured[:], written[:]
+                if body is not None:
+                    environ['wsgi.input'] = body.view()
+
+        if not captured:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            raise AssertionError(
+                'app must call start_response before returning')
+        start_response(*captured)
+        if written:
+            return close_when_done(written, app_iter)
+        return app_iter
+
+    def sleep(self, attempt):
+        """
+        Sleeps for a random time of up to the backoff delay for the given
+        attempt.
+        """
+        delay = min(self.delay * (2 ** (attempt - 1)), self.max_delay)
+        if delay > 0:
+            time.sleep(random.uniform(0, delay))
+
+
+class SpooledBody(object):
+    """
+    A copy of a request body which can be read again by each attempt at
+    serving a request.  The body is read once from `input`, in small chunks.
+    Bodies of up to `threshold` bytes are kept in memory and larger ones are
+    spooled to a temporary file, so memory use does not grow with the size
+    of uploads.  Each attempt reads the body through its own read only
+    `BodyView`, without copying the body again.
+    """
+    chunk_size = 1<<16
+
+    def __init__(self, input, length, threshold):
+        self.length = length
+        self.spooled = spooled = length > threshold
+        if spooled:
+            data = TemporaryFile('w+b')
+            write = data.write
+        else:
+            chunks = []
+            write = chunks.append
+
+        rest = length
+        chunk_size = self.chunk_size
+        while rest:
+            chunk = input.read(min(rest, chunk_size))
+            if not chunk:
+                break
+            write(chunk)
+            rest -= len(chunk)
+        self.length -= rest
+
+        if spooled:
+            data.flush()
+        else:
+            data = ''.join(chunks)
+        self.data = data
+
+    def view(self):
+        return BodyView(self)
+
+    def read(self, pos, size):
+        data = self.data
+        if self.spooled:
+            data.seek(pos)
+            return data.read(size)
+        return data[pos:pos + size]
+
+    def find(self, char, pos, end):
+        if not self.spooled:
+            return self.data.find(char, pos, end)
+        data = self.data
+        data.seek(pos)
+        while pos < end:
+            chunk = data.read(min(self.chunk_size, end - pos))
+            if not chunk:
+                break
+            i = chunk.find(char)
+            if i != -1:
+                return pos + i
+            pos += len(chunk)
+        return -1
+
+    def close(self):
+        if self.spooled:
+            self.data.close()
+
+
+class BodyView(object):
+    """
+    A read only, file like view of a `SpooledBody` with its own position.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self.pos = 0
+
+    def read(self, size=-1):
+        pos = self.pos
+        rest = self.body.length - pos
+        if size is None or size < 0 or size > rest:
+            size = rest
+        self.pos = pos + size
+        return self.body.read(pos, size)
+
+    def readline(self, size=-1):
+        pos = self.pos
+        end = self.body.length
+        if size is not None and size >= 0:
+            end = min(end, pos + size)
+        i = self.body.find('\n', pos, end)
+        if i != -1:
+            end = i + 1
+        return self.read(end - pos)
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if hint > 0 and total >= hint:
+                break
+        return lines
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.body.length
+        self.pos = max(0, min(pos, self.body.length))
+
+    def tell(self):
+        return self.pos
+
+
+def close_when_done(written, app_iter):
+    try:
+        for chunk in itertools.chain(written, app_iter):
+            yield chunk
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+class RetryBudget(object):
+    """
+    Limits retries to a fraction, `ratio`, of requests.  Each request
+    deposits `ratio` tokens, up to a maximum of `burst`, and each retry
+    withdraws one.  When the budget is spent, conflicts are not retried, which
+    keeps a conflict storm from being amplified by retries.
+    """
+
+    def __init__(self, ratio=0.2, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = float(burst)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.burst)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class ConflictLog(object):
+    """
+    Keeps count of conflicts by path, persistent class and oid, to help find
+    conflict hotspots.  At most `max_entries` hotspots are kept, dropping the
+    least frequent ones to make room for new ones.
+    """
+
+    def __init__(self, max_entries=100):
+        self.max_entries = max_entries
+        self.conflicts = 0
+        self.retries = 0
+        self.failures = 0
+        self.hotspots = {}
+        self.lock = threading.Lock()
+
+    def record(self, path, error, retried):
+        """
+        Records a conflict, `error`, raised by a request for `path`.
+        `retried` is whether the request was retried.
+        """
+        key = (path, get_class_name(error), get_oid(error))
+        with self.lock:
+            self.conflicts += 1
+            if retried:
+                self.retries += 1
+            else:
+                self.failures += 1
+            hotspots = self.hotspots
+            if key not in hotspots and len(hotspots) >= self.max_entries:
+                coldest = min(hotspots, key=hotspots.get)
+                del hotspots[coldest]
+            hotspots[key] = hotspots.get(key, 0) + 1
+        log.info("Conflict at %s on %s %s%s", path, key[1], key[2],
+                 '' if retried else ', not retried')
+
+    def top(self, n=10):
+        """
+        Returns the `n` most frequent hotspots as a list of
+        `((path, class_name, oid), count)` tuples.
+        """
+        with self.lock:
+            items = self.hotspots.items()
+        items.sort(key=lambda item: item[1], reverse=True)
+        return items[:n]
+
+
+def get_class_name(error):
+    class_name = getattr(error, 'class_name', None)
+    if class_name is None:
+        return type(error).__name__
+    return class_name
+
+
+def get_oid(error):
+    oid = getattr(error, 'oid', None)
+    if oid is None:
+        return ''
+    return '0x%x' % int(oid.encode('hex'), 16)
@@ -0,0 +1,60 @@
+import sys
+import time
+
+try:
+    from zc.lockfile import LockError
+except ImportError: #pragma NO COVERAGE
+    class LockError(Exception):
+        pass
+
+from jove.scripts.utils import get_site
+
+
+def config_parser(name, subparsers):
+    parser = subparsers.add_parser(
+        name, help='Check that sites can be spun up, reporting how long each '
+        'one takes.')
+    parser.add_argument('-t', '--threads', type=int, metavar='NUMBER',
+                        default=None, help='Number of sites to check at '
+                        'once. Defaults to the jove.warmup.threads setting '
+                        'or 4.')
+    parser.add_argument('site', nargs='*',
+                        help='Sites to check. By default all sites are '
+                        'checked.')
+    parser.set_defaults(func=main, parser=parser)
+
+
+def main(args):
+    """
+    Spins up sites in this process, to check that their applications can be
+    configured and their databases opened.  This doesn't warm up a running
+    server, which has its own copies of the sites.  A site whose storage is
+    locked by another process, such as a server using a FileStorage, can't be
+    checked, and is reported as skipped rather than failed.
+    """
+    sites = args.app.registry.sites
+    names = args.site
+    for name in names:
+        get_site(args, name)
+    threads = args.threads
+    if threads is None:
+        threads = int(sites.settings.get('jove.warmup.threads', 4))
+
+    start = time.time()
+    results = sites.warmup(names or None, threads)
+    failed = skipped = 0
+    for name, elapsed, error in results:
+        if error is None:
+            print >> args.out, "%s: %0.3fs" % (name, elapsed)
+        elif isinstance(error, LockError):
+            skipped += 1
+            print >> args.out, "%s: SKIPPED, storage is locked by another " \
+                "process (%s)" % (name, error)
+        else:
+            failed += 1
+            print >> args.out, "%s: FAILED after %0.3fs (%s: %s)" % (
+                name, elapsed, type(error).__name__, error)
+    print >> args.out, "Checked %d sites in %0.3fs, %d failed, %d skipped." % (
+        len(results) - failed - skipped, time.time() - start, failed, skipped)
+    if failed:
+        sys.exit(1)
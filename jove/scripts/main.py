@@ -1,11 +1,12 @@
 import argparse
 import logging
 import os
-import pkg_resources
 import pdb
 import sys
 
 from paste.deploy import loadapp
+from jove.entrypoints import iter_entry_points
+from jove.site import LOCAL_SERVICE_ENTRYPOINT
 from jove.scripts.utils import retry
 
 logging.basicConfig(
@@ -26,21 +27,19 @@ def main(argv=sys.argv, out=sys.stdout):
     parser.add_argument('--retries', type=int, metavar='NUMBER', default=None,
         help='Number of times to retry if there are database conflict errors.')
 
-    # Load subcommands from entry points
+    # Find subcommands from entry points
     subparsers = parser.add_subparsers(
         title='command', help='Available commands.')
-    eps = [ep for ep in pkg_resources.iter_entry_points('jove.script')]
+    eps = iter_entry_points('jove.script')
     eps.sort(key=lambda ep: ep.name)
     ep_names = set()
     for ep in eps:
         if ep.name in ep_names:
             raise RuntimeError('script defined more than once: %s' % ep.name)
         ep_names.add(ep.name)
-        ep.load()(ep.name, subparsers)
 
     # Need to get hold of config necessary to load app before running the
-    # argument parser because we want to find configured services and
-    # add their commands to the parser.
+    # argument parser.
     appname = 'jove'
     config = None
     raw_args = list(argv)
@@ -56,14 +55,24 @@ def main(argv=sys.argv, out=sys.stdout):
     if not config:
         config = get_default_config()
 
-    # Load subcommands from configured services.
-    app = loadapp('config:%s' % config, appname)
-    for site in app.registry.sites.sites.values():
-        for service in site.services:
-            for name, subparser in service.scripts():
-                subparser(name, subparsers)
+    # When the command is one of the scripts above, only that script is
+    # loaded.  Otherwise the command might be provided by a service, or help
+    # has been asked for, so all scripts are loaded, along with the scripts
+    # declared by installed services.  The app is only loaded after parsing
+    # the arguments, and not at all for commands which load it themselves.
+    command = find_command(argv[1:])
+    for ep in eps:
+        if command not in ep_names or ep.name == command:
+            ep.load()(ep.name, subparsers)
+
+    if command not in ep_names:
+        for name, subparser in service_scripts():
+            subparser(name, subparsers)
 
     args = parser.parse_args(argv[1:])
+    app = None
+    if getattr(args, 'load_app', True):
+        app = load_app(config, appname)
     args.config = config
     args.app = app
     args.out = out
@@ -75,11 +84,57 @@ def main(argv=sys.argv, out=sys.stdout):
             func = debug(func)
         func(args)
     finally:
-        sites = getattr(app.registry, 'sites')
+        sites = getattr(getattr(app, 'registry', None), 'sites', None)
         if sites is not None:
             sites.close()
 
 
+# Global options which take a value
+VALUE_OPTIONS = ('-C', '--config', '-A', '--appname', '--retries')
+
+
+def find_command(argv):
+    """
+    Returns the name of the command in the command line arguments, `argv`,
+    without parsing them, or `None` if there is no command.
+    """
+    args = iter(argv)
+    for arg in args:
+        if arg in VALUE_OPTIONS:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
+
+def load_app(config, appname):
+    return loadapp('config:%s' % config, appname,
+                   global_conf={'jove.script': 'true'})
+
+
+def service_scripts():
+    """
+    Returns a sorted sequence of `(name, config_parser)` tuples for the
+    command line scripts declared by the installed local services.  Scripts
+    are declared by the `scripts` class method of each service's factory,
+    found in the entry point manifest, so neither the app nor any of its
+    sites need to be loaded to build the argument parser.
+    """
+    scripts = {}
+    for ep in iter_entry_points(LOCAL_SERVICE_ENTRYPOINT):
+        factory = ep.load()
+        declared = getattr(factory, 'scripts', None)
+        if declared is None:
+            continue
+        if getattr(declared, 'im_self', True) is None:
+            log.warn("Scripts of local service %s are ignored, because "
+                     "`scripts` isn't a class method.", ep.name)
+            continue
+        for script_name, subparser in declared():
+            scripts.setdefault(script_name, subparser)
+    return sorted(scripts.items())
+
+
 def get_default_config():
     config = 'jove.ini'
 
@@ -1,18 +1,464 @@
+import errno
+import logging
 import os
+import signal
+import socket
 import sys
+import threading
+import time
 
+from paste.deploy.loadwsgi import APP
+from paste.deploy.loadwsgi import loadcontext
+from paste.deploy.loadwsgi import PIPELINE
+from paste.deploy.loadwsgi import SERVER
+from paste.httpserver import server_runner
+from paste.httpserver import ThreadPoolMixIn
+from paste.httpserver import WSGIHandler
+from paste.httpserver import WSGIServerBase
 from paste.script.serve import ServeCommand
 
+from jove.application import reload_on_signal
+from jove.proxy import ShardMiddleware
+from jove.site import APPLICATION_ENTRYPOINT
+from jove.site import load_entry_point
+from jove.utils import asbool
+
+log = logging.getLogger(__name__)
+
+# Options of the Paste HTTP server which are supported with workers
+SERVER_OPTIONS = ('host', 'port', 'use_threadpool', 'threadpool_workers',
+                  'daemon_threads', 'socket_timeout', 'request_queue_size')
+
+# Options of the Paste HTTP server's thread pool, which are integers
+THREADPOOL_OPTIONS = ('max_requests', 'hung_thread_limit', 'kill_thread_limit',
+                      'dying_limit', 'spawn_if_under',
+                      'max_zombie_threads_before_die', 'hung_check_period')
+
 
 def config_parser(name, subparsers):
     parser = subparsers.add_parser(
         name, help='Serve the application using Paste HTTP server.')
-    parser.set_defaults(func=main, parser=parser)
+    parser.add_argument('-w', '--workers', type=int, metavar='NUMBER',
+                        default=None, help='Number of worker processes to '
+                        'fork. By default the application is served by a '
+                        'single process.')
+    parser.add_argument('--max-requests', type=int, metavar='NUMBER',
+                        default=0, help='Restart a worker after it has '
+                        'served this many requests. Defaults to no limit.')
+    parser.add_argument('--shard', action='store_true', default=False,
+                        help='Divide sites between the workers, forwarding '
+                        'requests for a site to the worker which owns it.')
+    parser.add_argument('--host', default=None, help='Address to listen on. '
+                        'Defaults to the host of the server in the ini file.')
+    parser.add_argument('--port', type=int, default=None, help='Port to '
+                        'listen on. Defaults to the port of the server in the '
+                        'ini file.')
+    parser.set_defaults(func=main, parser=parser, load_app=False)
 
 
 def main(args):
+    if args.workers is not None:
+        serve_workers(args)
+        return
+
     os.environ['PASTE_CONFIG_FILE'] = args.config
 
     cmd = ServeCommand('jove serve')
     exit_code = cmd.run([])
     sys.exit(exit_code)
+
+
+def serve_workers(args):
+    """
+    Serves the main pipeline of the ini file, as `jove serve` does without
+    workers, from a pool of forked worker processes which share one listening
+    socket.  The pipeline is loaded once, before forking, and workers which
+    die, or which reach their request limit, are replaced.
+
+    If sites are sharded, each worker only serves the sites it owns and also
+    listens on a private socket, to which the other workers forward requests
+    for its sites.
+    """
+    if args.workers < 1:
+        args.parser.error("Number of workers must be at least 1.")
+
+    # Import applications once, so workers share them, but database
+    # connections can't be shared with children.  The command line doesn't
+    # load the app for this command, so the pipeline is only loaded here.
+    pipeline, app = load_pipeline(args)
+    sites = app.registry.sites
+    for site in sites.sites.values():
+        load_entry_point(site.application_spec, APPLICATION_ENTRYPOINT)
+    sites.close()
+
+    conf = get_server_conf(args)
+    options = get_server_options(conf)
+    host, port = get_address(args, conf)
+    listener = listen(host, port, int(conf.get('request_queue_size',
+                                               socket.SOMAXCONN)))
+    host, port = listener.getsockname()[:2]
+
+    shard_listeners = None
+    if args.shard:
+        shard_listeners = [listen('127.0.0.1', 0)
+                           for i in xrange(args.workers)]
+
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Workers, and the copy of the sites they are forked from, reload the
+    # sites config on SIGHUP.  The handler only sets a flag, which the loop
+    # below checks, so the reload isn't run in the handler.
+    workers = {}
+    reloading = []
+    def reload(signum, frame):
+        reloading.append(signum)
+    signal.signal(signal.SIGHUP, reload)
+
+    log.info("Serving on http://%s:%d with %d workers", host, port,
+             args.workers)
+    try:
+        while not stopping:
+            if reloading:
+                del reloading[:]
+                reload_workers(app.registry.sites, workers)
+
+            running = set(index for index, started in workers.values())
+            for index in xrange(args.workers):
+                if index in running:
+                    continue
+                pid = os.fork()
+                if not pid:
+                    shard = None
+                    if shard_listeners is not None:
+                        shard = (index, shard_listeners)
+                    run_worker(pipeline, app, listener, args.max_requests,
+                               shard, options)
+                workers[pid] = (index, time.time())
+
+            # A signal received just before a blocking wait wouldn't be
+            # handled until a worker exited, so poll instead.  Signals cut the
+            # sleep short.
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            if not pid:
+                time.sleep(0.1)
+                continue
+
+            worker = workers.pop(pid, None)
+            if worker is None or stopping:
+                continue
+            index, started = worker
+            if os.WIFEXITED(status) and not os.WEXITSTATUS(status):
+                log.info("Worker %d recycled", pid)
+            else:
+                log.warn("Worker %d died, restarting", pid)
+                if time.time() - started < 1:
+                    # Don't spin if workers are dying on startup
+                    time.sleep(1)
+    finally:
+        # Wake up workers waiting for connections, then stop them.
+        try:
+            listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        listener.close()
+        for shard_listener in shard_listeners or ():
+            shard_listener.close()
+
+
+def reload_workers(sites, workers):
+    try:
+        sites.reload()
+    except Exception:
+        log.exception("Unable to reload sites config")
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except OSError:
+            pass
+
+
+def load_pipeline(args):
+    """
+    Loads the main pipeline of the ini file, which must end with the Jove
+    application.  Returns a tuple of `(pipeline, app)`, where `app` is the
+    Jove application.
+    """
+    try:
+        context = loadcontext(APP, 'config:%s' % args.config,
+                              global_conf={'jove.script': 'true'})
+        pipeline, app = create_pipeline(context)
+    except LookupError, e:
+        args.parser.error(str(e))
+    sites = getattr(getattr(app, 'registry', None), 'sites', None)
+    if sites is None:
+        args.parser.error("The main pipeline of %s must end with the Jove "
+                          "application." % args.config)
+    return pipeline, app
+
+
+def create_pipeline(context):
+    """
+    Creates the application described by the paste deploy `context`.
+    Returns a tuple of `(pipeline, app)`, where `app` is the application at
+    the end of the pipeline.
+    """
+    if context.object_type is PIPELINE:
+        pipeline, app = create_pipeline(context.app_context)
+        for filter_context in reversed(context.filter_contexts):
+            pipeline = filter_context.create()(pipeline)
+        return pipeline, app
+    if getattr(context, 'next_context', None) is not None:
+        # A filter-app section, or an app with filter-with
+        pipeline, app = create_pipeline(context.next_context)
+        return context.filter_context.create()(pipeline), app
+    app = context.create()
+    return app, app
+
+
+def listen(host, port, backlog=socket.SOMAXCONN):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+def run_worker(pipeline, app, listener, max_requests, shard=None,
+               options={}):
+    """
+    Serves requests with `pipeline` in a forked worker process until it is
+    told to stop or has served `max_requests` requests.  If sites are
+    sharded, `shard` is a tuple of `(index, listeners)`, where `listeners`
+    are the private listening sockets of all of the workers and `index` is
+    the position of this worker's own.  Requests forwarded by other workers
+    have already been through the pipeline, so they are served by the Jove
+    application, `app`, directly.  `options` are passed to each
+    `WorkerServer`.  Never returns.
+    """
+    status = 0
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        sites = app.registry.sites
+        reload_on_signal(sites)
+        if shard is None:
+            server = WorkerServer(pipeline, listener, max_requests, **options)
+        else:
+            server = WorkerServer(ShardMiddleware(pipeline), listener,
+                                  max_requests, **options)
+        servers = [server]
+        if shard is not None:
+            index, listeners = shard
+            sites.set_shard(index, [shard_listener.getsockname()
+                                    for shard_listener in listeners])
+            servers.append(WorkerServer(ShardMiddleware(app, forwarded=True),
+                                        listeners[index], timeout=1,
+                                        **options))
+            for i, shard_listener in enumerate(listeners):
+                if i != index:
+                    shard_listener.close()
+
+        def stop(signum, frame):
+            server.running = False
+        signal.signal(signal.SIGTERM, stop)
+
+        if asbool(sites.settings.get('jove.warmup', False)):
+            sites.warmup(threads=int(
+                sites.settings.get('jove.warmup.threads', 4)))
+
+        # Requests forwarded by other workers are served until this worker
+        # stops serving its share of the public socket.
+        threads = [threading.Thread(target=other.serve)
+                   for other in servers[1:]]
+        for thread in threads:
+            thread.start()
+        server.serve()
+        for other in servers[1:]:
+            other.running = False
+        for thread in threads:
+            thread.join()
+        sites.close()
+    except:
+        log.exception("Worker %d failed", os.getpid())
+        status = 1
+    finally:
+        os._exit(status)
+
+
+class WorkerServer(ThreadPoolMixIn, WSGIServerBase):
+    """
+    A Paste HTTP server which accepts connections from a listening socket
+    shared with other worker processes, serving connections from a pool of
+    `nworkers` threads, as the Paste HTTP server does by default.
+    `threadpool_options` are the options of Paste's `ThreadPool`, and
+    `socket_timeout`, if there is one, is set on each connection.
+
+    Unless there is a `timeout`, workers wait for connections in a blocking
+    `accept`, which wakes up only one of the workers waiting on the shared
+    socket for each connection.  Shutting down the socket stops them.  A
+    worker which reaches `max_requests` while waiting serves the connection
+    it is waiting for, then stops.
+    """
+
+    def __init__(self, app, listener, max_requests=0, timeout=None,
+                 nworkers=10, daemon=False, threadpool_options=None,
+                 socket_timeout=None):
+        self.listener = listener
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.requests = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        WSGIServerBase.__init__(self, app, listener.getsockname(),
+                                WorkerHandler)
+        self.wsgi_socket_timeout = socket_timeout
+        threadpool_options = dict(threadpool_options or {})
+        threadpool_options.setdefault('spawn_if_under', min(5, nworkers))
+        ThreadPoolMixIn.__init__(self, nworkers, daemon, **threadpool_options)
+
+    def server_bind(self):
+        self.socket.close()
+        self.socket = self.listener
+        self.server_address = self.socket.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def server_activate(self):
+        pass
+
+    def get_request(self):
+        try:
+            return WSGIServerBase.get_request(self)
+        except socket.error, e:
+            if e.args[0] == errno.EINVAL:
+                # The listening socket has been shut down
+                self.running = False
+            raise
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.pending += 1
+        ThreadPoolMixIn.process_request(self, request, client_address)
+
+    def process_request_in_thread(self, request, client_address):
+        try:
+            ThreadPoolMixIn.process_request_in_thread(
+                self, request, client_address)
+        finally:
+            with self.lock:
+                self.pending -= 1
+                if not self.pending:
+                    self.done.notify_all()
+
+    def request_started(self):
+        """
+        Counts a request, stopping the server once it has served
+        `max_requests` requests.
+        """
+        with self.lock:
+            self.requests += 1
+            if self.max_requests and self.requests >= self.max_requests:
+                self.running = False
+
+    def serve(self):
+        """
+        Handles requests until told to stop, then waits for the requests in
+        progress to finish.
+        """
+        while self.running:
+            if self.timeout is None:
+                self._handle_request_noblock()
+            else:
+                self.handle_request()
+        with self.lock:
+            while self.pending:
+                self.done.wait()
+        self.thread_pool.shutdown()
+
+
+class WorkerHandler(WSGIHandler):
+    """
+    Counts each request, of which there may be several on one connection,
+    with the `WorkerServer`.
+    """
+
+    def wsgi_execute(self, environ=None):
+        self.server.request_started()
+        WSGIHandler.wsgi_execute(self, environ)
+
+
+def get_server_conf(args):
+    """
+    Returns the options of the `[server:main]` section of the ini file, or
+    an empty dictionary if there isn't one.  Workers serve requests with
+    their own Paste HTTP server, so the section must use the Paste HTTP
+    server, and options which workers don't support, such as SSL, are
+    reported as errors rather than ignored.
+    """
+    try:
+        context = loadcontext(SERVER, 'config:%s' % args.config)
+    except LookupError:
+        return {}
+    if context.object is not server_runner:
+        args.parser.error("Workers can only be used with the Paste HTTP "
+                          "server, egg:Paste#http.")
+    conf = context.local_conf
+    unsupported = [name for name in sorted(conf)
+                   if name not in SERVER_OPTIONS and
+                   name[len('threadpool_'):] not in THREADPOOL_OPTIONS]
+    if not asbool(conf.get('use_threadpool', True)):
+        unsupported.append('use_threadpool = false')
+    if unsupported:
+        args.parser.error("Server options not supported with workers: %s" %
+                          ', '.join(unsupported))
+    return conf
+
+
+def get_server_options(conf):
+    """
+    Returns the keyword arguments of `WorkerServer` for the server options,
+    `conf`.
+    """
+    threadpool_options = {}
+    for name in THREADPOOL_OPTIONS:
+        value = conf.get('threadpool_' + name)
+        if value is not None:
+            threadpool_options[name] = int(value)
+    socket_timeout = conf.get('socket_timeout')
+    if socket_timeout is not None:
+        socket_timeout = int(socket_timeout)
+    return {
+        'nworkers': int(conf.get('threadpool_workers', 10)),
+        'daemon': asbool(conf.get('daemon_threads', False)),
+        'threadpool_options': threadpool_options,
+        'socket_timeout': socket_timeout,
+    }
+
+
+def get_address(args, conf):
+    host, port = args.host, args.port
+    if host is None:
+        host = conf.get('host', '127.0.0.1')
+    if port is None:
+        port = int(conf.get('port', 8080))
+    return host, port
@@ -1,9 +1,28 @@
 import colander
 import json
+import os
 import pprint
+import Queue
+import sys
+import threading
+import time
 import transaction
 
+try:
+    import yaml
+except ImportError: #pragma NO COVERAGE
+    yaml = None
+
+from pyramid.scripting import get_root
+
+from jove.scripts.utils import get_site
 from jove.scripts.utils import get_site_home
+from jove.scripts.utils import open_site_home
+from jove.scripts.utils import read_site_home
+from jove.scripts.utils import retryable
+
+# Key, in a settings patch, of the settings applied to every site
+ALL_SITES = '*'
 
 
 def config_parser(name, subparsers):
@@ -16,6 +35,7 @@ def config_parser(name, subparsers):
     config_append_setting(subparsers)
     config_insert_setting(subparsers)
     config_remove_setting(subparsers)
+    config_apply_settings(subparsers)
 
 
 def config_list_settings(subparsers):
@@ -68,8 +88,20 @@ def config_insert_setting(subparsers):
     parser.set_defaults(func=add_setting, parser=parser)
 
 
+def config_apply_settings(subparsers):
+    parser = subparsers.add_parser(
+        'apply', help='Apply a file of setting changes to one or more sites.')
+    parser.add_argument('-j', '--jobs', type=int, metavar='NUMBER',
+                        default=4, help='Number of sites to change at once. '
+                        'Defaults to 4.')
+    parser.add_argument('file', help='JSON or YAML file mapping site names, '
+                        'or "*" for all sites, to mappings of paths to new '
+                        'values for the settings.')
+    parser.set_defaults(func=apply_settings, parser=parser)
+
+
 def list_settings(args):
-    home, closer = get_site_home(args, args.site)
+    home, closer = read_site_home(args, args.site)
     _list_settings(home['settings'], args.out)
 
 
@@ -134,3 +166,215 @@ def remove_setting(args):
     _list_settings(settings, args.out)
 
 
+def apply_settings(args):
+    """
+    Applies a patch of setting changes to many sites.  Every site's changes
+    are first made to its current settings without being committed, and
+    nothing is applied if any of them fail.  Then each site's changes are
+    made in a single transaction, with `args.jobs` sites changed at once.
+    """
+    if args.jobs < 1:
+        args.parser.error("Number of jobs must be at least 1.")
+    patch = read_patch(args, args.file)
+    sites = args.app.registry.sites
+    changes = site_changes(args, sites, patch)
+
+    # Each site's database is closed once it has been checked, so a patch
+    # for many sites doesn't keep all of their storages open.
+    errors = []
+    for name, values in sorted(changes.items()):
+        site = sites.get(name)
+        try:
+            errors.extend('%s: %s' % (name, error)
+                          for error in check_site_changes(site, values))
+        finally:
+            site.close()
+    if errors:
+        args.parser.error('\n'.join(errors))
+
+    start = time.time()
+    results = apply_changes(sites, changes, args.jobs)
+    failed = 0
+    for name, diff, error in results:
+        if error is not None:
+            failed += 1
+            print >> args.out, "%s: FAILED (%s)" % (name, error)
+            continue
+        print >> args.out, "%s:" % name
+        for path, old, new in diff:
+            print >> args.out, "  %s: %r -> %r" % (path, old, new)
+        if not diff:
+            print >> args.out, "  no changes"
+    print >> args.out, "Applied settings to %d sites in %0.3fs, %d failed." % (
+        len(results) - failed, time.time() - start, failed)
+    if failed:
+        sys.exit(1)
+
+
+def read_patch(args, filename):
+    try:
+        with open(filename) as f:
+            if os.path.splitext(filename)[1] in ('.yaml', '.yml'):
+                if yaml is None:
+                    args.parser.error(
+                        "PyYAML must be installed to read YAML files.")
+                patch = yaml.safe_load(f)
+            else:
+                patch = json.load(f)
+    except (IOError, ValueError), e:
+        args.parser.error("Unable to read %s: %s" % (filename, e))
+    if not isinstance(patch, dict) or not all(
+            isinstance(values, dict) for values in patch.values()):
+        args.parser.error("%s must map site names to mappings of setting "
+                          "paths to values." % filename)
+    return patch
+
+
+def site_changes(args, sites, patch):
+    """
+    Returns a mapping of site names to the `(path, value)` changes to make to
+    each site's settings, in order of path.  Changes for all sites are
+    overridden by changes for a particular site.
+    """
+    everywhere = patch.get(ALL_SITES, {})
+    names = set(name for name in patch if name != ALL_SITES)
+    for name in sorted(names):
+        get_site(args, name)
+    if everywhere:
+        names.update(sites.sites.keys())
+    changes = {}
+    for name in names:
+        values = dict(everywhere)
+        values.update(patch.get(name, {}))
+        changes[name] = sorted(values.items())
+    return changes
+
+
+def validate_changes(schema, values):
+    """
+    Checks each of the `(path, value)` changes against the node of `schema`
+    at `path`.  Returns a list of error messages.
+    """
+    errors = []
+    for path, value in values:
+        node = schema
+        try:
+            for name in path.split('.'):
+                if isinstance(node.typ, colander.Sequence):
+                    int(name)
+                    node = node.children[0]
+                else:
+                    node = node[name]
+        except (KeyError, ValueError):
+            errors.append('%s: No such setting' % path)
+            continue
+        try:
+            node.deserialize(value)
+        except colander.Invalid, e:
+            errors.append('%s: %s' % (path, '; '.join(
+                message for key, message in sorted(e.asdict().items()))))
+    return errors
+
+
+def check_site_changes(site, values):
+    """
+    Makes the `(path, value)` changes to the site's current settings, as
+    `apply_site_changes` would, but doesn't commit them.  Returns a list of
+    error messages.
+    """
+    schema = site.application.settings_schema()
+    errors = validate_changes(schema, values)
+    if errors:
+        return errors
+
+    home, closer = open_site_home(site)
+    try:
+        serial = schema.serialize(home['settings'])
+        for path, value in values:
+            try:
+                schema.set_value(serial, path, value)
+            except (IndexError, KeyError, TypeError), e:
+                errors.append('%s: Unable to set (%s: %s)' % (
+                    path, type(e).__name__, e))
+        if not errors:
+            try:
+                schema.deserialize(serial)
+            except colander.Invalid, e:
+                errors.extend('%s: %s' % (key, message)
+                              for key, message in sorted(e.asdict().items()))
+    finally:
+        transaction.abort()
+        closer()
+    return errors
+
+
+def apply_changes(sites, changes, jobs):
+    """
+    Makes each site's changes in a transaction, using a pool of at most
+    `jobs` threads, closing each site once it has been changed.  Returns a
+    list of `(name, diff, error)` tuples, in order of site name, where `diff`
+    is a list of `(path, old, new)` tuples of the settings which were changed
+    and `error` describes the exception which stopped the site being changed,
+    or is `None`.
+    """
+    queue = Queue.Queue()
+    for name in sorted(changes):
+        queue.put(name)
+
+    results = {}
+    def worker():
+        while True:
+            try:
+                name = queue.get_nowait()
+            except Queue.Empty:
+                return
+            site = sites.get(name)
+            try:
+                diff = apply_site_changes(site, changes[name])
+                results[name] = (name, diff, None)
+            except Exception, e:
+                results[name] = (name, None, '%s: %s' % (type(e).__name__, e))
+            finally:
+                site.close()
+
+    workers = [threading.Thread(target=worker)
+               for i in xrange(min(jobs, len(changes)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return [results[name] for name in sorted(changes)]
+
+
+def apply_site_changes(site, values, tries=3):
+    schema = site.application.settings_schema()
+    app = site.site()
+    while True:
+        root, closer = get_root(app)
+        home = root.__home__
+        try:
+            old = home['settings']
+            serial = schema.serialize(old)
+            for path, value in values:
+                schema.set_value(serial, path, value)
+            home['settings'] = new = schema.deserialize(serial)
+            transaction.commit()
+        except retryable:
+            transaction.abort()
+            if not tries:
+                raise
+            tries -= 1
+            continue
+        except:
+            transaction.abort()
+            raise
+        finally:
+            closer()
+
+        diff = []
+        for path, value in values:
+            before = schema.get_value(old, path)
+            after = schema.get_value(new, path)
+            if before != after:
+                diff.append((path, before, after))
+        return diff
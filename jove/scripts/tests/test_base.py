@@ -10,8 +10,17 @@ class TestBase(unittest2.TestCase):
         import cStringIO
         import os
         import tempfile
+        from jove import entrypoints
 
         self.tmp = tmp = tempfile.mkdtemp('.jove-tests')
+
+        # Keep the entry points manifest out of the user's cache
+        patcher = mock.patch.dict(os.environ, {
+            'JOVE_ENTRY_POINTS': os.path.join(tmp, 'entry_points.json')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        entrypoints.clear()
+        self.addCleanup(entrypoints.clear)
         self.etc = etc = os.path.join(tmp, 'etc')
         os.mkdir(etc)
         var = os.path.join(tmp, 'var')
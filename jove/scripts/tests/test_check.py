@@ -0,0 +1,60 @@
+import mock
+
+from jove.scripts.tests.test_base import TestBase
+
+
+class TestCheck(TestBase):
+    # Integration test
+
+    def test_all_sites(self):
+        self.call_script('check')
+        lines = self.output.splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertRegexpMatches(lines[0], r'^test: \d+\.\d{3}s$')
+        self.assertRegexpMatches(
+            lines[1], r'^Checked 1 sites in \d+\.\d{3}s, 0 failed, 0 skipped\.$')
+
+    def test_named_site(self):
+        self.call_script('check', '-t', '2', 'test')
+        self.assertRegexpMatches(self.output, r'^test: \d+\.\d{3}s\n')
+
+    def test_bad_site(self):
+        self.call_script('check', 'nosuchsite')
+        self.assertEqual(self.error, 'No such site: nosuchsite')
+
+    @mock.patch('jove.scripts.check.sys.exit')
+    def test_failure(self, exit):
+        with mock.patch(
+            'jove.tests.test_functional.TestApplication.make_pipeline',
+            mock.Mock(side_effect=ValueError('broken'))):
+            self.call_script('check')
+        lines = self.output.splitlines()
+        self.assertRegexpMatches(
+            lines[0], r'^test: FAILED after \d+\.\d{3}s '
+            r'\(ValueError: broken\)$')
+        self.assertRegexpMatches(
+            lines[1], r'^Checked 0 sites in \d+\.\d{3}s, 1 failed, 0 skipped\.$')
+        exit.assert_called_once_with(1)
+
+
+class TestCheckLocked(TestBase):
+    # Integration test
+    zodb_uri = 'file://%(here)s/../var/test.fs'
+
+    @mock.patch('jove.scripts.check.sys.exit')
+    def test_locked_storage(self, exit):
+        import os
+        from ZODB.FileStorage import FileStorage
+        # Storage held open by a server
+        storage = FileStorage(os.path.join(self.tmp, 'var', 'test.fs'))
+        try:
+            self.call_script('check')
+        finally:
+            storage.close()
+        lines = self.output.splitlines()
+        self.assertTrue(lines[0].startswith(
+            'test: SKIPPED, storage is locked by another process ('))
+        self.assertRegexpMatches(
+            lines[1], r'^Checked 0 sites in \d+\.\d{3}s, 0 failed, '
+            r'1 skipped\.$')
+        self.assertFalse(exit.called)
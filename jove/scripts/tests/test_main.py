@@ -1,6 +1,8 @@
 import unittest2
 import mock
 
+from jove.scripts.tests.test_base import TestBase
+
 
 def mock_abspath(path):
     if path.startswith('/'):
@@ -105,7 +107,7 @@ class TestDebug(unittest2.TestCase):
 
 class TestMain(unittest2.TestCase):
 
-    @mock.patch('jove.scripts.main.pkg_resources.iter_entry_points')
+    @mock.patch('jove.scripts.main.iter_entry_points')
     def test_duplicate_entry_points(self, iter_eps):
         from jove.scripts.main import main
         iter_eps.return_value = [
@@ -114,12 +116,96 @@ class TestMain(unittest2.TestCase):
             main()
 
 
+class Test_find_command(unittest2.TestCase):
+
+    def callFUT(self, *argv):
+        from jove.scripts.main import find_command
+        return find_command(argv)
+
+    def test_it(self):
+        self.assertEqual(self.callFUT('settings', 'list', 'foo'), 'settings')
+        self.assertEqual(self.callFUT('--pdb', '--retries', '3', 'evolve',
+                                      'foo'), 'evolve')
+        self.assertEqual(self.callFUT('--retries=3', 'debug'), 'debug')
+        self.assertIsNone(self.callFUT('--help'))
+        self.assertIsNone(self.callFUT('--retries'))
+
+
+class Test_service_scripts(unittest2.TestCase):
+
+    def callFUT(self):
+        from jove.scripts.main import service_scripts
+        return service_scripts()
+
+    @mock.patch('jove.scripts.main.iter_entry_points')
+    def test_declared_by_factories(self, iter_eps):
+        from jove.interfaces import LocalService
+        one, two, three = mock.Mock(), mock.Mock(), mock.Mock()
+        class Service(LocalService):
+            def __init__(self, descriptor):
+                raise AssertionError("Services shouldn't be created")
+            @classmethod
+            def scripts(cls):
+                return [('foo', one), ('bar', two)]
+        class Other(Service):
+            @classmethod
+            def scripts(cls):
+                return [('foo', two), ('baz', three)]
+        class Unbound(object):
+            def scripts(self):
+                raise AssertionError("Unbound scripts shouldn't be called")
+        iter_eps.return_value = [
+            DummyEntryPoint('service', Service),
+            DummyEntryPoint('other', Other),
+            DummyEntryPoint('unbound', Unbound),
+            DummyEntryPoint('function', lambda descriptor: None)]
+        self.assertEqual(self.callFUT(), [
+            ('bar', two), ('baz', three), ('foo', one)])
+        self.assertEqual(iter_eps.call_args, (('jove.local_service',), {}))
+
+
+class TestLazyStartup(TestBase):
+
+    @mock.patch('jove.scripts.main.service_scripts')
+    def test_script_command(self, service_scripts):
+        self.call_script('check', 'test')
+        self.assertFalse(service_scripts.called)
+        self.assertIn('Checked 1 sites', self.output)
+
+    def test_service_command(self):
+        self.call_script('evolve', 'test', 'status')
+        self.assertIn('Package jove.services.tests.fixtures.one',
+                      self.output)
+
+    @mock.patch('jove.scripts.main.load_app')
+    @mock.patch('jove.scripts.main.LOCAL_SERVICE_ENTRYPOINT', 'nosuchgroup')
+    def test_service_command_declared(self, load_app):
+        # Only the declarations of installed services are used to build the
+        # parser, not the app's sites
+        from jove.entrypoints import GROUPS
+        with mock.patch('jove.entrypoints.GROUPS', GROUPS + ('nosuchgroup',)):
+            self.call_script('evolve', 'test', 'status')
+        self.assertIn("invalid choice: 'evolve'", self.error)
+        self.assertFalse(load_app.called)
+
+    @mock.patch('jove.scripts.serve.main')
+    @mock.patch('jove.scripts.main.load_app')
+    def test_command_loads_app(self, load_app, serve):
+        self.call_script('serve')
+        self.assertTrue(serve.called)
+        self.assertFalse(load_app.called)
+        self.assertIsNone(serve.call_args[0][0].app)
+
+
 class DummyEntryPoint(object):
 
-    def __init__(self, name):
+    def __init__(self, name, obj=None):
         self.name = name
+        self.obj = obj
 
     def load(self):
+        if self.obj is not None:
+            return self.obj
         return self
 
     def __call__(self, name, subparsers):
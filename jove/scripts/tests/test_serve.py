@@ -1,5 +1,7 @@
+import contextlib
 import mock
 from jove.scripts.tests.test_base import TestBase
+from jove.scripts.tests.test_base import jove_ini
 
 
 class ServeTests(TestBase):
@@ -19,3 +21,245 @@ class ServeTests(TestBase):
                          os.path.join(self.etc, 'jove.ini'))
         self.assertEqual(serve.call_count, 1)
         self.assertEqual(serve.call_args, (('jove serve',), {}))
+
+
+class ServeWorkersTests(TestBase):
+    # Integration test
+
+    def setUp(self):
+        super(ServeWorkersTests, self).setUp()
+        with open(self.ini_path, 'a') as out:
+            out.write(pipeline_ini)
+
+    @contextlib.contextmanager
+    def serve(self, *args):
+        import os
+        import signal
+        import subprocess
+        import sys
+        script = 'from jove.scripts.main import main; main()'
+        process = subprocess.Popen(
+            [sys.executable, '-c', script, '-C', self.ini_path, 'serve',
+             '--port', '0'] + list(args),
+            stderr=subprocess.PIPE)
+        self.process = process
+        try:
+            line = process.stderr.readline()
+            self.assertIn('Serving on', line)
+            yield line.split()[-4]
+        finally:
+            os.kill(process.pid, signal.SIGTERM)
+            process.stderr.read()
+            process.wait()
+        self.assertEqual(process.returncode, 0)
+
+    def test_it(self):
+        import urllib2
+        with self.serve('--workers', '2', '--max-requests', '2') as url:
+            # Enough requests for every worker to be recycled
+            for i in xrange(6):
+                response = urllib2.urlopen(url + '/test/')
+                self.assertEqual(response.read(), 'Test Application')
+                self.assertEqual(response.info()['X-Filtered'], '1')
+
+    def test_shard(self):
+        import os
+        import urllib
+        import urllib2
+        with open(os.path.join(self.etc, 'sites.ini'), 'w') as out:
+            for name in ('one', 'two', 'three'):
+                out.write('[site:%s]\n'
+                          'application = jove#test_app\n'
+                          'zodbconn.uri = memory://\n' % name)
+        with self.serve('--workers', '2', '--shard') as url:
+            # Each worker has its own in memory databases, so edits are only
+            # seen again if every request for a site goes to the same worker.
+            for i in xrange(3):
+                for name in ('one', 'two', 'three'):
+                    body = '%s %d' % (name, i)
+                    response = urllib2.urlopen(
+                        '%s/%s/edit' % (url, name),
+                        urllib.urlencode({'body': body}))
+                    self.assertEqual(response.read(), body)
+                    # Forwarded requests only go through the pipeline once
+                    self.assertEqual(response.info()['X-Filtered'], '1')
+
+    def test_reload(self):
+        import os
+        import signal
+        import time
+        import urllib2
+        with self.serve('--workers', '2') as url:
+            with open(os.path.join(self.etc, 'sites.ini'), 'a') as out:
+                out.write('[site:other]\n'
+                          'application = jove#test_app\n'
+                          'zodbconn.uri = memory://\n')
+            os.kill(self.process.pid, signal.SIGHUP)
+            # Every worker serves the new site once it has reloaded
+            served = 0
+            for i in xrange(100):
+                try:
+                    urllib2.urlopen(url + '/other/').read()
+                    served += 1
+                except urllib2.HTTPError:
+                    served = 0
+                if served == 10:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(served, 10)
+
+    def test_bad_workers(self):
+        self.call_script('serve', '--workers', '0')
+        self.assertEqual(self.error, 'Number of workers must be at least 1.')
+
+    def test_bad_pipeline(self):
+        with open(self.ini_path, 'w') as out:
+            out.write(jove_ini)
+        self.call_script('serve', '--workers', '1')
+        self.assertIn("No section 'main'", self.error)
+        with open(self.ini_path, 'a') as out:
+            out.write(pipeline_ini.replace('header jove', 'header other'))
+            out.write('[app:other]\n'
+                      'use = call:jove.scripts.tests.test_serve:'
+                      'other_app\n')
+        self.call_script('serve', '--workers', '1')
+        self.assertEqual(self.error, "The main pipeline of %s must end with "
+                         "the Jove application." % self.ini_path)
+
+    def test_max_requests(self):
+        from jove.scripts.serve import listen
+        from jove.scripts.serve import WorkerServer
+        listener = listen('127.0.0.1', 0)
+        try:
+            server = WorkerServer(None, listener, max_requests=2)
+            server.request_started()
+            self.assertTrue(server.running)
+            server.request_started()
+            self.assertFalse(server.running)
+            server.serve()
+        finally:
+            listener.close()
+
+    def test_thread_pool(self):
+        import socket
+        import threading
+        from jove.scripts.serve import listen
+        from jove.scripts.serve import WorkerServer
+        listener = listen('127.0.0.1', 0)
+        clients = []
+        try:
+            before = threading.active_count()
+            server = WorkerServer(None, listener, nworkers=2)
+            for i in xrange(5):
+                clients.append(socket.create_connection(
+                    listener.getsockname()))
+                server._handle_request_noblock()
+            # Connections wait for a thread from the pool
+            self.assertEqual(threading.active_count() - before, 2)
+            self.assertEqual(server.pending, 5)
+            for client in clients:
+                client.close()
+            server.running = False
+            server.serve()
+            self.assertEqual(server.pending, 0)
+        finally:
+            listener.close()
+
+    def test_address_from_config(self):
+        import argparse
+        from jove.scripts.serve import get_address
+        from jove.scripts.serve import get_server_conf
+        with open(self.ini_path, 'a') as out:
+            out.write('[server:main]\n'
+                      'use = egg:Paste#http\n'
+                      'host = 0.0.0.0\n'
+                      'port = 6543\n')
+        args = argparse.Namespace(config=self.ini_path, host=None, port=None)
+        conf = get_server_conf(args)
+        self.assertEqual(get_address(args, conf), ('0.0.0.0', 6543))
+        args.port = 8000
+        self.assertEqual(get_address(args, conf), ('0.0.0.0', 8000))
+
+    def test_default_address(self):
+        import argparse
+        from jove.scripts.serve import get_address
+        from jove.scripts.serve import get_server_conf
+        args = argparse.Namespace(config=self.ini_path, host=None, port=None)
+        conf = get_server_conf(args)
+        self.assertEqual(conf, {})
+        self.assertEqual(get_address(args, conf), ('127.0.0.1', 8080))
+
+    def test_server_options(self):
+        import argparse
+        from jove.scripts.serve import get_server_conf
+        from jove.scripts.serve import get_server_options
+        with open(self.ini_path, 'a') as out:
+            out.write('[server:main]\n'
+                      'use = egg:Paste#http\n'
+                      'threadpool_workers = 4\n'
+                      'threadpool_spawn_if_under = 2\n'
+                      'socket_timeout = 30\n')
+        args = argparse.Namespace(config=self.ini_path)
+        self.assertEqual(get_server_options(get_server_conf(args)), {
+            'nworkers': 4,
+            'daemon': False,
+            'threadpool_options': {'spawn_if_under': 2},
+            'socket_timeout': 30})
+        self.assertEqual(get_server_options({}), {
+            'nworkers': 10,
+            'daemon': False,
+            'threadpool_options': {},
+            'socket_timeout': None})
+
+    def test_unsupported_server_options(self):
+        with open(self.ini_path, 'a') as out:
+            out.write('[server:main]\n'
+                      'use = egg:Paste#http\n'
+                      'ssl_pem = *\n'
+                      'use_threadpool = false\n')
+        self.call_script('serve', '--workers', '1')
+        self.assertEqual(self.error, "Server options not supported with "
+                         "workers: ssl_pem, use_threadpool = false")
+
+    def test_unsupported_server(self):
+        with open(self.ini_path, 'a') as out:
+            out.write('[server:main]\n'
+                      'use = call:jove.scripts.tests.test_serve:other_server\n')
+        self.call_script('serve', '--workers', '1')
+        self.assertEqual(self.error, "Workers can only be used with the "
+                         "Paste HTTP server, egg:Paste#http.")
+
+
+pipeline_ini = """\
+[filter:header]
+use = call:jove.scripts.tests.test_serve:header_filter
+
+[pipeline:main]
+pipeline = header jove
+"""
+
+
+def header_filter(global_conf):
+    def header_filter(app):
+        def filtered(environ, start_response):
+            def start(status, headers, exc_info=None):
+                count = sum(1 for name, value in headers
+                            if name == 'X-Filtered')
+                headers = [(name, value) for name, value in headers
+                           if name != 'X-Filtered']
+                headers.append(('X-Filtered', str(count + 1)))
+                return start_response(status, headers, exc_info)
+            return app(environ, start)
+        return filtered
+    return header_filter
+
+
+def other_server(global_conf, **options):
+    raise AssertionError("Server shouldn't be run")
+
+
+def other_app(global_conf):
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['Not Jove']
+    return app
@@ -21,6 +21,24 @@ class TestSettings(TestBase):
             'things: []\n'
         )
 
+    def test_set_with_registry(self):
+        # Application code run by the script sees the site's registry
+        from pyramid.threadlocal import get_current_registry
+        import transaction
+        registries = []
+        def commit(real=transaction.commit):
+            registries.append(get_current_registry())
+            real()
+        with mock.patch('jove.scripts.settings.transaction.commit', commit):
+            self.call_script('settings', 'set', 'test', 'foo', '5')
+        self.assertEqual(registries[0].foo, 'Foo')
+
+    @mock.patch('jove.site.LazySite.site')
+    def test_list_without_pyramid(self, site):
+        self.call_script('settings', 'list', 'test')
+        self.assertEqual(self.output, 'foo: 3\nthings: []\n')
+        self.assertFalse(site.called)
+
     def test_set_invalid(self):
         self.call_script('settings', 'set', 'test', 'foo', 'five')
         self.assertEqual(self.out.getvalue(),'')
@@ -96,3 +114,170 @@ class TestSettings(TestBase):
                 "foo: 3\n"
                 "things: [u'dog']\n"
             )
+
+
+class TestApplySettings(TestBase):
+    zodb_uri = 'file://%(here)s/../var/test.fs'
+
+    def setUp(self):
+        import os
+        super(TestApplySettings, self).setUp()
+        with open(os.path.join(self.etc, 'sites.ini'), 'a') as out:
+            out.write(other_site_ini)
+
+    def write_patch(self, patch, filename='patch.json'):
+        import json
+        import os
+        path = os.path.join(self.tmp, filename)
+        with open(path, 'w') as out:
+            json.dump(patch, out)
+        return path
+
+    def test_apply(self):
+        path = self.write_patch({
+            'test': {'foo': 5, 'things': ['cat', 'dog']},
+            'other': {'foo': 3}})
+        self.call_script('settings', 'apply', path)
+        lines = self.output.splitlines()
+        self.assertEqual(lines[:5], [
+            "other:",
+            "  no changes",
+            "test:",
+            "  foo: 3 -> 5",
+            "  things: [] -> [u'cat', u'dog']"])
+        self.assertTrue(lines[5].startswith("Applied settings to 2 sites in "))
+        self.assertTrue(lines[5].endswith(", 0 failed."))
+
+        self.call_script('settings', 'list', 'test')
+        self.assertEqual(self.output,
+            "foo: 5\n"
+            "things: [u'cat', u'dog']\n")
+
+    def test_apply_all_sites(self):
+        path = self.write_patch({
+            '*': {'foo': 7},
+            'other': {'foo': 8, 'things.0': 'cat'}})
+        with mock.patch(
+            'jove.tests.test_functional.TestApplication.initial_settings',
+            mock.Mock(return_value={'things': ['dog']})):
+            self.call_script('settings', 'apply', '--jobs', '1', path)
+        self.assertEqual(self.output.splitlines()[:5], [
+            "other:",
+            "  foo: 3 -> 8",
+            "  things.0: u'dog' -> u'cat'",
+            "test:",
+            "  foo: 3 -> 7"])
+
+    def test_apply_invalid(self):
+        path = self.write_patch({
+            'test': {'foo': 'five', 'things': ['foobar'], 'bar': 1},
+            'other': {'things.x': 'cat'}})
+        self.call_script('settings', 'apply', path)
+        self.assertEqual(self.error,
+            "other: things.x: No such setting\n"
+            "test: bar: No such setting\n"
+            "test: foo: \"five\" is not a number\n"
+            "test: things: Invalid value")
+        self.assertEqual(self.output, '')
+
+        # Nothing was changed
+        self.call_script('settings', 'list', 'test')
+        self.assertEqual(self.output,
+            "foo: 3\n"
+            "things: []\n")
+
+    def test_apply_closes_sites(self):
+        from jove.site import LazySite
+        path = self.write_patch({'*': {'foo': 5}})
+        spin_up = LazySite.site
+        opened = set()
+        most_open = []
+        def spinning(site):
+            opened.add(site)
+            most_open.append(sum(1 for other in opened
+                                 if other._site is not None))
+            return spin_up(site)
+        with mock.patch.object(LazySite, 'site', spinning):
+            self.call_script('settings', 'apply', '--jobs', '1', path)
+        # Each site is closed before the next one is opened
+        self.assertEqual(len(most_open), 4)
+        self.assertEqual(max(most_open), 0)
+
+    def test_apply_with_registry(self):
+        from pyramid.threadlocal import get_current_registry
+        path = self.write_patch({'test': {'foo': 5}})
+        import transaction
+        registries = []
+        def commit(real=transaction.commit):
+            registries.append(get_current_registry())
+            real()
+        with mock.patch('jove.scripts.settings.transaction.commit', commit):
+            self.call_script('settings', 'apply', path)
+        self.assertEqual(registries[0].foo, 'Foo')
+
+    def test_apply_bad_file(self):
+        path = self.write_patch(['foo'])
+        self.call_script('settings', 'apply', path)
+        self.assertEqual(self.error, "%s must map site names to mappings of "
+                         "setting paths to values." % path)
+        self.call_script('settings', 'apply', path + '.missing')
+        self.assertTrue(self.error.startswith("Unable to read "))
+        path = self.write_patch({'nosuchsite': {'foo': 1}})
+        self.call_script('settings', 'apply', path)
+        self.assertEqual(self.error, "No such site: nosuchsite")
+        path = self.write_patch({'*': {'foo': 7}, 'nosuchsite': {'foo': 9}})
+        self.call_script('settings', 'apply', path)
+        self.assertEqual(self.error, "No such site: nosuchsite")
+        self.call_script('settings', 'list', 'test')
+        self.assertEqual(self.output.splitlines()[0], "foo: 3")
+
+    def test_apply_yaml(self):
+        import os
+        path = os.path.join(self.tmp, 'patch.yaml')
+        with open(path, 'w') as out:
+            out.write("test:\n  foo: 5\n")
+        yaml = mock.Mock()
+        yaml.safe_load.return_value = {'test': {'foo': 5}}
+        with mock.patch('jove.scripts.settings.yaml', yaml):
+            self.call_script('settings', 'apply', path)
+        self.assertEqual(self.output.splitlines()[:2], [
+            "test:",
+            "  foo: 3 -> 5"])
+        with mock.patch('jove.scripts.settings.yaml', None):
+            self.call_script('settings', 'apply', path)
+        self.assertEqual(self.error,
+                         "PyYAML must be installed to read YAML files.")
+
+    def test_apply_failed(self):
+        path = self.write_patch({
+            'test': {'things.3': 'cat'},
+            'other': {'foo': 5}})
+        self.call_script('settings', 'apply', path)
+        self.assertEqual(self.error,
+            "test: things.3: Unable to set (IndexError: list assignment "
+            "index out of range)")
+        self.assertEqual(self.output, '')
+
+        # No site was changed
+        self.call_script('settings', 'list', 'other')
+        self.assertEqual(self.output,
+            "foo: 3\n"
+            "things: []\n")
+
+    def test_apply_site_failed(self):
+        path = self.write_patch({'test': {'foo': 5}})
+        with mock.patch('jove.scripts.settings.apply_site_changes',
+                        side_effect=ValueError('boom')):
+            with self.assertRaises(SystemExit):
+                self.call_script('settings', 'apply', path)
+        lines = self.output.splitlines()
+        self.assertEqual(lines[0], "test: FAILED (ValueError: boom)")
+        self.assertTrue(lines[1].endswith(", 1 failed."))
+
+
+other_site_ini = """\
+
+[site:other]
+application = jove#test_app
+zodbconn.uri = file://%(here)s/../var/other.fs
+"""
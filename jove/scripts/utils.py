@@ -39,9 +39,28 @@ def get_site_root(args, name):
 
 
 def get_site_home(args, name):
-    root, closer = get_site_root(args, name)
+    return open_site_home(get_site(args, name))
+
+
+def open_site_home(site):
+    """
+    Spins up `site` and returns a tuple of `(home, closer)`, with the site's
+    registry pushed until `closer` is called, for scripts which run
+    application code.
+    """
+    root, closer = get_root(site.site())
     return root.__home__, closer
 
+
+def read_site_home(args, name):
+    """
+    Returns a tuple of `(home, closer)` for a site without configuring its
+    Pyramid application, for read only scripts which don't run any
+    application code.
+    """
+    return get_site(args, name).open_home()
+
+
 def retry(n, retryable=retryable):
     def decorator(f):
         def wrapper(args):
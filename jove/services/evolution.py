@@ -1,23 +1,60 @@
+import logging
+import multiprocessing
+import Queue
+import sys
+import threading
+import time
+
+from cStringIO import StringIO
+
+from BTrees.LLBTree import LLTreeSet
 from persistent.mapping import PersistentMapping
 
 from pyramid.util import DottedNameResolver
+from ZODB import DB
+from ZODB.DemoStorage import DemoStorage
+from ZODB.MappingStorage import MappingStorage
+from ZODB.serialize import referencesf
+from ZODB.utils import get_pickle_metadata
+from ZODB.utils import u64
+
+try:
+    from zodbpickle.fastpickle import Unpickler
+except ImportError: #pragma NO COVERAGE
+    from zodbpickle.pickle import Unpickler
 
 from jove.interfaces import LocalService
 from jove.scripts.utils import get_site
 from jove.scripts.utils import get_site_home
+from jove.scripts.utils import read_site_home
+from jove.scripts.utils import retryable
 
 import transaction
 
 
+log = logging.getLogger(__name__)
+
 HOME_KEY = 'jove.services.evolution'
 
+# Key, in the versions mapping, of the progress of each package's evolve step
+# in progress
+PROGRESS_KEY = '__progress__'
+
+# Number of times an evolve step is resumed after a conflict
+RETRIES = 3
+
+# Package, progress report, and dry run if there is one, of the evolve step
+# running in this thread
+_step = threading.local()
+
 
 class EvolutionService(LocalService):
 
     def __init__(self, pkgname):
         self.pkgname = pkgname
 
-    def scripts(self):
+    @classmethod
+    def scripts(cls):
         return [('evolve', config_parser)]
 
     def __call__(self, home):
@@ -51,18 +88,479 @@ class Evolution(object):
     def evolution_required(self):
         return self.database_version() < self.software_version()
 
-    def evolve(self):
-        pkgname = self.pkgname
-        resolve = self.resolver.resolve
+    def progress(self):
+        """
+        Returns the progress of this package's evolve step which is in
+        progress, or was interrupted, or `None`.
+        """
+        return self.versions.get(PROGRESS_KEY, {}).get(self.pkgname)
+
+    def resumable(self):
+        """
+        Returns whether the evolve step which is in progress can be run again
+        without repeating work which has been committed: either it hasn't
+        committed anything yet, or `batch` recorded a cursor for it to
+        continue from.
+        """
+        progress = self.progress()
+        return (progress is None or not progress['count'] or
+                progress['cursor'] is not None)
+
+    def evolve(self, report=None, retries=RETRIES, dry_run=False,
+               sample=None):
+        """
+        Runs the evolve steps between the database and software versions.  A
+        step which was interrupted, and which checkpointed its progress with
+        `batch`, continues from its last checkpoint.  A step which conflicts
+        is retried if it can continue from its checkpoint, or if it hasn't
+        committed anything yet.  `report`, if given, is called with the
+        number of objects processed and the rate, in objects per second, as
+        each batch is finished.
+
+        If `dry_run` is true, the steps are run against a demo storage, so
+        nothing is committed to the site's database, and a list of `Estimate`s of the cost of each step is returned.  If
+        `sample` is given, steps which use `batch` only process that many
+        items from each batch, and the full cost is extrapolated from them.
+        """
+        if dry_run:
+            return self._dry_run(report, sample)
+
         home = self.home
-        target = self.software_version()
-        for version in xrange(self.database_version() + 1, target + 1):
-            module_name = '%s.evolve%d' % (pkgname, version)
-            module = resolve(module_name)
-            evolve = getattr(module, 'evolve')
-            evolve(home)
-            self.versions[self.pkgname] = version
+        for version in xrange(self.database_version() + 1,
+                              self.software_version() + 1):
+            evolve = self.step(version)
+            tries = retries
+            while True:
+                self.start_step(version)
+                _step.pkgname = self.pkgname
+                _step.report = report
+                try:
+                    evolve(home)
+                    self.finish_step(version)
+                    transaction.commit()
+                    break
+                except retryable:
+                    transaction.abort()
+                    if not tries or not self.resumable():
+                        raise
+                    tries -= 1
+                finally:
+                    _step.pkgname = _step.report = None
+
+    def _dry_run(self, report, sample):
+        # The steps commit to a demo storage layered over the site's, so
+        # later steps see the changes made by earlier ones, as they would in a
+        # real run, and the records committed can be measured.
+        changes = MeasuringStorage()
+        db = DB(DemoStorage(base=self.home._p_jar.db().storage,
+                            changes=changes, close_base_on_close=False))
+        conn = db.open()
+        home = conn.get(self.home._p_oid)
+        evolution = Evolution(self.pkgname, home)
+        estimates = []
+        try:
+            for version in xrange(self.database_version() + 1,
+                                  self.software_version() + 1):
+                evolve = self.step(version)
+                changes.sizes.clear()
+                evolution.start_step(version)
+                _step.pkgname = self.pkgname
+                _step.report = report
+                _step.dry_run = dry_run = DryRun(sample)
+                start = time.time()
+                evolve(home)
+                evolution.finish_step(version)
+                transaction.commit()
+                elapsed = time.time() - start
+                estimates.append(Estimate(
+                    version, elapsed, len(changes.sizes),
+                    sum(changes.sizes.values()), dry_run.scale()))
+        finally:
+            _step.pkgname = _step.report = _step.dry_run = None
+            transaction.abort()
+            conn.close()
+            db.close()
+        return estimates
+
+    def step(self, version):
+        """
+        Returns the `evolve` function of the step to `version`.
+        """
+        module = self.resolver.resolve('%s.evolve%d' % (self.pkgname, version))
+        return getattr(module, 'evolve')
+
+    def start_step(self, version):
+        progress = self.progress()
+        if progress is None or progress['version'] != version:
+            if PROGRESS_KEY not in self.versions:
+                self.versions[PROGRESS_KEY] = PersistentMapping()
+            self.versions[PROGRESS_KEY][self.pkgname] = PersistentMapping(
+                version=version, count=0, cursor=None)
+
+    def finish_step(self, version):
+        self.clear_progress()
+        self.versions[self.pkgname] = version
+
+    def clear_progress(self):
+        progress = self.versions.get(PROGRESS_KEY)
+        if progress is not None and self.pkgname in progress:
+            del progress[self.pkgname]
+            if not progress:
+                del self.versions[PROGRESS_KEY]
+
+
+class DryRun(object):
+    """
+    Keeps track of the items processed by `batch` during a dry run.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self.processed = 0
+        self.total = 0
+        self.truncated = False
+
+    def sample(self, items):
+        """
+        Generates at most `size` of `items`, counting the items processed
+        and, if it can be found without iterating, the total number of
+        items.
+        """
+        try:
+            total = len(items)
+        except TypeError:
+            total = None
+        if total is None or self.total is None:
+            self.total = None
+        else:
+            self.total += total
+
+        for item in items:
+            if self.size is not None and self.processed >= self.size:
+                self.truncated = True
+                return
+            yield item
+            self.processed += 1
+
+    def scale(self):
+        """
+        Returns the ratio of the total number of items to the number
+        processed, or `None` if items were left out of the run and their
+        total is unknown.
+        """
+        if not self.truncated:
+            return 1.0
+        if not self.total or not self.processed:
+            return None
+        return float(self.total) / self.processed
+
+
+class Estimate(object):
+    """
+    The cost of an evolve step, measured by a dry run.  `seconds`, `objects`
+    and `bytes` are what was measured, the objects changed and the bytes
+    they take up when saved, and `scale` is the factor by which the full run
+    is expected to be bigger, or `None` if it is unknown.
+    """
+
+    def __init__(self, version, seconds, objects, bytes, scale=1.0):
+        self.version = version
+        self.seconds = seconds
+        self.objects = objects
+        self.bytes = bytes
+        self.scale = scale
+
+    def extrapolate(self, value):
+        if self.scale is not None:
+            return value * self.scale
+
+
+class MeasuringStorage(MappingStorage):
+    """
+    Keeps the changes made in a dry run, and records the size of the last
+    record stored for each object since `sizes` was last cleared.  Earlier
+    records of an object stored more than once are left out, as they are
+    superseded by the last.
+    """
+
+    def __init__(self):
+        MappingStorage.__init__(self)
+        self.sizes = {}
+
+    def store(self, oid, serial, data, version, transaction):
+        self.sizes[oid] = len(data)
+        return MappingStorage.store(
+            self, oid, serial, data, version, transaction)
+
+
+def batch(home, items, size=1000, savepoint=False, key=None):
+    """
+    Iterates over `items`, for use by evolve steps which change more objects
+    than fit comfortably in a single transaction.  After every `size` items,
+    the work done so far is committed, or, if `savepoint` is true, saved to a
+    savepoint, and the database cache is minimized, so memory use stays flat
+    however many objects are changed.  The number of items processed is
+    recorded in the progress of the evolve step, in the versions mapping.
+
+    If `key` is given, it is called with the last item of each batch and
+    the result is recorded as the step's cursor, which `checkpoint` returns
+    if the step is interrupted and run again.
+
+    Items are counted once the caller moves on to the next item, so the
+    caller should have finished with an item before asking for another.
+    """
+    progress = step_progress(home)
+    report = getattr(_step, 'report', None)
+    dry_run = getattr(_step, 'dry_run', None)
+    if dry_run is not None:
+        # A dry run may only take a sample
+        items = dry_run.sample(items)
+    jar = home._p_jar
+    start = time.time()
+    count = 0
+    for item in items:
+        yield item
+        count += 1
+        if count % size == 0:
+            if progress is not None:
+                progress['count'] += size
+                if key is not None:
+                    progress['cursor'] = key(item)
+            if savepoint:
+                transaction.savepoint(True)
+            else:
+                transaction.commit()
+            jar.cacheMinimize()
+            if report is not None:
+                report(progress['count'] if progress is not None else count,
+                       count / max(time.time() - start, 1e-6))
+    if progress is not None:
+        progress['count'] += count % size
+        if key is not None and count % size:
+            progress['cursor'] = key(item)
+
+
+def checkpoint(home):
+    """
+    Returns the cursor last recorded by `batch` for the evolve step which is
+    running, or `None` if the step is starting from the beginning.
+    """
+    progress = step_progress(home)
+    if progress is not None:
+        return progress.get('cursor')
+
+
+def step_progress(home):
+    """
+    Returns the progress of the evolve step running in this thread, or `None`
+    if `batch` is used outside of an evolve step.
+    """
+    pkgname = getattr(_step, 'pkgname', None)
+    if pkgname is not None:
+        return home[HOME_KEY].get(PROGRESS_KEY, {}).get(pkgname)
+
+
+class Migratable(object):
+    """
+    Mixin for persistent classes whose instances are upgraded when they are
+    loaded, rather than by an offline evolve step.  Upgrade hooks are methods
+    decorated with `upgrade`, which are run, in order of version, for each
+    version an object is behind.  An upgraded object is marked as changed
+    when its transaction is committed, so the upgrade is saved by whatever
+    transaction happens to load it.  Objects which aren't loaded by traffic
+    can be upgraded with `sweep`.  Mix in before `Persistent`::
+
+        class Document(Migratable, Persistent):
+
+            @upgrade(1)
+            def add_title(self):
+                self.title = u''
+
+    New objects are stamped with the latest version when they are first
+    saved, and objects saved before the class had upgrade hooks are at
+    version 0.
+    """
+
+    def __getstate__(self):
+        state = super(Migratable, self).__getstate__()
+        if '_migration_version' not in state:
+            state = dict(state)
+            state['_migration_version'] = latest_upgrade(type(self))
+        return state
+
+    def __setstate__(self, state):
+        super(Migratable, self).__setstate__(state)
+        if migrate(self) and self._p_jar is not None:
+            # Changes made while an object is loaded aren't registered with
+            # its connection, so it is marked as changed just before commit.
+            self._v_migrated = True
+            txn = self._p_jar.transaction_manager.get()
+            txn.addBeforeCommitHook(mark_changed, (self,))
+
+
+def upgrade(version):
+    """
+    Decorator for a method of a `Migratable` class which upgrades an instance
+    from the previous version to `version`.
+    """
+    def decorator(method):
+        method.upgrade_version = version
+        return method
+    return decorator
+
+
+_upgrades = {}
+
+
+def upgrades(cls):
+    """
+    Returns the upgrade hooks of a `Migratable` class, as a sorted list of
+    `(version, method)` tuples.
+    """
+    hooks = _upgrades.get(cls)
+    if hooks is None:
+        hooks = []
+        for name in dir(cls):
+            version = getattr(getattr(cls, name), 'upgrade_version', None)
+            if version is not None:
+                hooks.append((version, name))
+        _upgrades[cls] = hooks = sorted(hooks)
+    return hooks
+
+
+def latest_upgrade(cls):
+    hooks = upgrades(cls)
+    if hooks:
+        return hooks[-1][0]
+    return 0
+
+
+def migrate(obj):
+    """
+    Runs the upgrade hooks for the versions `obj` is behind.  Returns whether
+    it was upgraded.
+    """
+    version = obj.__dict__.get('_migration_version', 0)
+    hooks = [(hook_version, name) for hook_version, name
+             in upgrades(type(obj)) if hook_version > version]
+    if not hooks:
+        return False
+    for version, name in hooks:
+        getattr(obj, name)()
+    obj._migration_version = version
+    return True
+
+
+def mark_changed(obj):
+    obj._p_changed = True
+
+
+def sweep(home, size=1000, delay=0.0, report=None, retries=RETRIES):
+    """
+    Upgrades the `Migratable` objects reachable from `home` which haven't
+    yet been upgraded by being loaded, so a database converges on the latest
+    versions while its site is serving traffic.  Objects are upgraded in
+    batches of `size`, each committed in its own transaction and retried on
+    conflicts, sleeping for `delay` seconds between batches, so the sweep
+    doesn't compete too hard with traffic.  `report`, if given, is called
+    with the number of objects swept and the rate, in objects per second,
+    after each batch.  Returns the number of objects swept and the number
+    upgraded.
+
+    Each record is read from the storage once, to find the objects it refers
+    to and whether it is behind.  Only objects which are behind are loaded
+    into the connection, to be upgraded.
+    """
+    jar = home._p_jar
+    db = jar.db()
+    storage = db.storage
+    seen = LLTreeSet()
+    seen.insert(u64(home._p_oid))
+    stack = [home._p_oid]
+    behind = []
+    swept = upgraded = 0
+    start = time.time()
+    while stack:
+        oid = stack.pop()
+        data, serial = storage.load(oid)
+        for ref in referencesf(data):
+            if seen.insert(u64(ref)):
+                stack.append(ref)
+        if upgrade_required(db, data):
+            behind.append(oid)
+        swept += 1
+        if swept % size and stack:
+            continue
+
+        if behind:
+            upgraded += sweep_batch(jar, behind, retries)
+            behind = []
+        if report is not None:
+            report(swept, swept / max(time.time() - start, 1e-6))
+        if delay and stack:
+            time.sleep(delay)
+    return swept, upgraded
+
+
+def upgrade_required(db, data):
+    """
+    Returns whether the database record, `data`, is of a `Migratable` object
+    which is behind the latest version of its class, without loading the
+    object.  Objects which the record refers to aren't loaded either.
+    """
+    module, name = get_pickle_metadata(data)
+    try:
+        cls = db.classFactory(None, str(module), str(name))
+    except Exception:
+        return False
+    if not isinstance(cls, type) or not issubclass(cls, Migratable):
+        return False
+    latest = latest_upgrade(cls)
+    if not latest:
+        return False
+    unpickler = Unpickler(StringIO(data))
+    unpickler.find_global = lambda module, name: db.classFactory(
+        None, module, name)
+    unpickler.persistent_load = lambda ref: None
+    try:
+        unpickler.noload()
+        state = unpickler.load()
+    except Exception:
+        # Leave it to loading the object to find out
+        return True
+    if isinstance(state, tuple):
+        state = state[0]
+    return (state or {}).get('_migration_version', 0) < latest
+
+
+def sweep_batch(jar, oids, retries):
+    tries = retries
+    while True:
+        upgraded = 0
+        try:
+            for oid in oids:
+                obj = jar.get(oid)
+                obj._p_activate()
+                if obj.__dict__.pop('_v_migrated', False):
+                    upgraded += 1
             transaction.commit()
+            jar.cacheMinimize()
+            return upgraded
+        except retryable:
+            # Objects upgraded in the aborted transaction must be loaded
+            # again to be upgraded again.
+            transaction.abort()
+            jar.cacheMinimize()
+            if not tries:
+                raise
+            tries -= 1
+
+
+def packages(versions):
+    """
+    Returns the names of the packages in the versions mapping.
+    """
+    return [key for key in versions.keys() if key != PROGRESS_KEY]
 
 
 #
@@ -76,7 +574,13 @@ def config_parser(name, subparsers):
     """
     parser = subparsers.add_parser(
         name, help='Evolve a site database.')
-    parser.add_argument('site', help='Site to evolve.')
+    parser.add_argument('site', nargs='?', help='Site to evolve.')
+    parser.add_argument('--all-sites', action='store_true', default=False,
+        help='Evolve every site. Only the latest command may be used with '
+        'all sites.')
+    parser.add_argument('-j', '--jobs', type=int, metavar='NUMBER', default=1,
+        help='Number of sites to evolve at once, in separate processes, with '
+        '--all-sites. Defaults to 1.')
     subparsers = parser.add_subparsers(
         title='command', help='Evolution commands.')
     config_init(subparsers)
@@ -86,6 +590,7 @@ def config_parser(name, subparsers):
     config_required(subparsers)
     config_set_version(subparsers)
     config_latest(subparsers)
+    config_sweep(subparsers)
 
 
 def config_init(subparsers):
@@ -138,9 +643,28 @@ def config_latest(subparsers):
     parser.add_argument('-p', '--package', metavar='NAME', action='append',
         help='Package to update. May be specified more than once. By default '
         'all configured packages are updated.')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+        help='Run the evolve steps without committing them, and estimate '
+        'how long they take and how much they write.')
+    parser.add_argument('--sample', type=int, metavar='NUMBER', default=None,
+        help='With --dry-run, only process this many items from each batch '
+        'of an evolve step, extrapolating the cost of the full step.')
     parser.set_defaults(func=latest, parser=parser)
 
 
+def config_sweep(subparsers):
+    parser = subparsers.add_parser(
+        'sweep', help='Upgrade migratable objects which have not been '
+        'upgraded by being loaded.')
+    parser.add_argument('-b', '--batch-size', type=int, metavar='NUMBER',
+        default=1000, help='Number of objects to upgrade in each transaction. '
+        'Defaults to 1000.')
+    parser.add_argument('-d', '--delay', type=float, metavar='SECONDS',
+        default=0.0, help='Time to sleep between batches, to limit the load '
+        'on a site which is serving traffic. Defaults to no delay.')
+    parser.set_defaults(func=sweep_site, parser=parser)
+
+
 def get_services(args):
     site = get_site(args, args.site)
     services = []
@@ -150,7 +674,16 @@ def get_services(args):
     return services
 
 
+def check_site(args):
+    if args.all_sites:
+        args.parser.error("Only the latest command may be used with "
+                          "--all-sites.")
+    if args.site is None:
+        args.parser.error("Must specify a site, or --all-sites.")
+
+
 def init(args):
+    check_site(args)
     home, closer = get_site_home(args, args.site)
     if HOME_KEY in home:
         args.parser.error("Evolution is already initialized.")
@@ -160,8 +693,12 @@ def init(args):
     transaction.commit()
 
 
-def get_versions(args):
-    home, closer = get_site_home(args, args.site)
+def get_versions(args, read_only=False):
+    check_site(args)
+    if read_only:
+        home, closer = read_site_home(args, args.site)
+    else:
+        home, closer = get_site_home(args, args.site)
     versions = home.get(HOME_KEY)
     if not versions:
         args.parser.error("Evolution is not initialized.")
@@ -169,8 +706,8 @@ def get_versions(args):
 
 
 def status(args):
-    home, versions, closer = get_versions(args)
-    for pkgname in sorted(versions.keys()):
+    home, versions, closer = get_versions(args, read_only=True)
+    for pkgname in sorted(packages(versions)):
         print_status(args, Evolution(pkgname, home))
 
 
@@ -186,11 +723,15 @@ def print_status(args, evolution):
         print >> args.out, "Evolution required"
     else:
         print >> args.out, "WARNING: Database is ahead of software"
+    progress = evolution.progress()
+    if progress is not None:
+        print >> args.out, "Evolution to version %d interrupted after %d " \
+            "objects" % (progress['version'], progress['count'])
     print >> args.out, ''
 
 
 def db_version(args):
-    home, versions, closer = get_versions(args)
+    home, versions, closer = get_versions(args, read_only=True)
     pkgname = get_pkgname(args)
     if not pkgname in versions:
         args.parser.error(
@@ -200,7 +741,7 @@ def db_version(args):
 
 
 def sw_version(args):
-    home, versions, closer = get_versions(args)
+    home, versions, closer = get_versions(args, read_only=True)
     pkgname = get_pkgname(args)
     if not pkgname in versions:
         args.parser.error(
@@ -211,8 +752,8 @@ def sw_version(args):
 
 def required(args):
     required = False
-    home, versions, closer = get_versions(args)
-    for pkgname in versions.keys():
+    home, versions, closer = get_versions(args, read_only=True)
+    for pkgname in packages(versions):
         evolution = Evolution(pkgname, home)
         if evolution.evolution_required():
             required = True
@@ -240,15 +781,24 @@ def set_version(args):
             "Package %s is not configured for evolution or is not initialized."
              % pkgname)
     versions[pkgname] = args.version
+    Evolution(pkgname, home).clear_progress()
     print_status(args, Evolution(pkgname, home))
     transaction.commit()
 
 
 def latest(args):
+    if args.all_sites:
+        if args.site is not None:
+            args.parser.error("Can't specify a site with --all-sites.")
+        if args.dry_run:
+            args.parser.error("Can't dry run --all-sites.")
+        latest_all_sites(args)
+        return
+
     home, versions, closer = get_versions(args)
     pkgnames = args.package
     if not pkgnames:
-        pkgnames = versions.keys()
+        pkgnames = packages(versions)
     for pkgname in sorted(pkgnames):
         if pkgname not in versions:
             args.parser.error(
@@ -256,10 +806,218 @@ def latest(args):
                 "or is not initialized." % pkgname)
         evolution = Evolution(pkgname, home)
         print_status(args, evolution)
-        if evolution.evolution_required():
+        if evolution.evolution_required() and args.dry_run:
+            print >> args.out, "Dry run of %s . . ." % pkgname
+            estimates = evolution.evolve(report=report_progress(args),
+                                         dry_run=True, sample=args.sample)
+            print_estimates(args, estimates)
+        elif evolution.evolution_required():
             print >> args.out, "Evolving %s . . ." % pkgname
-            evolution.evolve()
+            evolution.evolve(report=report_progress(args))
             print >> args.out, "%s successfully evolved." % pkgname
             print >> args.out, ''
 
-    transaction.commit()
+    if args.dry_run:
+        transaction.abort()
+    else:
+        transaction.commit()
+
+
+def print_estimates(args, estimates):
+    totals = [0, 0, 0]
+    for estimate in estimates:
+        measured = (estimate.seconds, estimate.objects, estimate.bytes)
+        line = "Version %d: %d objects, %d bytes in %0.3fs" % (
+            estimate.version, estimate.objects, estimate.bytes,
+            estimate.seconds)
+        if estimate.scale is None:
+            print >> args.out, "%s, sampled; total unknown" % line
+            totals = None
+            continue
+        if estimate.scale != 1.0:
+            line += ", sampled; estimated %d objects, %d bytes in %0.3fs" % (
+                estimate.extrapolate(estimate.objects),
+                estimate.extrapolate(estimate.bytes),
+                estimate.extrapolate(estimate.seconds))
+        print >> args.out, line
+        if totals is not None:
+            for i, value in enumerate(measured):
+                totals[i] += estimate.extrapolate(value)
+    if totals is not None:
+        seconds, objects, bytes = totals
+        print >> args.out, "Estimated %d objects, %d bytes in %0.3fs." % (
+            objects, bytes, seconds)
+    print >> args.out, ''
+
+
+def latest_all_sites(args):
+    """
+    Evolves every site to the latest versions, evolving `args.jobs` sites at
+    once, each in its own process.  Progress is reported as each site's evolve
+    steps run, followed by a summary of how long each site took and which
+    sites failed.  A site whose process exits without reporting a result is
+    counted as failed.
+    """
+    if args.jobs < 1:
+        args.parser.error("Number of jobs must be at least 1.")
+    sites = args.app.registry.sites
+    pending = sorted(sites.sites)
+
+    # Database connections can't be shared with child processes
+    sites.close()
+
+    start = time.time()
+    events = multiprocessing.Queue()
+    running = {}
+    results = {}
+    try:
+        while pending or running:
+            while pending and len(running) < args.jobs:
+                name = pending.pop(0)
+                process = multiprocessing.Process(
+                    target=run_worker, args=(args, name, events))
+                process.start()
+                running[name] = (process, time.time())
+
+            try:
+                kind, event = events.get(timeout=0.5)
+                handle_event(args, results, kind, event)
+            except Queue.Empty:
+                pass
+
+            for name, (process, started) in running.items():
+                if name not in results and not process.is_alive():
+                    # Anything the process sent before exiting is already in
+                    # the queue.
+                    drain_events(args, results, events)
+                    if name not in results:
+                        handle_event(args, results, 'done', (
+                            name, time.time() - started, [],
+                            'worker exited with code %s' % process.exitcode))
+                if name in results:
+                    process.join()
+                    del running[name]
+    finally:
+        for process, started in running.values():
+            process.terminate()
+
+    print >> args.out, ''
+    print >> args.out, "Summary:"
+    failed = 0
+    for name, elapsed, evolved, error in sorted(results.values()):
+        if error is None:
+            print >> args.out, "%s: %0.3fs" % (name, elapsed)
+        else:
+            failed += 1
+            print >> args.out, "%s: FAILED after %0.3fs (%s)" % (
+                name, elapsed, error)
+    print >> args.out, "Evolved %d sites in %0.3fs, %d failed." % (
+        len(results) - failed, time.time() - start, failed)
+    if failed:
+        sys.exit(1)
+
+
+def drain_events(args, results, events):
+    while True:
+        try:
+            kind, event = events.get_nowait()
+        except Queue.Empty:
+            return
+        handle_event(args, results, kind, event)
+
+
+def handle_event(args, results, kind, event):
+    if kind == 'progress':
+        name, pkgname, count, rate = event
+        print >> args.out, "%s: %s: %d objects processed, " \
+            "%.1f objects/s" % (name, pkgname, count, rate)
+    else:
+        name, elapsed, evolved, error = event
+        results[name] = event
+        if error is not None:
+            print >> args.out, "%s: FAILED after %0.3fs (%s)" % (
+                name, elapsed, error)
+        elif evolved:
+            for pkgname, old, new in evolved:
+                print >> args.out, "%s: evolved %s from version " \
+                    "%d to %d" % (name, pkgname, old, new)
+            print >> args.out, "%s: done in %0.3fs" % (name, elapsed)
+        else:
+            print >> args.out, "%s: nothing to do" % name
+    args.out.flush()
+
+
+def run_worker(args, name, events):
+    """
+    Runs in a child process, evolving the site, `name`, and sending its result
+    to the parent.
+    """
+    start = time.time()
+    try:
+        result = evolve_site(args, name, events)
+    except BaseException, e:
+        result = name, time.time() - start, [], '%s: %s' % (
+            type(e).__name__, e)
+    events.put(('done', result))
+    events.close()
+    events.join_thread()
+
+
+def evolve_site(args, name, events):
+    """
+    Evolves the site, `name`, in a worker process.  Returns a tuple of
+    `(name, seconds, evolved, error)`, where `evolved` is a list of `(pkgname,
+    old_version, new_version)` tuples and `error` describes the exception
+    which stopped evolution, or is `None`.
+    """
+    start = time.time()
+    evolved = []
+    site = args.app.registry.sites.get(name)
+    try:
+        home, closer = get_site_home(args, name)
+        try:
+            versions = home.get(HOME_KEY)
+            if versions:
+                for pkgname in sorted(args.package or packages(versions)):
+                    if pkgname not in versions:
+                        continue
+                    evolution = Evolution(pkgname, home)
+                    if not evolution.evolution_required():
+                        continue
+                    def report(count, rate):
+                        events.put(('progress', (name, pkgname, count, rate)))
+                    old = evolution.database_version()
+                    evolution.evolve(report=report)
+                    evolved.append(
+                        (pkgname, old, evolution.database_version()))
+            transaction.commit()
+        finally:
+            transaction.abort()
+            closer()
+    except Exception, e:
+        log.exception("Unable to evolve site %s", name)
+        return name, time.time() - start, evolved, '%s: %s' % (
+            type(e).__name__, e)
+    finally:
+        site.close()
+    return name, time.time() - start, evolved, None
+
+
+def sweep_site(args):
+    check_site(args)
+    if args.batch_size < 1:
+        args.parser.error("Batch size must be at least 1.")
+    home, closer = get_site_home(args, args.site)
+    start = time.time()
+    swept, upgraded = sweep(home, args.batch_size, args.delay,
+                            report=report_progress(args))
+    print >> args.out, "Swept %d objects in %0.3fs, %d upgraded." % (
+        swept, time.time() - start, upgraded)
+
+
+def report_progress(args):
+    def report(count, rate):
+        print >> args.out, "  %d objects processed, %.1f objects/s" % (
+            count, rate)
+        args.out.flush()
+    return report
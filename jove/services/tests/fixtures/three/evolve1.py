@@ -0,0 +1,15 @@
+from jove.services.evolution import batch
+from jove.services.evolution import checkpoint
+
+def evolve(home):
+    numbers = home['numbers']
+    cursor = checkpoint(home)
+    if cursor is None:
+        keys = numbers.keys()
+    else:
+        keys = numbers.keys(cursor, excludemin=True)
+    for key in batch(home, keys, size=10, key=lambda key: key):
+        increment(numbers, key)
+
+def increment(numbers, key):
+    numbers[key] += 1
@@ -130,3 +130,521 @@ class TestEvolution(TestBase):
         self.assertEqual(output,
             "one_five: evolved\n"
             "one_six: evolved\n")
+
+    def test_evolve_all_sites(self):
+        self.call_script('evolve', 'test', 'set_version', '-p',
+                         'jove.services.tests.fixtures.one', '4')
+        self.call_script('evolve', '--all-sites', '--jobs', '2', 'latest')
+        lines = self.output.splitlines()
+        self.assertEqual(lines[:2], [
+            "test: evolved jove.services.tests.fixtures.one from version 4 "
+            "to 6",
+            "test: done in %s" % lines[1].split()[-1]])
+        self.assertEqual(lines[2:4], ["", "Summary:"])
+        self.assertTrue(lines[4].startswith("test: "))
+        self.assertTrue(lines[5].startswith("Evolved 1 sites in "))
+        self.assertTrue(lines[5].endswith(", 0 failed."))
+        self.call_script('debug', 'test', '-S', self.test_script)
+        output = open(self.test_out).read()
+        self.assertEqual(output,
+            "one_five: evolved\n"
+            "one_six: evolved\n")
+
+        self.call_script('evolve', '--all-sites', 'latest')
+        self.assertEqual(self.output.splitlines()[0], "test: nothing to do")
+
+    def test_evolve_all_sites_failed(self):
+        self.call_script('evolve', 'test', 'set_version', '-p',
+                         'jove.services.tests.fixtures.one', '4')
+        with mock.patch('jove.services.tests.fixtures.one.evolve5.evolve',
+                        side_effect=ValueError('boom')):
+            with self.assertRaises(SystemExit):
+                self.call_script('evolve', '--all-sites', 'latest')
+        lines = self.output.splitlines()
+        self.assertTrue(lines[0].startswith("test: FAILED after "))
+        self.assertTrue(lines[0].endswith("s (ValueError: boom)"))
+        self.assertTrue(lines[-1].endswith(", 1 failed."))
+        self.call_script('evolve', 'test', 'db_version', '-p',
+                         'jove.services.tests.fixtures.one')
+        self.assertEqual(self.output, '4\n')
+
+    def test_evolve_all_sites_worker_lost(self):
+        import os
+        self.call_script('evolve', 'test', 'set_version', '-p',
+                         'jove.services.tests.fixtures.one', '4')
+        with mock.patch('jove.services.tests.fixtures.one.evolve5.evolve',
+                        side_effect=lambda root: os._exit(3)):
+            with self.assertRaises(SystemExit):
+                self.call_script('evolve', '--all-sites', 'latest')
+        lines = self.output.splitlines()
+        self.assertTrue(lines[0].startswith("test: FAILED after "))
+        self.assertTrue(lines[0].endswith("s (worker exited with code 3)"))
+        self.assertTrue(lines[-1].endswith(", 1 failed."))
+
+    def test_sweep(self):
+        self.call_script('evolve', 'test', 'sweep', '--batch-size', '2')
+        lines = self.output.splitlines()
+        self.assertEqual(lines[0].split(',')[0], "  2 objects processed")
+        self.assertTrue(lines[-1].startswith("Swept "))
+        self.assertTrue(lines[-1].endswith("s, 0 upgraded."))
+        self.call_script('evolve', 'test', 'sweep', '--batch-size', '0')
+        self.assertEqual(self.error, "Batch size must be at least 1.")
+
+    def test_dry_run(self):
+        self.call_script('evolve', 'test', 'set_version', '-p',
+                         'jove.services.tests.fixtures.one', '4')
+        self.call_script('evolve', 'test', 'latest', '--dry-run')
+        lines = self.output.splitlines()
+        self.assertEqual(lines[5], "Dry run of jove.services.tests.fixtures.one "
+                         ". . .")
+        self.assertTrue(lines[6].startswith("Version 5: 2 objects, "))
+        self.assertTrue(lines[7].startswith("Version 6: 2 objects, "))
+        self.assertTrue(lines[8].startswith("Estimated 4 objects, "))
+        self.call_script('evolve', 'test', 'db_version', '-p',
+                         'jove.services.tests.fixtures.one')
+        self.assertEqual(self.output, '4\n')
+        self.call_script('evolve', '--all-sites', 'latest', '--dry-run')
+        self.assertEqual(self.error, "Can't dry run --all-sites.")
+
+    def test_all_sites_usage(self):
+        self.call_script('evolve', '--all-sites', 'status')
+        self.assertEqual(self.error,
+            "Only the latest command may be used with --all-sites.")
+        self.call_script('evolve', 'status')
+        self.assertEqual(self.error, "Must specify a site, or --all-sites.")
+        self.call_script('evolve', '--all-sites', 'test', 'latest')
+        self.assertEqual(self.error, "Can't specify a site with --all-sites.")
+        self.call_script('evolve', '--all-sites', '--jobs', '0', 'latest')
+        self.assertEqual(self.error, "Number of jobs must be at least 1.")
+
+
+class TestBatch(unittest2.TestCase):
+
+    def setUp(self):
+        from BTrees.OOBTree import OOBTree
+        from persistent.mapping import PersistentMapping
+        from ZODB import DB
+        import transaction
+        from jove.services.evolution import HOME_KEY
+        from jove.services.evolution import PROGRESS_KEY
+        from jove.services.evolution import _step
+        self.db = db = DB(None, cache_size=100)
+        self.conn = conn = db.open()
+        self.home = home = conn.root()
+        home[HOME_KEY] = PersistentMapping()
+        home['content'] = content = OOBTree()
+        for i in xrange(1000):
+            content[i] = PersistentMapping()
+        home[HOME_KEY][PROGRESS_KEY] = PersistentMapping(
+            foo=PersistentMapping(version=1, count=0))
+        transaction.commit()
+        conn.cacheMinimize()
+        _step.pkgname = 'foo'
+
+    def tearDown(self):
+        import transaction
+        from jove.services.evolution import _step
+        _step.pkgname = None
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+
+    def call_fut(self, items, **kw):
+        from jove.services.evolution import batch
+        return batch(self.home, items, **kw)
+
+    def progress(self):
+        from jove.services.evolution import HOME_KEY
+        from jove.services.evolution import PROGRESS_KEY
+        return self.home[HOME_KEY][PROGRESS_KEY]['foo']
+
+    def evolve(self, **kw):
+        sizes = []
+        for obj in self.call_fut(self.home['content'].values(), **kw):
+            obj['evolved'] = True
+            sizes.append(len(self.conn._cache))
+        return sizes
+
+    def test_commits(self):
+        import transaction
+        sizes = self.evolve(size=100)
+        self.assertLess(max(sizes), 300)
+        self.assertEqual(self.progress()['count'], 1000)
+        transaction.abort()
+        self.assertTrue(all(obj.get('evolved')
+                            for obj in self.home['content'].values()))
+        self.assertEqual(self.progress()['count'], 1000)
+
+    def test_savepoints(self):
+        import transaction
+        sizes = self.evolve(size=100, savepoint=True)
+        self.assertLess(max(sizes), 300)
+        self.assertEqual(self.progress()['count'], 1000)
+        transaction.abort()
+        self.assertFalse(any(obj.get('evolved')
+                             for obj in self.home['content'].values()))
+        self.assertEqual(self.progress()['count'], 0)
+
+    def test_partial_batch(self):
+        items = self.call_fut(self.home['content'].values()[:250], size=100)
+        self.assertEqual(len(list(items)), 250)
+        self.assertEqual(self.progress()['count'], 250)
+
+    def test_outside_evolve(self):
+        from jove.services.evolution import _step
+        _step.pkgname = None
+        self.assertEqual(len(list(self.call_fut(range(250), size=100))), 250)
+        self.assertEqual(self.progress()['count'], 0)
+
+
+class TestResume(unittest2.TestCase):
+    pkgname = 'jove.services.tests.fixtures.three'
+
+    def setUp(self):
+        from BTrees.OOBTree import OOBTree
+        from ZODB import DB
+        import transaction
+        self.db = db = DB(None)
+        self.conn = conn = db.open()
+        self.home = home = conn.root()
+        home['numbers'] = OOBTree(dict.fromkeys(range(50), 0))
+        self.evolution = evolution = self.make_one()
+        evolution.versions[self.pkgname] = 0
+        transaction.commit()
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+
+    def make_one(self):
+        from jove.services.evolution import Evolution
+        return Evolution(self.pkgname, self.home)
+
+    def fail_at(self, failing, exc):
+        from jove.services.tests.fixtures.three import evolve1
+        increment = evolve1.increment
+        failed = []
+        def side_effect(numbers, key):
+            if key == failing and not failed:
+                failed.append(key)
+                raise exc
+            increment(numbers, key)
+        return mock.patch.object(evolve1, 'increment', side_effect)
+
+    def without_cursor(self):
+        from jove.services.evolution import batch
+        from jove.services.tests.fixtures.three import evolve1
+        def evolve(home):
+            numbers = home['numbers']
+            for key in batch(home, numbers.keys(), size=10):
+                evolve1.increment(numbers, key)
+        return mock.patch.object(evolve1, 'evolve', evolve)
+
+    def test_resume_after_crash(self):
+        import transaction
+        with self.fail_at(25, KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.evolution.evolve()
+        transaction.abort()
+
+        evolution = self.make_one()
+        progress = evolution.progress()
+        self.assertEqual(progress['version'], 1)
+        self.assertEqual(progress['count'], 20)
+        self.assertEqual(progress['cursor'], 19)
+        self.assertEqual(evolution.database_version(), 0)
+
+        import cStringIO
+        from jove.services.evolution import print_status
+        args = mock.Mock(out=cStringIO.StringIO())
+        print_status(args, evolution)
+        self.assertEqual(args.out.getvalue(),
+            "Package jove.services.tests.fixtures.three\n"
+            "Code at software version 1\n"
+            "Database at version 0\n"
+            "Evolution required\n"
+            "Evolution to version 1 interrupted after 20 objects\n"
+            "\n")
+
+        reports = []
+        evolution.evolve(report=lambda count, rate: reports.append(count))
+        self.assertEqual(reports, [30, 40, 50])
+        self.assertEqual(evolution.database_version(), 1)
+        self.assertEqual(evolution.progress(), None)
+        self.assertEqual(set(self.home['numbers'].values()), set([1]))
+
+    def test_progress_per_package(self):
+        import transaction
+        from jove.services.evolution import Evolution
+        from jove.services.evolution import packages
+        with self.fail_at(25, KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.evolution.evolve()
+        transaction.abort()
+
+        other = Evolution('jove.services.tests.fixtures.one', self.home)
+        other.versions[other.pkgname] = 4
+        other.start_step(5)
+        self.assertEqual(other.progress()['version'], 5)
+        self.assertEqual(self.evolution.progress()['count'], 20)
+        self.assertEqual(sorted(packages(other.versions)), [
+            'jove.services.tests.fixtures.one', self.pkgname])
+        other.finish_step(5)
+        self.assertEqual(other.progress(), None)
+        self.assertEqual(self.evolution.progress()['count'], 20)
+
+    def test_retry_conflict(self):
+        from ZODB.POSException import ConflictError
+        with self.fail_at(25, ConflictError):
+            self.evolution.evolve()
+        self.assertEqual(self.evolution.database_version(), 1)
+        self.assertEqual(set(self.home['numbers'].values()), set([1]))
+
+    def test_retry_before_commit(self):
+        from ZODB.POSException import ConflictError
+        with self.without_cursor():
+            with self.fail_at(5, ConflictError):
+                self.evolution.evolve()
+        self.assertEqual(self.evolution.database_version(), 1)
+        self.assertEqual(set(self.home['numbers'].values()), set([1]))
+
+    def test_no_retry_without_cursor(self):
+        from ZODB.POSException import ConflictError
+        with self.without_cursor():
+            with self.fail_at(25, ConflictError):
+                with self.assertRaises(ConflictError):
+                    self.evolution.evolve()
+        self.assertEqual(self.evolution.database_version(), 0)
+        self.assertEqual(self.evolution.progress()['count'], 20)
+        self.assertEqual(self.evolution.progress()['cursor'], None)
+
+    def test_give_up(self):
+        from ZODB.POSException import ConflictError
+        with self.fail_at(25, ConflictError):
+            with self.assertRaises(ConflictError):
+                self.evolution.evolve(retries=0)
+
+    def test_dry_run(self):
+        estimates = self.evolution.evolve(dry_run=True)
+        self.assertEqual(len(estimates), 1)
+        estimate = estimates[0]
+        self.assertEqual(estimate.version, 1)
+        self.assertEqual(estimate.scale, 1.0)
+        self.assertGreater(estimate.objects, 0)
+        self.assertGreater(estimate.bytes, 0)
+        self.assertEqual(self.evolution.database_version(), 0)
+        self.assertEqual(self.evolution.progress(), None)
+        self.assertEqual(set(self.home['numbers'].values()), set([0]))
+
+    def test_dry_run_commits_nothing(self):
+        import transaction
+        from jove.services.tests.fixtures.three import evolve1
+        def evolve(home):
+            home['numbers'][0] = 1
+            transaction.commit()
+        with mock.patch.object(evolve1, 'evolve', evolve):
+            estimates = self.evolution.evolve(dry_run=True)
+        self.assertEqual(estimates[0].version, 1)
+        self.conn.sync()
+        self.assertEqual(self.home['numbers'][0], 0)
+        self.assertEqual(self.evolution.database_version(), 0)
+        self.assertEqual(self.evolution.progress(), None)
+
+    def test_dry_run_bytes(self):
+        import transaction
+        from jove.services.tests.fixtures.three import evolve1
+        def evolve(commits):
+            def evolve(home):
+                numbers = home['numbers']
+                for i in xrange(commits):
+                    numbers[0] = i
+                    transaction.commit()
+                numbers[0] = 1
+            return evolve
+        estimates = []
+        for commits in (1, 10):
+            with mock.patch.object(evolve1, 'evolve', evolve(commits)):
+                estimates.extend(self.evolution.evolve(dry_run=True))
+        self.assertEqual(estimates[0].objects, estimates[1].objects)
+        self.assertEqual(estimates[0].bytes, estimates[1].bytes)
+
+    def test_dry_run_sample(self):
+        reports = []
+        estimates = self.evolution.evolve(
+            report=lambda count, rate: reports.append(count), dry_run=True,
+            sample=5)
+        estimate = estimates[0]
+        self.assertEqual(estimate.scale, 10.0)
+        self.assertEqual(estimate.extrapolate(2), 20.0)
+        self.assertEqual(reports, [])
+        self.assertEqual(self.evolution.database_version(), 0)
+        self.assertEqual(set(self.home['numbers'].values()), set([0]))
+
+    def test_dry_run_sample_unknown_total(self):
+        from jove.services.evolution import DryRun
+        dry_run = DryRun(5)
+        self.assertEqual(list(dry_run.sample(iter(range(50)))), range(5))
+        self.assertEqual(dry_run.scale(), None)
+        dry_run = DryRun(5)
+        self.assertEqual(list(dry_run.sample(iter(range(5)))), range(5))
+        self.assertEqual(dry_run.scale(), 1.0)
+
+    def test_report_rate(self):
+        reports = []
+        self.evolution.evolve(
+            report=lambda count, rate: reports.append((count, rate)))
+        self.assertEqual([count for count, rate in reports],
+                         [10, 20, 30, 40, 50])
+        self.assertTrue(all(rate > 0 for count, rate in reports))
+
+
+from persistent import Persistent
+from jove.services.evolution import Migratable
+from jove.services.evolution import upgrade
+
+
+class Document(Migratable, Persistent):
+
+    def __init__(self, name):
+        self.name = name
+
+    @upgrade(2)
+    def add_tags(self):
+        self.tags = (self.title.lower(),)
+
+    @upgrade(1)
+    def add_title(self):
+        self.title = self.name.title()
+
+
+class TestMigratable(unittest2.TestCase):
+
+    def setUp(self):
+        from BTrees.OOBTree import OOBTree
+        from ZODB import DB
+        import transaction
+        self.db = db = DB(None)
+        self.conn = conn = db.open()
+        self.home = home = conn.root()
+        home['docs'] = docs = OOBTree()
+        for i in xrange(50):
+            docs[i] = doc = Document('doc %d' % i)
+        transaction.commit()
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        self.conn.close()
+        self.db.close()
+
+    def make_old(self):
+        import transaction
+        for doc in self.home['docs'].values():
+            doc._migration_version = 0
+        transaction.commit()
+        self.conn.cacheMinimize()
+
+    def reopen(self):
+        import transaction
+        transaction.abort()
+        self.conn.close()
+        self.conn = self.db.open()
+        self.conn.cacheMinimize()
+        self.home = self.conn.root()
+
+    def test_new_objects_at_latest_version(self):
+        self.reopen()
+        doc = self.home['docs'][0]
+        self.assertEqual(doc._migration_version, 2)
+        self.assertFalse(hasattr(doc, 'title'))
+
+    def test_upgrade_on_load(self):
+        import transaction
+        self.make_old()
+        doc = self.home['docs'][3]
+        self.assertEqual(doc.title, 'Doc 3')
+        self.assertEqual(doc.tags, ('doc 3',))
+        self.assertEqual(doc._migration_version, 2)
+        self.assertFalse(doc._p_changed)
+        transaction.commit()
+
+        self.reopen()
+        doc = self.home['docs'][3]
+        self.assertEqual(doc.__dict__.get('_v_migrated'), None)
+        self.assertEqual(doc.title, 'Doc 3')
+        self.assertEqual(doc._migration_version, 2)
+        self.assertTrue(self.home['docs'][4]._v_migrated)
+
+    def test_upgrade_not_saved_on_abort(self):
+        import transaction
+        self.make_old()
+        self.assertEqual(self.home['docs'][3].title, 'Doc 3')
+        self.reopen()
+        doc = self.home['docs'][3]
+        doc._p_activate()
+        self.assertTrue(doc._v_migrated)
+
+    def test_sweep(self):
+        from jove.services.evolution import sweep
+        self.make_old()
+        self.assertEqual(self.home['docs'][3].title, 'Doc 3')
+        reports = []
+        swept, upgraded = sweep(
+            self.home, size=10,
+            report=lambda count, rate: reports.append(count))
+        self.assertEqual(upgraded, 49)
+        self.assertEqual(swept, reports[-1])
+        self.assertEqual(reports[:2], [10, 20])
+
+        self.reopen()
+        for i, doc in self.home['docs'].items():
+            doc._p_activate()
+            self.assertFalse(hasattr(doc, '_v_migrated'))
+            self.assertEqual(doc.title, 'Doc %d' % i)
+
+        swept, upgraded = sweep(self.home, size=10)
+        self.assertEqual(upgraded, 0)
+
+    def test_sweep_only_loads_objects_behind(self):
+        import transaction
+        from jove.services.evolution import sweep
+        self.make_old()
+        docs = self.home['docs']
+        docs[3]._migration_version = 2
+        transaction.commit()
+        self.reopen()
+        loaded = []
+        setstate = Document.__setstate__
+        def loading(doc, state):
+            loaded.append(state['name'])
+            setstate(doc, state)
+        with mock.patch.object(Document, '__setstate__', loading):
+            swept, upgraded = sweep(self.home, size=10)
+            self.assertEqual(upgraded, 49)
+            self.assertEqual(len(loaded), 49)
+            self.assertNotIn('doc 3', loaded)
+
+            self.reopen()
+            del loaded[:]
+            swept, upgraded = sweep(self.home, size=10)
+            self.assertEqual(upgraded, 0)
+            self.assertEqual(loaded, [])
+
+    def test_sweep_retries_conflicts(self):
+        from ZODB.POSException import ConflictError
+        import transaction
+        from jove.services.evolution import sweep
+        self.make_old()
+        commit = transaction.commit
+        conflicts = [ConflictError]
+        def side_effect():
+            if conflicts:
+                transaction.get().note(u'conflict')
+                raise conflicts.pop()
+            commit()
+        with mock.patch('jove.services.evolution.transaction.commit',
+                        side_effect=side_effect):
+            swept, upgraded = sweep(self.home, size=10)
+        self.assertEqual(upgraded, 50)
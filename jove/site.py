@@ -1,34 +1,79 @@
 import ConfigParser
+import collections
+import logging
 import os
-import pkg_resources
+import Queue
+import threading
+import time
 import transaction
+import zlib
 
 from persistent.mapping import PersistentMapping
 from pyramid.config import Configurator
 from pyramid.decorator import reify
 from pyramid.request import Request
 from pyramid_zodbconn import get_connection
-from repoze.retry import Retry
 from zodburi import resolve_uri
+from ZODB.ActivityMonitor import ActivityMonitor
 from ZODB.DB import DB
 
+from jove import entrypoints
+from jove.metrics import SiteMetrics
+from jove.retry import ConflictLog
+from jove.retry import Retry
+from jove.retry import RetryBudget
 from jove.utils import asbool
+from jove.utils import ClosingIterator
 
 APPLICATION_ENTRYPOINT = 'jove.application'
 LOCAL_SERVICE_ENTRYPOINT = 'jove.local_service'
 
+# Site settings which are passed to the site's ZODB database
+DB_OPTIONS = {
+    'zodb.pool_size': 'pool_size',
+    'zodb.pool_timeout': 'pool_timeout',
+    'zodb.cache_size': 'cache_size',
+    'zodb.cache_size_bytes': 'cache_size_bytes',
+}
+
+log = logging.getLogger(__name__)
+
 
 class Sites(object):
     root_site = None
+    evictions = 0
+
+    # Set when sites are sharded between processes
+    shard_index = None
+    shard_addresses = None
+
+    # Minimum number of seconds between checks of total cache size
+    cache_check_interval = 1.0
+    _cache_checked = 0
 
     def __init__(self, settings):
         self.settings = settings
+        self.max_active_sites = int(settings.get('jove.max_active_sites', 0))
+        self.max_cache_bytes = int(settings.get('jove.max_cache_bytes', 0))
+        self.shard_timeout = float(
+            settings.get('jove.shard_timeout', 30)) or None
+        self.active = collections.OrderedDict()
+        self._lru_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.sites = {}
+        self._configure(self.read_config())
+
+    def read_config(self):
+        """
+        Reads the sites config file.  Returns a dictionary mapping the names
+        of the configured sites to their settings.
+        """
+        settings = self.settings
         ini_file = settings['sites_config']
         here = os.path.dirname(os.path.abspath(ini_file))
         config = ConfigParser.ConfigParser({'here': here})
         config.read(ini_file)
-        sites = {}
-        virtual_hosts = {}
+        configured = {}
         for site_section in config.sections():
             if not site_section.startswith('site:'):
                 continue
@@ -40,88 +85,488 @@ class Sites(object):
                     continue
                 for option in config.options(section):
                     site_settings[option] = config.get(section, option) % subs
-            sites[name] = LazySite(name, site_settings)
+            configured[name] = site_settings
+        return configured
+
+    def _configure(self, configured):
+        """
+        Builds the sites for the configuration, `configured`, as returned by
+        `read_config`, reusing any existing site whose settings are unchanged,
+        and swaps them in.  Returns the sites which are no longer used.
+        """
+        old_sites = self.sites
+        sites = {}
+        virtual_hosts = {}
+        root_site = None
+        for name, site_settings in configured.items():
+            site = old_sites.get(name)
+            if site is None or site.settings != site_settings:
+                site = LazySite(name, site_settings)
+            sites[name] = site
             virtual_host = site_settings.get('virtual_host')
             if virtual_host:
                 for host in virtual_host.split():
                     host = host.strip()
                     virtual_hosts[host] = name
             if asbool(site_settings.get('root', 'false')):
-                self.root_site = name
+                root_site = name
 
+        index = DispatchIndex(sites, virtual_hosts, root_site)
         self.sites = sites
         self.virtual_hosts = virtual_hosts
+        self.root_site = root_site
+        self.index = index
+        return [site for name, site in old_sites.items()
+                if sites.get(name) is not site]
+
+    def reload(self):
+        """
+        Reads the sites config file again and applies any changes.  Sites
+        which have been added are created and sites whose settings have
+        changed are replaced, while unchanged sites are kept as they are,
+        with their pipelines and database connections.  Sites which have been
+        removed or replaced are closed once their requests in flight have
+        finished.  Returns a tuple of the sorted names of the sites which
+        were `(added, changed, removed)`.
+        """
+        with self._reload_lock:
+            configured = self.read_config()
+            old_sites = self.sites
+            retired = self._configure(configured)
+
+        with self._lru_lock:
+            for site in retired:
+                if self.active.get(site.name) is site:
+                    del self.active[site.name]
+        for site in retired:
+            site.retire()
+
+        added = sorted(set(self.sites) - set(old_sites))
+        removed = sorted(set(old_sites) - set(self.sites))
+        changed = sorted(site.name for site in retired
+                         if site.name in self.sites)
+        log.info("Reloaded sites config, added: %s, changed: %s, "
+                 "removed: %s", ', '.join(added) or 'none',
+                 ', '.join(changed) or 'none', ', '.join(removed) or 'none')
+        return added, changed, removed
 
     def get(self, name):
         return self.sites.get(name)
 
     def get_virtual_host(self, host):
-        return self.virtual_hosts.get(host)
+        return self.index.get_virtual_host(host)
+
+    def lookup(self, host, path):
+        return self.index.lookup(host, path)
+
+    def touch(self, site):
+        """
+        Marks `site` as most recently used and, if the configured limit on
+        the number of active sites or on their total cache size is exceeded,
+        closes least recently used idle sites.  An evicted site is spun up
+        again by its next request.  Only sites served by this process are
+        touched, not sites whose requests are forwarded to their owners.
+        """
+        if not (self.max_active_sites or self.max_cache_bytes):
+            return
+
+        # Victims are chosen while holding the lock, but closed after it is
+        # released, so closing a site doesn't hold up other requests.
+        victims = []
+        with self._lru_lock:
+            active = self.active
+            name = site.name
+            if name in active:
+                del active[name]
+                active[name] = site
+                if not self.max_cache_bytes:
+                    return
+                now = time.time()
+                if now - self._cache_checked < self.cache_check_interval:
+                    return
+            else:
+                active[name] = site
+                now = time.time()
+
+            max_active_sites = self.max_active_sites
+            if max_active_sites:
+                excess = len(active) - max_active_sites
+                for victim in active.values():
+                    if excess <= 0:
+                        break
+                    if victim is not site and victim.idle():
+                        del active[victim.name]
+                        victims.append(victim)
+                        excess -= 1
+
+            max_cache_bytes = self.max_cache_bytes
+            if max_cache_bytes:
+                self._cache_checked = now
+                sizes = [(victim, victim.cache_bytes())
+                         for victim in active.values()]
+                excess = sum(size for victim, size in sizes) - max_cache_bytes
+                for victim, size in sizes:
+                    if excess <= 0:
+                        break
+                    if victim is not site and victim.idle():
+                        del active[victim.name]
+                        victims.append(victim)
+                        excess -= size
+
+        for victim in victims:
+            self._evict(victim)
+
+    def _evict(self, site):
+        if site.evict():
+            with self._lru_lock:
+                self.evictions += 1
+            log.info("Evicted idle site %s", site.name)
+            return
+
+        # The site became busy after it was chosen, so it is kept, unless it
+        # has since been removed by reloading the sites config.
+        with self._lru_lock:
+            if self.sites.get(site.name) is site:
+                self.active.setdefault(site.name, site)
+
+    def set_shard(self, index, addresses):
+        """
+        Restricts this process to serving one shard of the sites, where
+        `addresses` is a sequence of the `(host, port)` addresses of the
+        processes serving each shard and `index` is the position of this
+        process's shard in the sequence.  Sites are assigned to shards by a
+        stable hash of their names, so every process agrees on which process
+        owns a site.
+        """
+        self.shard_index = index
+        self.shard_addresses = addresses
+
+    def owner(self, site):
+        """
+        Returns the `(host, port)` address of the process which owns `site`,
+        or `None` if the site is owned by this process or sites are not
+        sharded.
+        """
+        addresses = self.shard_addresses
+        if addresses is None:
+            return None
+        shard = shard_for(site.name, len(addresses))
+        if shard == self.shard_index:
+            return None
+        return addresses[shard]
+
+    def owned(self):
+        """
+        Returns the sorted names of the sites owned by this process.
+        """
+        return sorted(name for name, site in self.sites.items()
+                      if self.owner(site) is None)
+
+    def warmup(self, names=None, threads=4):
+        """
+        Spins up the pipelines of the named sites, or of all sites owned by
+        this process if `names` is `None`, ahead of traffic, using a pool of
+        at most `threads` threads.  A site which fails to spin up does not
+        stop the others from being warmed up.  Returns a sequence of `(name,
+        seconds, error)` tuples, in the order of `names`, where `error` is the
+        exception raised while spinning up the site or `None` on success.
+        """
+        if names is None:
+            names = self.owned()
+        queue = Queue.Queue()
+        for name in names:
+            queue.put(name)
+
+        results = {}
+        def worker():
+            while True:
+                try:
+                    name = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                start = time.time()
+                error = None
+                site = self.sites[name]
+                try:
+                    site.pipeline()
+                except Exception, error:
+                    log.exception("Unable to warm up site %s", name)
+                else:
+                    self.touch(site)
+                results[name] = (name, time.time() - start, error)
+
+        workers = [threading.Thread(target=worker)
+                   for i in xrange(min(threads, len(names)))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        return [results[name] for name in names]
+
+    def stats(self):
+        """
+        Returns a dictionary mapping site names to the statistics returned by
+        `LazySite.stats`.
+        """
+        return dict((name, site.stats()) for name, site in self.sites.items())
 
     def close(self):
         for site in self.sites.values():
             site.close()
 
 
+class DispatchIndex(object):
+    """
+    Immutable index used to find the site for a request, built once at
+    startup.  Hosts are normalized (port stripped, case folded) and
+    virtual hosts of the form `*.example.com` match any subdomain of
+    `example.com`.  Lookup cost depends only on the number of labels in the
+    requested host name, not on the number of configured sites.
+    """
+
+    def __init__(self, sites, virtual_hosts, root_site=None):
+        hosts = {}
+        wildcards = {}
+        for host, name in virtual_hosts.items():
+            host = normalize_host(host)
+            if host.startswith('*.'):
+                wildcards[host[2:]] = name
+            else:
+                hosts[host] = name
+        self.hosts = hosts
+        self.wildcards = wildcards
+        self.prefixes = dict(sites)
+        self.root = sites.get(root_site) if root_site is not None else None
+
+    def get_virtual_host(self, host):
+        """
+        Returns the name of the site configured for `host` or `None`.
+        """
+        if not host:
+            return None
+        host = normalize_host(host)
+        name = self.hosts.get(host)
+        if name is not None:
+            return name
+        wildcards = self.wildcards
+        if wildcards:
+            dot = host.find('.')
+            while dot != -1:
+                name = wildcards.get(host[dot + 1:])
+                if name is not None:
+                    return name
+                dot = host.find('.', dot + 1)
+        return None
+
+    def lookup(self, host, path):
+        """
+        Finds the site for a request to `host` with the path segments,
+        `path`.  Returns a tuple of `(site, prefix)` where `prefix` is the
+        leading path segment consumed to select the site, or `None` if the
+        site was selected by virtual host or is the root site.  Returns
+        `(None, None)` if no site matches.
+        """
+        name = self.get_virtual_host(host)
+        if name is not None:
+            return self.prefixes[name], None
+        if path:
+            site = self.prefixes.get(path[0])
+            if site is not None:
+                return site, path[0]
+        return self.root, None
+
+
+_entry_points = {}
+_entry_points_lock = threading.Lock()
+
+
+def load_entry_point(spec, group):
+    """
+    Loads the entry point named by `spec`, of the form `distribution#name`,
+    from the entry point group, `group`.  Entry points are only looked up and
+    imported once per process, however many sites use them.
+    """
+    key = (group, spec)
+    try:
+        return _entry_points[key]
+    except KeyError:
+        pass
+    with _entry_points_lock:
+        entry_point = _entry_points.get(key)
+        if entry_point is None:
+            ep_dist, ep_name = spec.split('#')
+            entry_point = entrypoints.load_entry_point(
+                ep_dist, group, ep_name)
+            _entry_points[key] = entry_point
+        return entry_point
+
+
+def shard_for(name, count):
+    """
+    Returns the shard, out of `count` shards, which the site named `name`
+    belongs to.
+    """
+    return (zlib.crc32(name) & 0xffffffff) % count
+
+
+def normalize_host(host):
+    """
+    Strips the port from and case folds a host name.
+    """
+    host = host.strip().lower()
+    if ':' in host and not host.endswith(']'):
+        host = host.rsplit(':', 1)[0]
+    return host
+
+
 class LazySite(object):
     _site = None
     _pipeline = None
+    _home_oid = None
+    _home_db = None
+    metrics = None
+
+    # Cold start metrics
+    cold_starts = 0
+    cold_start_seconds = 0.0
+    cold_start_waits = 0
+    cold_start_wait_seconds = 0.0
+    cold_start_max_wait_seconds = 0.0
+
+    # Number of requests currently being served
+    in_flight = 0
+
+    # Set when the site has been removed from the sites config
+    retired = False
+
+    # Time spent getting a database connection for requests
+    connection_waits = 0
+    connection_wait_seconds = 0.0
+    connection_max_wait_seconds = 0.0
 
     def __init__(self, name, settings):
         self.name = name
         self.settings = settings
-
-        ep_dist, ep_name = settings['application'].split('#')
-        self.application = pkg_resources.load_entry_point(
-            ep_dist, APPLICATION_ENTRYPOINT, ep_name)(settings)
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._home_lock = threading.Lock()
+        if asbool(settings.get('jove.metrics', 'false')):
+            self.metrics = SiteMetrics()
+        self.conflicts = ConflictLog()
+        self.retry_budget = RetryBudget(
+            float(settings.get('jove.retry.budget', 0.2)),
+            int(settings.get('jove.retry.budget_burst', 10)))
+
+        self.application_spec = settings['application']
 
         self.zodb_path = settings.get('zodb_path', '/')
 
+        db_options = {}
+        for option, keyword in DB_OPTIONS.items():
+            value = settings.get(option)
+            if value is None:
+                continue
+            try:
+                value = int(value)
+                if value < 0:
+                    raise ValueError(value)
+            except ValueError:
+                raise ValueError(
+                    "Bad value for %s in site %s, must be a non-negative "
+                    "integer: %s" % (option, name, value))
+            db_options[keyword] = value
+        self.db_options = db_options
+
+    @reify
+    def application(self):
+        """
+        The site's application, loaded from its entry point when the site is
+        first used rather than when the sites config is read.
+        """
+        factory = load_entry_point(self.application_spec,
+                                   APPLICATION_ENTRYPOINT)
+        return factory(self.settings)
+
     @reify
     def services(self):
         services = []
         for spec, descriptor in self.application.services():
-            ep_dist, ep_name = spec.split('#')
-            service = pkg_resources.load_entry_point(
-                ep_dist, LOCAL_SERVICE_ENTRYPOINT, ep_name)(descriptor)
-            services.append(service)
+            factory = load_entry_point(spec, LOCAL_SERVICE_ENTRYPOINT)
+            services.append(factory(descriptor))
         return services
 
     def site(self):
         """
         Spin up site.
         """
-        # Set up the root factory.
+        # Set up the root factory.  Once the site's home has been found, and
+        # bootstrapped if necessary, it is loaded directly by its oid.
         def get_root(request):
-            root = get_connection(request).root()
-            return self.find_home(root)['content']
-
-        # Colate persistent and config file based settings
-        settings = self.settings.copy()
-        settings.update(self.get_persistent_settings())
-
-        # Configure Pyramid application
-        config = Configurator(root_factory=get_root, settings=settings)
-        config.root_factory = get_root # so apps can access during config
-        config.begin()
-        for service in self.services:
-            service.preconfigure(config)
-        config.include('pyramid_zodbconn')
-        config.include('pyramid_tm')
-        self.application.configure(config)
-        for service in self.services:
-            service.configure(config)
-        config.end()
-
-        self._site = site = config.make_wsgi_app()
-
-        def closer():
-            db = getattr(config.registry, 'zodb_database', None)
+            start = time.time()
+            conn = get_connection(request)
+            waited = time.time() - start
+            with self._stats_lock:
+                self.connection_waits += 1
+                self.connection_wait_seconds += waited
+                if waited > self.connection_max_wait_seconds:
+                    self.connection_max_wait_seconds = waited
+
+            oid = self._home_oid
+            if oid is not None:
+                try:
+                    return conn.get(oid)['content']
+                except KeyError:
+                    # Home has gone missing, so take the slow path
+                    self._home_oid = None
+            home = self.find_home(conn.root())
+            self._home_oid = home._p_oid
+            return home['content']
+
+        # The database is opened once and shared by the settings lookup and
+        # the site itself.  If it was already opened by `open_home`, the site
+        # takes it over.  `_home_lock` is held until the site is set, so
+        # `open_home` can't open a second database in the meantime.  It is a
+        # separate lock from `_lock`, which `pipeline` holds while calling
+        # this.
+        with self._home_lock:
+            db = self._home_db
             if db is not None:
+                self._home_db = None
+            else:
+                db = self.open_db()
+            try:
+                # Colate persistent and config file based settings
+                settings = self.settings.copy()
+                settings.update(self.get_persistent_settings(db))
+
+                # Configure Pyramid application
+                config = Configurator(root_factory=get_root,
+                                      settings=settings)
+                # so apps can access during config
+                config.root_factory = get_root
+                config.begin()
+                for service in self.services:
+                    service.preconfigure(config)
+                config.registry.zodb_database = db  # used by pyramid_zodbconn
+                config.include('pyramid_tm')
+                self.application.configure(config)
+                for service in self.services:
+                    service.configure(config)
+                config.end()
+            except:
                 db.close()
-                del config.registry.zodb_database
+                raise
 
-        site.close = closer
+            def closer():
+                db = getattr(config.registry, 'zodb_database', None)
+                if db is not None:
+                    db.close()
+                    del config.registry.zodb_database
+
+            site = config.make_wsgi_app()
+            site.close = closer
+            self._site = site
         return site
 
     def pipeline(self):
@@ -129,19 +574,207 @@ class LazySite(object):
         if pipeline is not None:
             return pipeline
 
-        settings = self.settings
-        pipeline = self.application.make_pipeline(self.site())
-        n_tries = int(settings.get('repoze.retry.tries', 3))
-        pipeline = Retry(pipeline, n_tries)
-        self._pipeline = pipeline
+        # Only one thread spins up the site.  Any other threads which
+        # arrive in the meantime wait for it to finish.
+        start = time.time()
+        with self._lock:
+            pipeline = self._pipeline
+            if pipeline is None:
+                settings = self.settings
+                pipeline = self.application.make_pipeline(self.site())
+                n_tries = int(settings.get('jove.retry.tries',
+                              settings.get('repoze.retry.tries', 3)))
+                pipeline = Retry(
+                    pipeline, n_tries,
+                    delay=float(settings.get('jove.retry.delay', 0.01)),
+                    max_delay=float(settings.get('jove.retry.max_delay', 1.0)),
+                    budget=self.retry_budget,
+                    conflicts=self.conflicts,
+                    spool_threshold=int(settings.get(
+                        'jove.retry.spool_threshold', 2<<20)))
+                self._pipeline = pipeline
+
+                elapsed = time.time() - start
+                self.cold_starts += 1
+                self.cold_start_seconds += elapsed
+                log.info("Started site %s in %0.3f seconds",
+                         self.name, elapsed)
+                return pipeline
+
+            waited = time.time() - start
+            self.cold_start_waits += 1
+            self.cold_start_wait_seconds += waited
+            if waited > self.cold_start_max_wait_seconds:
+                self.cold_start_max_wait_seconds = waited
 
         return pipeline
 
-    def close(self):
+    def __call__(self, environ, start_response):
+        """
+        Serves a request with the site's pipeline, spinning up the site if
+        necessary, and keeps count of requests in flight.
+        """
+        finished = self._finished
+        metrics = self.metrics
+        if metrics is not None:
+            start_response, observe = metrics.timer(start_response)
+            def finished():
+                self._finished()
+                observe()
+
+        with self._stats_lock:
+            self.in_flight += 1
+        try:
+            app_iter = self.pipeline()(environ, start_response)
+        except:
+            finished()
+            raise
+        return ClosingIterator(app_iter, finished)
+
+    def _finished(self):
+        with self._stats_lock:
+            self.in_flight -= 1
+            close = self.retired and not self.in_flight
+        if close:
+            self.close()
+
+    def retire(self):
+        """
+        Closes the site, which has been removed or replaced by reloading the
+        sites config, once it has finished serving requests in flight.
+        """
+        with self._stats_lock:
+            self.retired = True
+            if self.in_flight:
+                return
+        self.close()
+
+    def _db(self):
         site = self._site
-        if site is not None:
-            site.close()
-            self._site = None
+        if site is None:
+            return None
+        return getattr(site.registry, 'zodb_database', None)
+
+    def cache_bytes(self):
+        """
+        Returns the estimated total size, in bytes, of the object caches of
+        the site's database connections.  This is the estimate ZODB keeps of
+        the size of the pickles of the objects in each cache, which is what
+        `zodb.cache_size_bytes` limits.  ZODB has no public API for it, so
+        each connection's cache is inspected.
+        """
+        db = self._db()
+        if db is None:
+            return 0
+        sizes = []
+        db._connectionMap(
+            lambda conn: sizes.append(conn._cache.total_estimated_size))
+        return sum(sizes)
+
+    def stats(self):
+        """
+        Returns a dictionary of statistics about the site: whether it is
+        spun up, requests in flight, cold starts, connection pool utilization
+        and waits, object cache usage and, over the last hour, object loads
+        and stores.
+        """
+        stats = {
+            'active': self._site is not None,
+            'in_flight': self.in_flight,
+            'cold_starts': self.cold_starts,
+            'cold_start_seconds': self.cold_start_seconds,
+            'cold_start_waits': self.cold_start_waits,
+            'cold_start_wait_seconds': self.cold_start_wait_seconds,
+            'connection_waits': self.connection_waits,
+            'connection_wait_seconds': self.connection_wait_seconds,
+            'connection_max_wait_seconds': self.connection_max_wait_seconds,
+            'conflicts': self.conflicts.conflicts,
+            'conflict_retries': self.conflicts.retries,
+            'conflict_failures': self.conflicts.failures,
+        }
+        db = self._db()
+        if db is None:
+            return stats
+
+        pool = db.pool
+        connections = len(pool.all)
+        stats.update({
+            'pool_size': db.getPoolSize(),
+            'pool_connections': connections,
+            'pool_in_use': connections - len(pool.available),
+            'cache_size': db.getCacheSize(),
+            'cache_size_bytes': db.getCacheSizeBytes(),
+            'cache_objects': db.cacheSize(),
+            'cache_bytes': self.cache_bytes(),
+        })
+        monitor = db.getActivityMonitor()
+        if monitor is not None:
+            activity = monitor.getActivityAnalysis(divisions=1)[0]
+            stats['loads'] = activity['loads']
+            stats['stores'] = activity['stores']
+        return stats
+
+    def idle(self):
+        """
+        Returns whether the site is neither serving a request nor being spun
+        up, so it can be evicted.
+        """
+        return not (self.in_flight or self._lock.locked())
+
+    def evict(self):
+        """
+        Closes the site if it is idle, that is, if it is neither serving a
+        request nor being spun up.  Returns `True` if the site was closed.
+        """
+        if not self._lock.acquire(False):
+            return False
+        try:
+            with self._stats_lock:
+                if self.in_flight:
+                    return False
+                self._pipeline = None
+            self.close()
+            return True
+        finally:
+            self._lock.release()
+
+    def open_home(self):
+        """
+        Opens the site's database and finds its home, bootstrapping the site
+        if necessary, without configuring the site's Pyramid application.
+        This is much cheaper than spinning up the site, for command line
+        scripts which only need to work on the database.  Returns a tuple of
+        `(home, closer)`, where `closer` closes the home's connection.  The
+        database stays open until the site is closed.
+        """
+        with self._home_lock:
+            site = self._site
+            if site is not None:
+                db = site.registry.zodb_database
+            else:
+                db = self._home_db
+                if db is None:
+                    self._home_db = db = self.open_db()
+            conn = db.open()
+        try:
+            home = self.find_home(conn.root())
+        except:
+            conn.close()
+            raise
+        return home, conn.close
+
+    def close(self):
+        with self._home_lock:
+            db = self._home_db
+            if db is not None:
+                db.close()
+                self._home_db = None
+            site = self._site
+            if site is not None:
+                site.close()
+                self._site = None
+        self._pipeline = None
+        self._home_oid = None
 
     def bootstrap(self, home):
         application = self.application
@@ -167,16 +800,37 @@ class LazySite(object):
         for service in self.services:
             service.bootstrap(home, self)
 
-    def get_persistent_settings(self):
+    def open_db(self):
+        """
+        Opens the site's database.
+        """
         uri = self.settings['zodbconn.uri']
         storage_factory, dbkw = resolve_uri(uri)
+        dbkw.update(self.db_options)
         db = DB(storage_factory(), **dbkw)
+        db.setActivityMonitor(ActivityMonitor())
+        return db
+
+    def get_persistent_settings(self, db=None):
+        """
+        Reads the site's persistent settings from `db`, bootstrapping the
+        site if necessary.  If `db` is not passed the site's database is
+        opened just for the occasion.
+        """
+        if db is None:
+            db = self.open_db()
+            try:
+                return self.get_persistent_settings(db)
+            finally:
+                db.close()
+
+        conn = db.open()
         try:
-            conn = db.open()
             home = self.find_home(conn.root())
+            self._home_oid = home._p_oid
             return home['settings']
         finally:
-            db.close()
+            conn.close()
 
     def find_home(self, root):
         needs_commit = False
@@ -0,0 +1,23 @@
+import mock
+import os
+import shutil
+import tempfile
+
+_fixture = {}
+
+
+def setup_package():
+    # Keep the entry points manifest out of the user's cache
+    from jove import entrypoints
+    tmp = _fixture['tmp'] = tempfile.mkdtemp('.jove-tests')
+    patcher = _fixture['patcher'] = mock.patch.dict(os.environ, {
+        'JOVE_ENTRY_POINTS': os.path.join(tmp, 'entry_points.json')})
+    patcher.start()
+    entrypoints.clear()
+
+
+def teardown_package():
+    from jove import entrypoints
+    entrypoints.clear()
+    _fixture.pop('patcher').stop()
+    shutil.rmtree(_fixture.pop('tmp'))
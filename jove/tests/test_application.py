@@ -47,20 +47,255 @@ class Test_site_dispatch(unittest2.TestCase):
         response = self.callFUT(request=request)
         self.assertEqual(response.body, 'Hello World')
 
+    def dispatch(self, request):
+        from jove.application import site_dispatch
+        return site_dispatch(request)
+
+    def test_forward_to_owner(self):
+        from jove.proxy import ProxyResponse
+        self.sites.owner_address = ('127.0.0.1', 6543)
+        request = self.makeRequest('/foo/bar?baz=1')
+        response = self.dispatch(request)
+        self.assertIsInstance(response, ProxyResponse)
+        self.assertEqual(response.address, ('127.0.0.1', 6543))
+        self.assertEqual(response.timeout, 30.0)
+        self.assertEqual(self.sites.touched, [])
+
+    def test_local_site_touched(self):
+        self.callFUT('/foo/bar')
+        self.assertEqual(self.sites.touched, [self.sites['foo']])
+
+    def test_forwarded_request_not_forwarded_again(self):
+        self.sites.owner_address = ('127.0.0.1', 6543)
+        request = self.makeRequest('/foo/bar')
+        request.environ['jove.forwarded'] = True
+        response = self.callFUT(request=request)
+        self.assertEqual(response.body, 'Hello World')
+
+    def test_forwarded_header_not_trusted(self):
+        from jove.proxy import ProxyResponse
+        self.sites.owner_address = ('127.0.0.1', 6543)
+        request = self.makeRequest('/foo/bar')
+        request.headers['X-Jove-Forwarded'] = '1'
+        self.assertIsInstance(self.dispatch(request), ProxyResponse)
+
+
+class Test_direct_site_dispatch(Test_site_dispatch):
+
+    def callFUT(self, path='/', request=None):
+        from jove.application import direct_site_dispatch as fut
+        if request is None:
+            request = self.makeRequest(path)
+        return request.get_response(fut(request))
+
+    def dispatch(self, request):
+        from jove.application import direct_site_dispatch
+        return direct_site_dispatch(request)
+
+    def test_environ_rewritten_in_place(self):
+        request = self.makeRequest('/foo/bar')
+        environ = request.environ
+        environ['bfg.routes.route'] = 'route'
+        environ['bfg.routes.matchdict'] = request.matchdict
+        environ['bfg.other'] = 'other'
+        from jove.application import direct_site_dispatch as fut
+        fut(request)
+        self.assertEqual(environ['SCRIPT_NAME'], '/foo')
+        self.assertEqual(environ['PATH_INFO'], '/bar')
+        self.assertNotIn('bfg.routes.route', environ)
+        self.assertNotIn('bfg.routes.matchdict', environ)
+        self.assertEqual(environ['bfg.other'], 'other')
+
+    def test_write_callable(self):
+        def app(environ, start_response):
+            write = start_response('200 OK', [('Content-Type', 'text/plain')])
+            write('Hello ')
+            return ['World']
+        self.sites['foo'].pipeline.return_value = app
+        response = self.callFUT('/foo/bar')
+        self.assertEqual(response.body, 'Hello World')
+
+    def test_deferred_start_response(self):
+        closed = []
+        class AppIter(object):
+            def __init__(self, start_response):
+                self.start_response = start_response
+            def __iter__(self):
+                self.start_response('200 OK', [('Content-Type', 'text/plain')])
+                yield 'Hello '
+                yield 'World'
+            def close(self):
+                closed.append(True)
+        self.sites['foo'].pipeline.return_value = (
+            lambda environ, start_response: AppIter(start_response))
+        response = self.callFUT('/foo/bar')
+        self.assertEqual(response.body, 'Hello World')
+        self.assertEqual(closed, [True])
+
+    def test_pass_through(self):
+        from jove.application import direct_site_dispatch as fut
+        app_iter = DummyAppIter()
+        def app(environ, start_response):
+            self.assertIs(start_response, server_start_response)
+            start_response('200 OK', [('Content-Length', '5')])
+            return app_iter
+        def server_start_response(status, headerlist, exc_info=None):
+            captured.append((status, headerlist))
+        captured = []
+        self.sites['foo'].pipeline.return_value = app
+        request = self.makeRequest('/foo/bar')
+        response = fut(request)
+        self.assertIs(response(request.environ, server_start_response),
+                      app_iter)
+        self.assertEqual(captured, [('200 OK', [('Content-Length', '5')])])
+        app_iter.close()
+        self.assertTrue(app_iter.closed)
+
+    def test_streaming_memory(self):
+        import os
+        import resource
+        from jove.application import direct_site_dispatch as fut
+        chunk_size = 1 << 20
+        n_chunks = 1 << 10  # 1 GB
+        closed = []
+        def generate():
+            try:
+                for i in xrange(n_chunks):
+                    yield 'x' * chunk_size
+            finally:
+                closed.append(True)
+        def app(environ, start_response):
+            start_response('200 OK', [
+                ('Content-Length', str(chunk_size * n_chunks))])
+            return generate()
+        self.sites['foo'].pipeline.return_value = app
+
+        # The current, not peak, resident size, so memory used by earlier
+        # tests doesn't hide memory used by this one
+        if not os.path.exists('/proc/self/statm'):
+            self.skipTest("Can't measure resident size.")
+        def rss():
+            with open('/proc/self/statm') as statm:
+                pages = int(statm.read().split()[1])
+            return pages * resource.getpagesize()
+
+        request = self.makeRequest('/foo/bar')
+        before = peak = rss()
+        app_iter = fut(request)(request.environ, lambda *args: None)
+        received = 0
+        for chunk in app_iter:
+            received += len(chunk)
+            peak = max(peak, rss())
+        app_iter.close()
+        self.assertEqual(received, chunk_size * n_chunks)
+        self.assertEqual(closed, [True])
+        self.assertLess(peak - before, 64 * chunk_size)
+
+
+class Test_reload_on_signal(unittest2.TestCase):
+
+    def callFUT(self, sites):
+        from jove.application import reload_on_signal as fut
+        return fut(sites)
+
+    def reloading(self, sites, side_effect=None):
+        import threading
+        reloaded = threading.Event()
+        def reload():
+            reloaded.set()
+            if side_effect is not None:
+                raise side_effect
+        sites.reload.side_effect = reload
+        return reloaded
+
+    @mock.patch('jove.application.signal.signal')
+    def test_it(self, signal):
+        import signal as signals
+        sites = mock.Mock()
+        reloaded = self.reloading(sites)
+        self.callFUT(sites)
+        signum, handler = signal.call_args[0]
+        self.assertEqual(signum, signals.SIGHUP)
+        handler(signum, None)
+        self.assertTrue(reloaded.wait(5))
+        sites.reload.assert_called_once_with()
+
+    @mock.patch('jove.application.signal.signal')
+    def test_handler_does_not_reload(self, signal):
+        sites = mock.Mock()
+        reloaded = self.reloading(sites)
+        with mock.patch('jove.application.threading.Thread'):
+            self.callFUT(sites)
+        signum, handler = signal.call_args[0]
+        handler(signum, None)
+        handler(signum, None)  # Doesn't block while a reload is pending
+        self.assertFalse(reloaded.is_set())
+
+    @mock.patch('jove.application.signal.signal')
+    def test_reload_fails(self, signal):
+        sites = mock.Mock()
+        reloaded = self.reloading(sites, ValueError('Bad config'))
+        self.callFUT(sites)
+        signum, handler = signal.call_args[0]
+        handler(signum, None)  # logged, not raised
+        self.assertTrue(reloaded.wait(5))
+
+    def test_not_main_thread(self):
+        import threading
+        errors = []
+        def target():
+            try:
+                self.callFUT(mock.Mock())
+            except Exception, e:
+                errors.append(e)
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+        self.assertEqual(errors, [])
+
+
+class DummyAppIter(object):
+    closed = False
+
+    def __iter__(self):
+        return iter(['Hello'])
+
+    def close(self):
+        self.closed = True
+
 
 class DummySites(dict):
     root_site = None
     virtual_host = None
+    owner_address = None
+    shard_timeout = 30.0
 
     def __init__(self):
-        site = mock.Mock()
-        pipeline = mock.Mock()
-        pipeline.return_value = self.app = DummyApp()
-        site.pipeline = pipeline
-        self['foo'] = site
-
-    def get_virtual_host(self, name):
-        return self.virtual_host
+        self['foo'] = DummySite(DummyApp())
+        self.app = self['foo'].pipeline.return_value
+        self.touched = []
+
+    def lookup(self, host, path):
+        if self.virtual_host:
+            return self.get(self.virtual_host), None
+        if path and path[0] in self:
+            return self[path[0]], path[0]
+        return self.get(self.root_site), None
+
+    def owner(self, site):
+        return self.owner_address
+
+    def touch(self, site):
+        self.touched.append(site)
+
+
+class DummySite(object):
+
+    def __init__(self, app):
+        self.pipeline = mock.Mock(return_value=app)
+
+    def __call__(self, environ, start_response):
+        return self.pipeline()(environ, start_response)
 
 
 class DummyApp(object):
@@ -0,0 +1,133 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest2
+
+
+class EntryPointsTestBase(unittest2.TestCase):
+
+    def setUp(self):
+        from jove import entrypoints
+        self.tmp = tempfile.mkdtemp('.jove-tests')
+        self.path = os.path.join(self.tmp, 'cache', 'entry_points.json')
+        patcher = mock.patch.dict(os.environ, {'JOVE_ENTRY_POINTS': self.path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        entrypoints.clear()
+        self.addCleanup(entrypoints.clear)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+class Test_load_entry_point(EntryPointsTestBase):
+
+    def callFUT(self, dist, group, name):
+        from jove.entrypoints import load_entry_point
+        return load_entry_point(dist, group, name)
+
+    def test_it(self):
+        import json
+        from jove.tests.test_functional import TestApplication
+        self.assertIs(self.callFUT('jove', 'jove.application', 'test_app'),
+                      TestApplication)
+        with open(self.path) as f:
+            manifest = json.load(f)
+        self.assertIn(['test_app', 'jove', 'jove.tests.test_functional',
+                       ['TestApplication']],
+                      manifest['groups']['jove.application'])
+
+    def test_not_found(self):
+        with self.assertRaises(ImportError):
+            self.callFUT('jove', 'jove.application', 'nosuchapp')
+        with self.assertRaises(ImportError):
+            self.callFUT('nosuchdist', 'jove.application', 'test_app')
+
+
+class Test_iter_entry_points(EntryPointsTestBase):
+
+    def test_it(self):
+        from jove.entrypoints import iter_entry_points
+        from jove.scripts.serve import config_parser
+        eps = dict((ep.name, ep) for ep in iter_entry_points('jove.script'))
+        self.assertIs(eps['serve'].load(), config_parser)
+
+
+class Test_load_manifest(EntryPointsTestBase):
+
+    def callFUT(self, key):
+        from jove.entrypoints import load_manifest
+        return load_manifest(self.path, key)
+
+    @mock.patch('jove.entrypoints.build_manifest')
+    def test_cached(self, build_manifest):
+        build_manifest.return_value = {'jove.script': []}
+        self.assertEqual(self.callFUT('one'), {'jove.script': []})
+        build_manifest.return_value = {'jove.script': [['foo']]}
+        self.assertEqual(self.callFUT('one'), {'jove.script': []})
+        self.assertEqual(build_manifest.call_count, 1)
+
+    @mock.patch('jove.entrypoints.build_manifest')
+    def test_stale(self, build_manifest):
+        build_manifest.return_value = {'jove.script': []}
+        self.callFUT('one')
+        build_manifest.return_value = {'jove.script': [['foo']]}
+        self.assertEqual(self.callFUT('two'), {'jove.script': [['foo']]})
+        self.assertEqual(self.callFUT('two'), {'jove.script': [['foo']]})
+        self.assertEqual(build_manifest.call_count, 2)
+
+    @mock.patch('jove.entrypoints.build_manifest')
+    def test_corrupt(self, build_manifest):
+        os.mkdir(os.path.dirname(self.path))
+        with open(self.path, 'w') as out:
+            out.write('{"key": ')
+        build_manifest.return_value = {'jove.script': []}
+        self.assertEqual(self.callFUT('one'), {'jove.script': []})
+
+    @mock.patch('jove.entrypoints.build_manifest')
+    def test_unable_to_save(self, build_manifest):
+        with open(os.path.join(self.tmp, 'cache'), 'w') as out:
+            out.write('Not a folder')
+        build_manifest.return_value = {'jove.script': []}
+        self.assertEqual(self.callFUT('one'), {'jove.script': []})
+
+
+class Test_stamp(unittest2.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp('.jove-tests')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def callFUT(self):
+        from jove.entrypoints import stamp
+        return stamp([self.tmp, os.path.join(self.tmp, 'missing')])
+
+    def add_dist(self, name):
+        folder = os.path.join(self.tmp, name)
+        os.mkdir(folder)
+        filename = os.path.join(folder, 'entry_points.txt')
+        with open(filename, 'w') as out:
+            out.write('[jove.script]\n')
+        return filename
+
+    def test_it(self):
+        filename = self.add_dist('foo-1.0.egg-info')
+        key = self.callFUT()
+        self.assertEqual(self.callFUT(), key)
+
+        # Entry points changed
+        os.utime(filename, (0, 0))
+        changed = self.callFUT()
+        self.assertNotEqual(changed, key)
+
+        # Distribution installed
+        self.add_dist('bar-1.0.dist-info')
+        installed = self.callFUT()
+        self.assertNotEqual(installed, changed)
+
+        # Unrelated files don't matter
+        os.mkdir(os.path.join(self.tmp, 'baz'))
+        self.assertEqual(self.callFUT(), installed)
@@ -8,6 +8,7 @@ import webtest
 
 
 class FunctionalTests(unittest2.TestCase):
+    settings = {}
 
     def setUp(self):
         self.tmp = tmp = tempfile.mkdtemp('.jove-testing')
@@ -24,6 +25,7 @@ class FunctionalTests(unittest2.TestCase):
         with open(self.sites_ini, 'w') as out:
             out.write(sites_ini)
         settings = {'sites_config': self.sites_ini}
+        settings.update(self.settings)
         return webtest.TestApp(make_app(settings))
 
     def assert_site_works(self, app, url):
@@ -99,6 +101,67 @@ class FunctionalTests(unittest2.TestCase):
                 self.assert_site_works(app, '/acme/')
         self.assertTrue(tx.aborted)
 
+    def test_warmup(self):
+        self.settings = dict(self.settings)
+        self.settings['jove.warmup'] = 'true'
+        app = self.make_application(
+            "[site:acme]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = %s\n" % self.zodb_uri)
+        site = app.app.registry.sites.get('acme')
+        self.assertIsNotNone(site._pipeline)
+        self.assert_site_works(app, '/acme/')
+
+    def test_metrics(self):
+        self.settings = dict(self.settings)
+        self.settings['jove.metrics'] = 'true'
+        app = self.make_application(
+            "[site:acme]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = %s\n" % self.zodb_uri)
+        self.assert_site_works(app, '/acme/')
+        response = app.get('/_jove/metrics')
+        self.assertEqual(response.headers['Content-Type'],
+                         'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.body.splitlines()
+        self.assertIn('jove_requests_total{site="acme"} 3', lines)
+        self.assertIn('jove_responses_total{site="acme",code="200"} 2', lines)
+        self.assertIn('jove_responses_total{site="acme",code="302"} 1', lines)
+        self.assertIn('jove_requests_in_flight{site="acme"} 0', lines)
+        self.assertIn('jove_cold_starts_total{site="acme"} 1', lines)
+
+    def test_reload_on_sighup(self):
+        sites_ini = (
+            "[site:acme]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = %s\n" % self.zodb_uri)
+        with mock.patch('jove.application.reload_on_signal') as reload:
+            self.make_application(sites_ini)
+            self.assertFalse(reload.called)
+            self.settings = dict(self.settings,
+                                 **{'jove.reload_on_sighup': 'true'})
+            self.make_application(sites_ini)
+            self.assertEqual(reload.call_count, 1)
+
+    def test_metrics_disabled(self):
+        app = self.make_application(
+            "[site:acme]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = %s\n" % self.zodb_uri)
+        app.get('/_jove/metrics', status=404)
+
+
+class DirectDispatchFunctionalTests(FunctionalTests):
+    settings = {'jove.dispatch': 'direct'}
+
+    def test_unknown_dispatch_mode(self):
+        self.settings = {'jove.dispatch': 'foo'}
+        with self.assertRaises(ValueError):
+            self.make_application(
+                "[site:acme]\n"
+                "application = jove#test_app\n"
+                "zodbconn.uri = %s\n" % self.zodb_uri)
+
 
 from jove.interfaces import Application
 from jove.interfaces import LocalService
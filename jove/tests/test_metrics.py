@@ -0,0 +1,84 @@
+import mock
+import unittest2
+
+
+class TestSiteMetrics(unittest2.TestCase):
+
+    def makeOne(self):
+        from jove.metrics import SiteMetrics
+        return SiteMetrics(buckets=(0.1, 1.0))
+
+    def test_observe(self):
+        metrics = self.makeOne()
+        metrics.observe('200', 0.05)
+        metrics.observe('200', 0.5)
+        metrics.observe('404', 0.1)
+        metrics.observe('500', 5.0)
+        self.assertEqual(metrics.snapshot(),
+                         (4, {'200': 2, '404': 1, '500': 1}, [2, 1], 5.65))
+
+    @mock.patch('jove.metrics.time.time')
+    def test_timer(self, time):
+        time.return_value = 10.0
+        metrics = self.makeOne()
+        start_response = mock.Mock(return_value='write')
+        timed_start_response, finished = metrics.timer(start_response)
+        self.assertEqual(timed_start_response('302 Found', []), 'write')
+        start_response.assert_called_once_with('302 Found', [], None)
+        time.return_value = 10.5
+        finished()
+        self.assertEqual(metrics.snapshot(), (1, {'302': 1}, [0, 1], 0.5))
+
+    def test_timer_no_response(self):
+        metrics = self.makeOne()
+        start_response, finished = metrics.timer(None)
+        finished()
+        self.assertEqual(metrics.snapshot()[1], {'500': 1})
+
+
+class Test_format_metrics(unittest2.TestCase):
+
+    def test_it(self):
+        from jove.metrics import SiteMetrics
+        from jove.metrics import format_metrics
+        from jove.retry import ConflictLog
+        foo = mock.Mock()
+        foo.conflicts = ConflictLog()
+        foo.conflicts.record('/a', ValueError(), True)
+        foo.metrics = SiteMetrics(buckets=(0.1, 1.0))
+        foo.metrics.observe('200', 0.05)
+        foo.metrics.observe('404', 0.5)
+        foo.stats.return_value = {'in_flight': 1, 'active': True,
+                                  'cold_starts': 2, 'cache_bytes': 1024}
+        bar = mock.Mock()
+        bar.conflicts = ConflictLog()
+        bar.metrics = None
+        bar.stats.return_value = {'in_flight': 0, 'active': False,
+                                  'cold_starts': 0}
+        sites = mock.Mock()
+        sites.sites = {'foo': foo, 'b"a\\r': bar}
+        sites.get = sites.sites.get
+        sites.evictions = 3
+
+        lines = format_metrics(sites).splitlines()
+        for line in [
+            '# TYPE jove_requests_total counter',
+            'jove_requests_total{site="foo"} 2',
+            'jove_responses_total{site="foo",code="200"} 1',
+            'jove_responses_total{site="foo",code="404"} 1',
+            '# TYPE jove_request_duration_seconds histogram',
+            'jove_request_duration_seconds_bucket{site="foo",le="0.1"} 1',
+            'jove_request_duration_seconds_bucket{site="foo",le="1.0"} 2',
+            'jove_request_duration_seconds_bucket{site="foo",le="+Inf"} 2',
+            'jove_request_duration_seconds_sum{site="foo"} 0.55',
+            'jove_request_duration_seconds_count{site="foo"} 2',
+            'jove_requests_in_flight{site="b\\"a\\\\r"} 0',
+            'jove_requests_in_flight{site="foo"} 1',
+            'jove_site_active{site="foo"} 1',
+            'jove_cold_starts_total{site="foo"} 2',
+            'jove_zodb_cache_bytes{site="foo"} 1024',
+            'jove_conflict_hotspots_total{site="foo",path="/a",'
+            'class="ValueError",oid=""} 1',
+            'jove_evictions_total 3']:
+            self.assertIn(line, lines)
+        self.assertNotIn('jove_requests_total{site="b\\"a\\\\r"} 0', lines)
@@ -0,0 +1,142 @@
+import threading
+import unittest2
+
+
+class TestProxyResponse(unittest2.TestCase):
+
+    def setUp(self):
+        from wsgiref.simple_server import make_server
+        from wsgiref.simple_server import WSGIRequestHandler
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+        self.requests = []
+        self.hung = threading.Event()
+        from jove.proxy import ShardMiddleware
+        self.server = make_server('127.0.0.1', 0,
+                                  ShardMiddleware(self.app, forwarded=True),
+                                  handler_class=QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.hung.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def app(self, environ, start_response):
+        if environ['PATH_INFO'] == '/hung':
+            self.hung.wait()
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length)
+        self.requests.append((environ, body))
+        start_response('201 Created', [
+            ('Content-Type', 'text/plain'),
+            ('Set-Cookie', 'a=1'),
+            ('Set-Cookie', 'b=2')])
+        return ['Hello ', 'World']
+
+    def makeOne(self, timeout=None):
+        from jove.proxy import ProxyResponse
+        return ProxyResponse(self.server.server_address, timeout)
+
+    def test_it(self):
+        from webob import Request
+        request = Request.blank('/foo/bar?baz=1', POST={'body': 'Hi!'})
+        request.host = 'example.com'
+        request.headers['Connection'] = 'close'
+        request.headers['X-Jove-Forwarded'] = '1'
+        request.script_name = '/mount'
+        request.path_info = '/foo bar/baz'
+        request.scheme = 'https'
+        request.remote_addr = '10.1.2.3'
+        response = request.get_response(self.makeOne())
+        self.assertEqual(response.status, '201 Created')
+        self.assertEqual(response.body, 'Hello World')
+        self.assertEqual(response.headers.getall('Set-Cookie'),
+                         ['a=1', 'b=2'])
+
+        environ, body = self.requests[0]
+        self.assertEqual(environ['REQUEST_METHOD'], 'POST')
+        self.assertEqual(environ['SCRIPT_NAME'], '/mount')
+        self.assertEqual(environ['PATH_INFO'], '/foo bar/baz')
+        self.assertEqual(environ['wsgi.url_scheme'], 'https')
+        self.assertEqual(environ['REMOTE_ADDR'], '10.1.2.3')
+        self.assertTrue(environ['jove.forwarded'])
+        self.assertEqual(environ['QUERY_STRING'], 'baz=1')
+        self.assertEqual(environ['HTTP_HOST'], 'example.com')
+        self.assertNotIn('HTTP_X_JOVE_FORWARDED', environ)
+        self.assertEqual(environ['CONTENT_TYPE'],
+                         'application/x-www-form-urlencoded')
+        self.assertNotIn('HTTP_CONNECTION', environ)
+        self.assertEqual(body, 'body=Hi%21')
+
+    def test_body_without_length(self):
+        import StringIO
+        from webob import Request
+        request = Request.blank('/', method='PUT')
+        request.environ.pop('CONTENT_LENGTH', None)
+        request.environ['wsgi.input'] = StringIO.StringIO('x' * 100000)
+        request.environ['wsgi.input_terminated'] = True
+        request.headers['Connection'] = 'close'
+        response = request.get_response(self.makeOne())
+        self.assertEqual(response.body, 'Hello World')
+        environ, body = self.requests[0]
+        self.assertEqual(environ['CONTENT_LENGTH'], '100000')
+        self.assertEqual(body, 'x' * 100000)
+        self.assertEqual(environ['SCRIPT_NAME'], '')
+
+
+    def test_timeout(self):
+        from webob import Request
+        request = Request.blank('/hung')
+        response = request.get_response(self.makeOne(timeout=0.1))
+        self.assertEqual(response.status, '504 Gateway Timeout')
+        self.assertEqual(response.body, 'Gateway Timeout')
+
+
+class TestShardMiddleware(unittest2.TestCase):
+
+    def call(self, forwarded):
+        from webob import Request
+        from jove.proxy import ShardMiddleware
+        environs = []
+        def app(environ, start_response):
+            environs.append(environ)
+            start_response('200 OK', [])
+            return []
+        request = Request.blank('/')
+        request.headers['X-Jove-Forwarded'] = '1'
+        request.get_response(ShardMiddleware(app, forwarded))
+        return environs[0]
+
+    def test_public(self):
+        environ = self.call(False)
+        self.assertNotIn('HTTP_X_JOVE_FORWARDED', environ)
+        self.assertNotIn('jove.forwarded', environ)
+
+    def test_forwarded(self):
+        environ = self.call(True)
+        self.assertNotIn('HTTP_X_JOVE_FORWARDED', environ)
+        self.assertTrue(environ['jove.forwarded'])
+
+
+class Test_response_headers(unittest2.TestCase):
+
+    def callFUT(self, message):
+        from jove.proxy import response_headers
+        return response_headers(message)
+
+    def test_it(self):
+        import mimetools
+        import StringIO
+        message = mimetools.Message(StringIO.StringIO(
+            'Content-Type: text/plain\r\n'
+            'X-Folded: one\r\n'
+            '  two\r\n'
+            'Transfer-Encoding: chunked\r\n'
+            '\r\n'))
+        self.assertEqual(self.callFUT(message), [
+            ('Content-Type', 'text/plain'),
+            ('X-Folded', 'one two')])
@@ -0,0 +1,253 @@
+import mock
+import unittest2
+
+
+class TestRetry(unittest2.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('jove.retry.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def makeOne(self, app, **kw):
+        from jove.retry import Retry
+        return Retry(app, **kw)
+
+    def call(self, retry, body='', path='/foo'):
+        from webob import Request
+        request = Request.blank(path, method='POST', body=body)
+        return request.get_response(retry)
+
+    def test_success(self):
+        retry = self.makeOne(ConflictingApp(0))
+        response = self.call(retry, 'Hello')
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(response.body, 'Hello')
+        self.assertEqual(retry.conflicts.conflicts, 0)
+        self.assertEqual(self.sleep.call_count, 0)
+
+    @mock.patch('jove.retry.random.uniform')
+    def test_retry_with_backoff(self, uniform):
+        uniform.side_effect = lambda low, high: high
+        app = ConflictingApp(3)
+        retry = self.makeOne(app, tries=4, delay=0.1, max_delay=0.3)
+        response = self.call(retry, 'Hello')
+        self.assertEqual(response.body, 'Hello')
+        self.assertEqual(app.calls, 4)
+        self.assertEqual(self.sleep.call_args_list, [
+            ((0.1,), {}), ((0.2,), {}), ((0.3,), {})])
+        conflicts = retry.conflicts
+        self.assertEqual(conflicts.conflicts, 3)
+        self.assertEqual(conflicts.retries, 3)
+        self.assertEqual(conflicts.failures, 0)
+        self.assertEqual(conflicts.top(),
+                         [(('/foo', 'jove.Foo', '0x2a'), 3)])
+
+    def test_give_up(self):
+        from ZODB.POSException import ConflictError
+        app = ConflictingApp(3)
+        retry = self.makeOne(app, tries=3)
+        with self.assertRaises(ConflictError):
+            self.call(retry)
+        self.assertEqual(app.calls, 3)
+        self.assertEqual(retry.conflicts.retries, 2)
+        self.assertEqual(retry.conflicts.failures, 1)
+
+    def test_budget_exhausted(self):
+        from ZODB.POSException import ConflictError
+        from jove.retry import RetryBudget
+        budget = RetryBudget(ratio=0.5, burst=1)
+        app = ConflictingApp(1)
+        retry = self.makeOne(app, budget=budget)
+        self.call(retry)
+        self.assertEqual(app.calls, 2)
+        app.calls = 0
+        with self.assertRaises(ConflictError):
+            self.call(retry)
+        self.assertEqual(app.calls, 1)
+        self.assertEqual(retry.conflicts.failures, 1)
+
+    def test_write_callable(self):
+        def app(environ, start_response):
+            write = start_response('200 OK', [])
+            write('Hello ')
+            return ['World']
+        self.assertEqual(self.call(self.makeOne(app)).body, 'Hello World')
+
+    def test_no_start_response(self):
+        app_iter = mock.Mock()
+        retry = self.makeOne(lambda environ, start_response: app_iter)
+        with self.assertRaises(AssertionError):
+            self.call(retry)
+        app_iter.close.assert_called_once_with()
+
+    def test_bad_request_body(self):
+        from webob import Request
+        request = Request.blank('/', method='POST', body='Hello')
+        request.environ['wsgi.input'] = mock.Mock()
+        request.environ['wsgi.input'].read.side_effect = IOError
+        response = request.get_response(self.makeOne(ConflictingApp(0)))
+        self.assertEqual(response.status, '400 Bad Request')
+
+    def test_large_body(self):
+        body = 'x' * 100
+        app = ConflictingApp(1)
+        retry = self.makeOne(app, spool_threshold=10)
+        self.assertEqual(self.call(retry, body).body, body)
+        self.assertEqual(app.calls, 2)
+
+    def test_webob_reads_body_without_copying(self):
+        from webob import Request
+        from jove.retry import BodyView
+        bodies = []
+        def app(environ, start_response):
+            request = Request(environ)
+            bodies.append((request.POST['foo'], request.body_file_raw))
+            start_response('200 OK', [])
+            return []
+        self.call(self.makeOne(app), 'foo=bar')
+        value, body_file = bodies[0]
+        self.assertEqual(value, 'bar')
+        self.assertIsInstance(body_file, BodyView)
+
+    def test_concurrent_large_uploads(self):
+        import os
+        import resource
+        import threading
+        chunk_size = 1 << 20
+        n_chunks = 100
+
+        # The current, not peak, resident size, so memory used by earlier
+        # tests doesn't hide memory used by this one
+        if not os.path.exists('/proc/self/statm'):
+            self.skipTest("Can't measure resident size.")
+        def rss():
+            with open('/proc/self/statm') as statm:
+                pages = int(statm.read().split()[1])
+            return pages * resource.getpagesize()
+        sizes = []
+
+        def app(environ, start_response):
+            input = environ['wsgi.input']
+            received = 0
+            while True:
+                chunk = input.read(chunk_size)
+                if not chunk:
+                    break
+                received += len(chunk)
+                sizes.append(rss())
+            start_response('200 OK', [])
+            return [str(received)]
+
+        results = []
+        retry = self.makeOne(app, spool_threshold=chunk_size)
+        def upload():
+            environ = {
+                'wsgi.input': GeneratedInput(chunk_size * n_chunks),
+                'CONTENT_LENGTH': str(chunk_size * n_chunks)}
+            app_iter = retry(environ, lambda *args: None)
+            results.append(''.join(app_iter))
+            app_iter.close()
+
+        before = rss()
+        threads = [threading.Thread(target=upload) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [str(chunk_size * n_chunks)] * 2)
+        self.assertLess(max(sizes) - before, 32 * chunk_size)
+
+
+class TestSpooledBody(unittest2.TestCase):
+
+    def makeOne(self, data, threshold=100, length=None):
+        from StringIO import StringIO
+        from jove.retry import SpooledBody
+        if length is None:
+            length = len(data)
+        return SpooledBody(StringIO(data), length, threshold)
+
+    def test_in_memory(self):
+        body = self.makeOne('Hello World')
+        self.assertFalse(body.spooled)
+        self.assertEqual(body.view().read(), 'Hello World')
+
+    def test_spooled(self):
+        body = self.makeOne('Hello World', threshold=5)
+        self.assertTrue(body.spooled)
+        self.assertEqual(body.view().read(), 'Hello World')
+        body.close()
+        self.assertTrue(body.data.closed)
+
+    def test_short_input(self):
+        body = self.makeOne('Hello', length=10)
+        self.assertEqual(body.length, 5)
+        self.assertEqual(body.view().read(), 'Hello')
+
+    def test_views(self):
+        for threshold in (100, 5):
+            body = self.makeOne('one\ntwo\nthree', threshold)
+            body.chunk_size = 2
+            view = body.view()
+            self.assertEqual(view.read(2), 'on')
+            self.assertEqual(view.readline(), 'e\n')
+            self.assertEqual(view.tell(), 4)
+            other = body.view()
+            self.assertEqual(other.readlines(), ['one\n', 'two\n', 'three'])
+            self.assertEqual(view.readline(2), 'tw')
+            self.assertEqual(list(view), ['o\n', 'three'])
+            self.assertEqual(view.read(), '')
+            view.seek(-5, 2)
+            self.assertEqual(view.read(3), 'thr')
+            view.seek(-2, 1)
+            self.assertEqual(view.read(), 'hree')
+            view.seek(0)
+            self.assertEqual(view.readlines(5), ['one\n', 'two\n'])
+            body.close()
+
+
+class GeneratedInput(object):
+
+    def __init__(self, length):
+        self.rest = length
+
+    def read(self, size):
+        size = min(size, self.rest)
+        self.rest -= size
+        return 'x' * size
+
+
+class TestConflictLog(unittest2.TestCase):
+
+    def test_max_entries(self):
+        from jove.retry import ConflictLog
+        log = ConflictLog(max_entries=2)
+        log.record('/a', ValueError(), True)
+        log.record('/a', ValueError(), True)
+        log.record('/b', ValueError(), False)
+        log.record('/c', ValueError(), False)
+        self.assertEqual(log.top(), [
+            (('/a', 'ValueError', ''), 2), (('/c', 'ValueError', ''), 1)])
+        self.assertEqual(log.conflicts, 4)
+        self.assertEqual(log.retries, 2)
+        self.assertEqual(log.failures, 2)
+
+
+class ConflictingApp(object):
+
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        self.calls = 0
+
+    def __call__(self, environ, start_response):
+        from ZODB.POSException import ConflictError
+        from ZODB.utils import p64
+        self.calls += 1
+        body = environ['wsgi.input'].read()
+        if self.calls <= self.conflicts:
+            error = ConflictError(oid=p64(42))
+            error.class_name = 'jove.Foo'
+            raise error
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [body]
@@ -0,0 +1,599 @@
+import mock
+import unittest2
+
+
+class TestDispatchIndex(unittest2.TestCase):
+
+    def makeOne(self, virtual_hosts={}, root_site=None):
+        from jove.site import DispatchIndex
+        self.sites = sites = {'foo': 'Foo', 'bar': 'Bar', 'baz': 'Baz'}
+        return DispatchIndex(sites, virtual_hosts, root_site)
+
+    def test_path_prefix(self):
+        index = self.makeOne()
+        self.assertEqual(index.lookup('localhost', ('foo', 'x')),
+                         ('Foo', 'foo'))
+
+    def test_not_found(self):
+        index = self.makeOne()
+        self.assertEqual(index.lookup('localhost', ('qux',)), (None, None))
+        self.assertEqual(index.lookup('localhost', ()), (None, None))
+
+    def test_root_site(self):
+        index = self.makeOne(root_site='baz')
+        self.assertEqual(index.lookup('localhost', ('qux',)), ('Baz', None))
+        self.assertEqual(index.lookup('localhost', ()), ('Baz', None))
+        self.assertEqual(index.lookup('localhost', ('foo',)), ('Foo', 'foo'))
+
+    def test_virtual_host(self):
+        index = self.makeOne({'Foo.Example.com:8080': 'foo'})
+        self.assertEqual(index.lookup('foo.example.com', ('bar',)),
+                         ('Foo', None))
+        self.assertEqual(index.lookup('FOO.EXAMPLE.COM:80', ()),
+                         ('Foo', None))
+        self.assertEqual(index.get_virtual_host('foo.example.com:443'), 'foo')
+        self.assertEqual(index.get_virtual_host('example.com'), None)
+        self.assertEqual(index.get_virtual_host(None), None)
+
+    def test_wildcard_virtual_host(self):
+        index = self.makeOne({'*.example.com': 'foo',
+                              'www.example.com': 'bar',
+                              '*.baz.example.com': 'baz'})
+        self.assertEqual(index.get_virtual_host('a.example.com'), 'foo')
+        self.assertEqual(index.get_virtual_host('a.b.example.com:80'), 'foo')
+        self.assertEqual(index.get_virtual_host('www.example.com'), 'bar')
+        self.assertEqual(index.get_virtual_host('a.baz.example.com'), 'baz')
+        self.assertEqual(index.get_virtual_host('example.com'), None)
+        self.assertEqual(index.get_virtual_host('example.org'), None)
+
+
+class Test_normalize_host(unittest2.TestCase):
+
+    def callFUT(self, host):
+        from jove.site import normalize_host as fut
+        return fut(host)
+
+    def test_it(self):
+        self.assertEqual(self.callFUT('Example.COM'), 'example.com')
+        self.assertEqual(self.callFUT('example.com:8080'), 'example.com')
+        self.assertEqual(self.callFUT('[::1]'), '[::1]')
+        self.assertEqual(self.callFUT('[::1]:8080'), '[::1]')
+
+
+class Test_shard_for(unittest2.TestCase):
+
+    def callFUT(self, name, count):
+        from jove.site import shard_for
+        return shard_for(name, count)
+
+    def test_it(self):
+        # Shards must not change between processes or releases
+        self.assertEqual([self.callFUT('site%d' % i, 4) for i in xrange(8)],
+                         [1, 3, 1, 3, 0, 2, 0, 2])
+        self.assertEqual(self.callFUT('anything', 1), 0)
+
+
+class TestSites(unittest2.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp('.jove-tests')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def makeOne(self, sites_ini):
+        import os
+        from jove.site import Sites
+        path = os.path.join(self.tmp, 'sites.ini')
+        with open(path, 'w') as out:
+            out.write(sites_ini)
+        return Sites({'sites_config': path})
+
+    def test_warmup(self):
+        sites = self.makeOne(
+            "[site:one]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = memory://\n"
+            "[site:two]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = memory://\n"
+            "[site:three]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = memory://\n")
+        error = ValueError('broken')
+        sites.get('two').site = mock.Mock(side_effect=error)
+        try:
+            results = sites.warmup(threads=2)
+            self.assertEqual([name for name, elapsed, e in results],
+                             ['one', 'three', 'two'])
+            self.assertEqual([e for name, elapsed, e in results],
+                             [None, None, error])
+            self.assertIsNotNone(sites.get('one')._pipeline)
+            self.assertIsNotNone(sites.get('three')._pipeline)
+            self.assertIsNone(sites.get('two')._pipeline)
+        finally:
+            sites.close()
+        self.assertIsNone(sites.get('one')._pipeline)
+
+    def test_shard(self):
+        sites = self.make_three_sites()
+        self.assertIsNone(sites.owner(sites.get('one')))
+        self.assertEqual(sites.owned(), ['one', 'three', 'two'])
+
+        addresses = [('127.0.0.1', 8001), ('127.0.0.1', 8002)]
+        owned = []
+        for index in (0, 1):
+            sites.set_shard(index, addresses)
+            owned.extend(sites.owned())
+            for name in sites.owned():
+                self.assertIsNone(sites.owner(sites.get(name)))
+            for name in set(sites.sites) - set(sites.owned()):
+                self.assertEqual(sites.owner(sites.get(name)),
+                                 addresses[1 - index])
+        self.assertEqual(sorted(owned), ['one', 'three', 'two'])
+
+    def test_shard_timeout(self):
+        import os
+        from jove.site import Sites
+        path = os.path.join(self.tmp, 'sites.ini')
+        with open(path, 'w') as out:
+            out.write('')
+        self.assertEqual(Sites({'sites_config': path}).shard_timeout, 30.0)
+        self.assertEqual(Sites({'sites_config': path,
+                                'jove.shard_timeout': '2.5'}).shard_timeout,
+                         2.5)
+        self.assertIsNone(Sites({'sites_config': path,
+                                 'jove.shard_timeout': '0'}).shard_timeout)
+
+    def test_warmup_owned_sites(self):
+        from jove.site import shard_for
+        sites = self.make_three_sites()
+        index = shard_for('one', 2)
+        sites.set_shard(index, [('127.0.0.1', 8001), ('127.0.0.1', 8002)])
+        results = sites.warmup()
+        self.assertEqual([name for name, elapsed, e in results],
+                         sites.owned())
+        for name, site in sites.sites.items():
+            self.assertEqual(site._pipeline is not None,
+                             name in sites.owned())
+
+    def test_reload(self):
+        import os
+        sites = self.make_three_sites()
+        one, two, three = [sites.get(name) for name in ('one', 'two', 'three')]
+        sites.warmup()
+        pipeline = one.pipeline()
+        with open(os.path.join(self.tmp, 'sites.ini'), 'w') as out:
+            out.write(
+                "[site:one]\n"
+                "application = jove#test_app\n"
+                "zodbconn.uri = memory://\n"
+                "[site:two]\n"
+                "application = jove#test_app\n"
+                "zodbconn.uri = memory://\n"
+                "virtual_host = two.example.com\n"
+                "[site:four]\n"
+                "application = jove#test_app\n"
+                "zodbconn.uri = memory://\n")
+        self.assertEqual(sites.reload(), (['four'], ['two'], ['three']))
+        self.assertIs(sites.get('one'), one)
+        self.assertIs(one.pipeline(), pipeline)
+        self.assertIsNot(sites.get('two'), two)
+        self.assertIsNone(sites.get('three'))
+        self.assertIsNone(two._pipeline)
+        self.assertIsNone(three._pipeline)
+        self.assertTrue(two.retired)
+        self.assertIs(sites.lookup('two.example.com', ())[0], sites.get('two'))
+        self.assertIs(sites.lookup('localhost', ('four',))[0],
+                      sites.get('four'))
+        self.assertEqual(sites.lookup('localhost', ('three',)), (None, None))
+
+    def test_reload_unchanged(self):
+        sites = self.make_three_sites()
+        before = dict(sites.sites)
+        self.assertEqual(sites.reload(), ([], [], []))
+        self.assertEqual(sites.sites, before)
+
+    def test_reload_bad_config(self):
+        import os
+        sites = self.make_three_sites()
+        before = dict(sites.sites)
+        with open(os.path.join(self.tmp, 'sites.ini'), 'a') as out:
+            out.write("[site:four]\n"
+                      "application = jove#test_app\n"
+                      "zodbconn.uri = memory://\n"
+                      "zodb.pool_size = lots\n")
+        with self.assertRaises(ValueError):
+            sites.reload()
+        self.assertEqual(sites.sites, before)
+
+    def test_reload_retires_site_in_flight(self):
+        import os
+        sites = self.make_three_sites(max_active_sites=3)
+        app_iter = self.request(sites, 'three', close=False)
+        three = sites.get('three')
+        self.assertEqual(sites.active.keys(), ['three'])
+        with open(os.path.join(self.tmp, 'sites.ini'), 'w') as out:
+            out.write("[site:one]\n"
+                      "application = jove#test_app\n"
+                      "zodbconn.uri = memory://\n")
+        sites.reload()
+        self.assertEqual(sites.active.keys(), [])
+        self.assertIsNotNone(three._pipeline)
+        app_iter.close()
+        self.assertIsNone(three._pipeline)
+
+    def make_three_sites(self, **settings):
+        sites = self.makeOne(
+            "[site:one]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = memory://\n"
+            "[site:two]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = memory://\n"
+            "[site:three]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = memory://\n")
+        for name, value in settings.items():
+            setattr(sites, name, value)
+        self.addCleanup(sites.close)
+        return sites
+
+    def request(self, sites, name, close=True):
+        from webob import Request
+        site, prefix = sites.lookup('localhost', (name,))
+        self.assertEqual(prefix, name)
+        sites.touch(site)
+        request = Request.blank('/%s/' % name)
+        request.script_name, request.path_info = '/' + name, '/'
+        app_iter = site(request.environ, lambda *args: None)
+        body = ''.join(app_iter)
+        self.assertEqual(body, 'Test Application')
+        if close:
+            app_iter.close()
+        return app_iter
+
+    def test_max_active_sites(self):
+        sites = self.make_three_sites(max_active_sites=2)
+        one = sites.get('one')
+        self.request(sites, 'one')
+        self.request(sites, 'two')
+        self.request(sites, 'one')
+        self.assertEqual(sites.evictions, 0)
+        self.request(sites, 'three')
+        self.assertEqual(sites.evictions, 1)
+        self.assertEqual(sites.active.keys(), ['one', 'three'])
+        self.assertIsNone(sites.get('two')._pipeline)
+        self.assertIsNotNone(one._pipeline)
+
+        # Evicted site comes back transparently
+        self.request(sites, 'two')
+        self.assertEqual(sites.evictions, 2)
+        self.assertEqual(sites.active.keys(), ['three', 'two'])
+        self.assertIsNone(one._pipeline)
+        self.assertEqual(sites.get('two').cold_starts, 2)
+
+    def test_in_flight_not_evicted(self):
+        sites = self.make_three_sites(max_active_sites=2)
+        one = sites.get('one')
+        app_iter = self.request(sites, 'one', close=False)
+        self.assertEqual(one.in_flight, 1)
+        self.request(sites, 'two')
+        self.request(sites, 'three')
+        self.assertEqual(sites.active.keys(), ['one', 'three'])
+        self.assertIsNotNone(one._pipeline)
+        app_iter.close()
+        app_iter.close()
+        self.assertEqual(one.in_flight, 0)
+        self.request(sites, 'two')
+        self.assertEqual(sites.active.keys(), ['three', 'two'])
+        self.assertIsNone(one._pipeline)
+
+    def test_not_evicted_while_starting(self):
+        sites = self.make_three_sites(max_active_sites=1)
+        one = sites.get('one')
+        self.request(sites, 'one')
+        one._lock.acquire()
+        try:
+            self.request(sites, 'two')
+        finally:
+            one._lock.release()
+        self.assertEqual(sites.evictions, 0)
+        self.assertEqual(sites.active.keys(), ['one', 'two'])
+
+    def test_evicted_outside_lock(self):
+        sites = self.make_three_sites(max_active_sites=1)
+        self.request(sites, 'one')
+        one = sites.get('one')
+        evict = one.evict
+        def check_unlocked():
+            self.assertFalse(sites._lru_lock.locked())
+            return evict()
+        one.evict = check_unlocked
+        self.request(sites, 'two')
+        self.assertEqual(sites.evictions, 1)
+        self.assertIsNone(one._pipeline)
+
+    def test_busy_victim_kept(self):
+        sites = self.make_three_sites(max_active_sites=1)
+        self.request(sites, 'one')
+        sites.get('one').evict = mock.Mock(return_value=False)
+        self.request(sites, 'two')
+        self.assertEqual(sites.evictions, 0)
+        self.assertEqual(sorted(sites.active.keys()), ['one', 'two'])
+
+    def test_max_cache_bytes(self):
+        sites = self.make_three_sites(max_cache_bytes=1000,
+                                      cache_check_interval=0)
+        self.request(sites, 'one')
+        one = sites.get('one')
+        self.assertGreater(one.cache_bytes(), 0)
+        for name in ('one', 'two', 'three'):
+            sites.get(name).cache_bytes = mock.Mock(return_value=400)
+        self.request(sites, 'two')
+        self.request(sites, 'three')
+        self.assertEqual(sites.evictions, 1)
+        self.assertEqual(sites.active.keys(), ['two', 'three'])
+        self.request(sites, 'three')
+        self.assertEqual(sites.evictions, 1)
+
+    def test_db_options(self):
+        sites = self.makeOne(
+            "[site:one]\n"
+            "application = jove#test_app\n"
+            "zodbconn.uri = memory://\n"
+            "zodb.pool_size = 3\n"
+            "zodb.cache_size = 500\n"
+            "zodb.cache_size_bytes = 1000000\n")
+        self.addCleanup(sites.close)
+        one = sites.get('one')
+        self.assertEqual(one.db_options, {
+            'pool_size': 3, 'cache_size': 500, 'cache_size_bytes': 1000000})
+        self.assertEqual(sites.stats(), {'one': {
+            'active': False,
+            'in_flight': 0,
+            'cold_starts': 0,
+            'cold_start_seconds': 0.0,
+            'cold_start_waits': 0,
+            'cold_start_wait_seconds': 0.0,
+            'connection_waits': 0,
+            'connection_wait_seconds': 0.0,
+            'connection_max_wait_seconds': 0.0,
+            'conflicts': 0,
+            'conflict_retries': 0,
+            'conflict_failures': 0,
+        }})
+
+        self.request(sites, 'one')
+        stats = sites.stats()['one']
+        self.assertEqual(stats['active'], True)
+        self.assertEqual(stats['cold_starts'], 1)
+        self.assertEqual(stats['connection_waits'], 1)
+        self.assertEqual(stats['pool_size'], 3)
+        self.assertEqual(stats['pool_connections'], 1)
+        self.assertEqual(stats['pool_in_use'], 0)
+        self.assertEqual(stats['cache_size'], 500)
+        self.assertEqual(stats['cache_size_bytes'], 1000000)
+        self.assertGreater(stats['cache_objects'], 0)
+        self.assertGreater(stats['cache_bytes'], 0)
+        self.assertIn('loads', stats)
+        self.assertIn('stores', stats)
+
+    def test_bad_db_option(self):
+        with self.assertRaises(ValueError) as cm:
+            self.makeOne(
+                "[site:one]\n"
+                "application = jove#test_app\n"
+                "zodbconn.uri = memory://\n"
+                "zodb.pool_size = lots\n")
+        self.assertEqual(str(cm.exception),
+            "Bad value for zodb.pool_size in site one, must be a "
+            "non-negative integer: lots")
+        with self.assertRaises(ValueError):
+            self.makeOne(
+                "[site:one]\n"
+                "application = jove#test_app\n"
+                "zodbconn.uri = memory://\n"
+                "zodb.cache_size = -1\n")
+
+    def test_unlimited(self):
+        sites = self.make_three_sites()
+        self.request(sites, 'one')
+        self.assertEqual(sites.active.keys(), [])
+
+
+class TestLazySite(unittest2.TestCase):
+
+    def makeOne(self, **settings):
+        from jove.site import LazySite
+        settings.setdefault('application', 'jove#test_app')
+        settings.setdefault('zodbconn.uri', 'memory://')
+        return LazySite('test', settings)
+
+    @mock.patch.dict('jove.site._entry_points', clear=True)
+    def test_application_loaded_lazily(self):
+        from jove import entrypoints
+        from jove.tests.test_functional import TestApplication
+        load_entry_point = mock.Mock(wraps=entrypoints.load_entry_point)
+        with mock.patch('jove.site.entrypoints.load_entry_point',
+                        load_entry_point):
+            sites = [self.makeOne() for i in xrange(3)]
+            self.assertEqual(load_entry_point.call_count, 0)
+            applications = [site.application for site in sites]
+            load_entry_point.assert_called_once_with(
+                'jove', 'jove.application', 'test_app')
+            for application in applications:
+                self.assertIsInstance(application, TestApplication)
+            self.assertEqual(len(set(applications)), 3)
+            services = [site.services for site in sites]
+            self.assertEqual(load_entry_point.call_count, 3)
+            self.assertEqual(len(services[0]), 3)
+
+    def test_pipeline_single_flight(self):
+        import threading
+        import time
+        site = self.makeOne()
+        started = threading.Event()
+        calls = []
+        def spin_up():
+            calls.append(True)
+            started.set()
+            time.sleep(0.1)
+            return DummyApp()
+        site.site = spin_up
+
+        pipelines = []
+        def request():
+            pipelines.append(site.pipeline())
+        first = threading.Thread(target=request)
+        first.start()
+        started.wait()
+        others = [threading.Thread(target=request) for i in range(4)]
+        for thread in others:
+            thread.start()
+        for thread in [first] + others:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(pipelines), 5)
+        self.assertEqual(len(set(map(id, pipelines))), 1)
+        self.assertEqual(site.cold_starts, 1)
+        self.assertEqual(site.cold_start_waits, 4)
+        self.assertGreater(site.cold_start_seconds, 0.05)
+        self.assertGreater(site.cold_start_max_wait_seconds, 0.0)
+        self.assertGreaterEqual(site.cold_start_wait_seconds,
+                                site.cold_start_max_wait_seconds)
+
+    def test_site_opens_storage_once(self):
+        from zodburi import resolve_uri
+        opened = []
+        def counting_resolve_uri(uri):
+            storage_factory, dbkw = resolve_uri(uri)
+            def counting_storage_factory():
+                opened.append(uri)
+                return storage_factory()
+            return counting_storage_factory, dbkw
+
+        with mock.patch('jove.site.resolve_uri', counting_resolve_uri):
+            site = self.makeOne()
+            app = site.site()
+        try:
+            self.assertEqual(opened, ['memory://'])
+            db = app.registry.zodb_database
+            conn = db.open()
+            home = conn.root()
+            self.assertEqual(home['settings'], {'foo': 3, 'things': []})
+            self.assertIn('content', home)
+            conn.close()
+        finally:
+            site.close()
+        self.assertFalse(hasattr(app.registry, 'zodb_database'))
+
+    def test_site_closes_db_on_error(self):
+        site = self.makeOne()
+        db = mock.Mock()
+        site.open_db = mock.Mock(return_value=db)
+        site.get_persistent_settings = mock.Mock(
+            side_effect=ValueError('broken'))
+        with self.assertRaises(ValueError):
+            site.site()
+        db.close.assert_called_once_with()
+
+    def test_get_persistent_settings_opens_own_db(self):
+        site = self.makeOne()
+        self.assertEqual(site.get_persistent_settings(),
+                         {'foo': 3, 'things': []})
+
+    def test_open_home_without_pyramid(self):
+        site = self.makeOne()
+        with mock.patch('jove.site.Configurator') as Configurator:
+            home, closer = site.open_home()
+        self.assertFalse(Configurator.called)
+        self.assertIsNone(site._site)
+        self.assertEqual(home['settings'], {'foo': 3, 'things': []})
+        self.assertIn('content', home)
+        db = site._home_db
+        closer()
+        home, closer = site.open_home()
+        self.assertIs(site._home_db, db)
+        closer()
+        site.close()
+        self.assertIsNone(site._home_db)
+
+    def test_open_home_shares_db_with_site(self):
+        site = self.makeOne()
+        home, closer = site.open_home()
+        db = site._home_db
+        closer()
+        app = site.site()
+        try:
+            self.assertIs(app.registry.zodb_database, db)
+            self.assertIsNone(site._home_db)
+            home, closer = site.open_home()
+            self.assertIs(home._p_jar.db(), db)
+            closer()
+        finally:
+            site.close()
+
+    def test_open_home_waits_for_site(self):
+        import threading
+        site = self.makeOne()
+        opened = []
+        def open_home():
+            home, closer = site.open_home()
+            opened.append(home._p_jar.db())
+            closer()
+        thread = threading.Thread(target=open_home)
+        get_persistent_settings = site.get_persistent_settings
+        def spinning_up(db):
+            thread.start()
+            thread.join(0.1)
+            self.assertTrue(thread.is_alive())
+            return get_persistent_settings(db)
+        site.get_persistent_settings = spinning_up
+        app = site.site()
+        try:
+            thread.join()
+            self.assertEqual(opened, [app.registry.zodb_database])
+            self.assertIsNone(site._home_db)
+        finally:
+            site.close()
+
+    def test_root_factory_caches_home(self):
+        import webtest
+        site = self.makeOne(zodb_path='/foo/bar')
+        find_home = mock.Mock(wraps=site.find_home)
+        site.find_home = find_home
+        app = webtest.TestApp(site.site())
+        try:
+            self.assertEqual(find_home.call_count, 1)
+            self.assertIsNotNone(site._home_oid)
+            self.assertEqual(app.get('/').body, 'Test Application')
+            self.assertEqual(app.get('/').body, 'Test Application')
+            self.assertEqual(find_home.call_count, 1)
+
+            # Missing home falls back to slow path
+            site._home_oid = '\xff' * 8
+            self.assertEqual(app.get('/').body, 'Test Application')
+            self.assertEqual(find_home.call_count, 2)
+            self.assertNotEqual(site._home_oid, '\xff' * 8)
+        finally:
+            site.close()
+        self.assertIsNone(site._home_oid)
+
+    def test_pipeline_warm(self):
+        site = self.makeOne()
+        site.site = DummyApp
+        pipeline = site.pipeline()
+        self.assertIs(site.pipeline(), pipeline)
+        self.assertEqual(site.cold_starts, 1)
+        self.assertEqual(site.cold_start_waits, 0)
+
+
+class DummyApp(object):
+
+    def __call__(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['Hello World']
@@ -8,3 +8,27 @@ def asbool(s):
 
 def find_home(context):
     return find_root(context).__home__
+
+
+class ClosingIterator(object):
+    """
+    Wraps a WSGI app_iter, calling `callback` after the app_iter has been
+    closed.  Iteration is passed straight through to the wrapped app_iter.
+    """
+
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        callback, self.callback = self.callback, None
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            if callback is not None:
+                callback()
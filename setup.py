@@ -31,7 +31,6 @@ install_requires=[
     'mock',
     'pyramid_tm',
     'pyramid_zodbconn',
-    'repoze.retry',
     ]
 
 tests_require = install_requires + ['WebTest']
@@ -76,6 +75,7 @@ setup(name='jove',
           evolution = jove.services.evolution:EvolutionService
 
           [jove.script]
+          check = jove.scripts.check:config_parser
           debug = jove.scripts.debug:config_parser
           serve = jove.scripts.serve:config_parser
           settings = jove.scripts.settings:config_parser